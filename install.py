@@ -2,10 +2,11 @@
 # This is ArchLinux install script
 
 import os
-import re
 import sys
 import subprocess
 import platform
+import time
+import resource
 
 UEFI = True
 BIOS = False
@@ -15,12 +16,30 @@ GNOME = 1
 PLASMA = 2
 
 
+step_timings = []  # (步骤, 耗时, 子进程CPU时间)
+
+
+def child_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def print_timings(top: int = 10):
+    """按耗时从高到低打印各步骤"""
+    for prompt, seconds, cpu in sorted(step_timings, key=lambda t: t[1], reverse=True)[:top]:
+        print(f"\033[34m{prompt}\033[0m \033[32m{seconds:.1f}s (cpu {cpu:.1f}s)\033[0m")
+
+
 def just_run(prompt: str):
     def decorator(func):
         def wrapper(*args, **kwargs):
             print(f"\033[34m正在{prompt}...\033[0m")
+            start = time.monotonic()
+            cpu = child_cpu()
             func(*args, **kwargs)
-            print("\033[32mOK\033[0m")
+            seconds = time.monotonic() - start
+            step_timings.append((prompt, seconds, child_cpu() - cpu))
+            print(f"\033[32mOK ({seconds:.1f}s)\033[0m")
 
         return wrapper
 
@@ -60,23 +79,48 @@ def run_cmd(*cmd):
     return output
 
 
-def disk_partition(*ops):
-    cmd_format = 'echo -e "{args}" | fdisk'
-    args = []
-    for p in ops:
-        args.append(f"{p}\\n")
-    return cmd_format.format(args="".join(args))
+def disk_partition(label: str, swap: int):
+    """
+    生成一次写入整个分区表的 sfdisk 命令: boot(EFI)分区 512M, swap分区, 剩余空间为根分区
+    """
+    boot_type = "U" if label == "gpt" else "L, bootable"
+    script = f"label: {label}\\n\\nsize=512MiB, type={boot_type}\\nsize={swap}GiB, type=S\\ntype=L\\n"
+    return f'printf "{script}" | sfdisk --wipe always --wipe-partitions always'
 
 
-def find_disk():
-    output = run_cmd("fdisk", "-l")
-    disks_ = re.findall("(/dev/.+?: [0-9 .]+? .+?iB)", output)
+def partition_path(disk: str, number: int):
+    """
+    /dev/sda -> /dev/sda1, /dev/nvme0n1 -> /dev/nvme0n1p1
+    """
+    return f"{disk}p{number}" if disk[-1].isdigit() else f"{disk}{number}"
+
+
+def list_disks(root: str = "/"):
+    """
+    直接读取 /sys/block 列出物理磁盘, 返回 "/dev/xxx: 大小 GiB 型号" 列表
+    """
+    block = os.path.join(root, "sys/block")
     disks = []
-    for each in disks_:
-        if "rom" in each or "loop" in each or "airoot" in each:
+    for name in sorted(os.listdir(block)) if os.path.isdir(block) else []:
+        if name.startswith(("loop", "ram", "sr", "zram", "fd", "dm-", "md")):
             continue
-        else:
-            disks.append(each)
+        try:
+            with open(os.path.join(block, name, "size")) as f:
+                size = int(f.read().strip()) * 512
+        except (OSError, ValueError):
+            continue
+        if size == 0:
+            continue
+        model = ""
+        if os.path.exists(os.path.join(block, name, "device/model")):
+            with open(os.path.join(block, name, "device/model")) as f:
+                model = f.read().strip()
+        disks.append(f"/dev/{name}: {size / 1024 ** 3:.2f} GiB {model}".rstrip())
+    return disks
+
+
+def find_disk():
+    disks = list_disks()
 
     if len(disks):
         print("\033[34m发现如下可用磁盘:\033[0m")
@@ -123,6 +167,19 @@ class Installation:
         """
         self.run_cmd(f"arch-chroot /mnt {cmd}")
 
+    def run_cmd_chroot_batch(self, *cmds):
+        """
+        运行多条命令, 只进入一次 arch-chroot
+        """
+        script = []
+        for i, cmd in enumerate(cmds):
+            print(f"\033[33mRUN\033[0m >>> \033[36m(chroot) {cmd}\033[0m")
+            script.append(f"(\n{cmd}\n) </dev/null\ncode=$?\n"
+                          f"[ $code -eq 0 ] || {{ echo \"ERROR chroot command {i + 1} exit $code\" >&2; exit $code; }}")
+        p = subprocess.run(["arch-chroot", "/mnt", "bash", "-s"], input="\n".join(script) + "\n", text=True)
+        if p.returncode != 0:
+            sys.exit(p.returncode)
+
     @just_run("更新系统时间")
     def update_datetime(self):
         """
@@ -135,42 +192,22 @@ class Installation:
         """
         磁盘分区: 包含分区，格式化，挂载，三步骤 todo
         """
+        label = "gpt" if self.boot == UEFI else "dos"
+        run_cmd(disk_partition(label, self.swap), self.disk)
+        boot_part, swap_part, root_part = (partition_path(self.disk, n) for n in (1, 2, 3))
+        # 格式化
         if self.boot == UEFI:
-            part = disk_partition("d", "", "d", "", "d", "", "d", "", "d", "", "d", "", "d", "",  # 删除现有分区
-                              "g",  # 新建gpt分区表
-                              "n", "", "", "+512M",  # 新建EFI分区/boot分区
-                              "n", "", "", f"+{self.swap}G",  # swap分区
-                              "n", "", "", "",  # 根分区
-                              "w"  # 写入
-                              )
-            run_cmd(part, self.disk)
-            # 格式化
-            run_cmd(f"mkfs.vfat {self.disk}1")
-            run_cmd(f"mkswap {self.disk}2")
-            run_cmd(f"mkfs.ext4 {self.disk}3")
-            # 挂载
-            self.run_cmd(f"mount {self.disk}3 /mnt")
-            self.run_cmd("mkdir -p /mnt/boot/EFI")
-            self.run_cmd(f"mount {self.disk}1 /mnt/boot/EFI")
-            self.run_cmd(f"swapon {self.disk}2")
-        elif self.boot == BIOS:
-            part = disk_partition("d", "", "d", "", "d", "", "d", "", "d", "", "d", "", "d", "",  # 删除现有分区
-                              "o",  # 新建mbr分区表
-                              "n", "", "", "", "+512M", "Y",  # 新建EFI分区/boot分区
-                              "n", "", "", "", f"+{self.swap}G", "Y",  # swap分区
-                              "n", "", "", "", "", "Y",  # 根分区
-                              "w"  # 写入
-                              )
-            run_cmd(part, self.disk)
-            # 格式化
-            run_cmd(f"mkfs.ext2 {self.disk}1")
-            run_cmd(f"mkswap {self.disk}2")
-            run_cmd(f"mkfs.ext4 {self.disk}3")
-            # 挂载
-            self.run_cmd(f"mount {self.disk}3 /mnt")
-            self.run_cmd("mkdir -p /mnt/boot")
-            self.run_cmd(f"mount {self.disk}1 /mnt/boot")
-            self.run_cmd(f"swapon {self.disk}2")
+            run_cmd(f"mkfs.vfat -F 32 {boot_part}")
+        else:
+            run_cmd(f"mkfs.ext2 -F {boot_part}")
+        run_cmd(f"mkswap {swap_part}")
+        run_cmd(f"mkfs.ext4 -F {root_part}")
+        # 挂载
+        boot_dir = "/mnt/boot/EFI" if self.boot == UEFI else "/mnt/boot"
+        self.run_cmd(f"mount {root_part} /mnt")
+        self.run_cmd(f"mkdir -p {boot_dir}")
+        self.run_cmd(f"mount {boot_part} {boot_dir}")
+        self.run_cmd(f"swapon {swap_part}")
 
     @just_run("下载基础软件包")
     def download_linux(self):
@@ -184,33 +221,33 @@ class Installation:
         """
         生成fstab文件
         """
-        self.run_cmd("genfstab -U /mnt >> /mnt/etc/fstab")
+        self.run_cmd("genfstab -U /mnt > /mnt/etc/fstab")  # 重复执行不会追加出重复的条目
 
     @just_run("设置时区")
     def set_timezone(self):
         """
         设置时区
         """
-        self.run_cmd_chroot("ln -sf /usr/share/zoneinfo/Asia/Shanghai /etc/localtime")
-        self.run_cmd_chroot("hwclock --systohc")
+        self.run_cmd_chroot_batch("ln -sf /usr/share/zoneinfo/Asia/Shanghai /etc/localtime",
+                                  "hwclock --systohc")
 
     @just_run("设置地区")
     def set_locale(self):
         """
         系统语言设置
         """
-        self.run_cmd_chroot("sed -in-place -e 's/#zh_CN.UTF-8 UTF-8/zh_CN.UTF-8 UTF-8/g' /etc/locale.gen")
-        self.run_cmd_chroot("sed -in-place -e 's/#en_US.UTF-8 UTF-8/en_US.UTF-8 UTF-8/g' /etc/locale.gen")
-        self.run_cmd_chroot("locale-gen")
-        self.run_cmd_chroot('echo "LANG=en_US.UTF-8" > /etc/locale.conf')
+        self.run_cmd_chroot_batch("sed -in-place -e 's/#zh_CN.UTF-8 UTF-8/zh_CN.UTF-8 UTF-8/g' /etc/locale.gen",
+                                  "sed -in-place -e 's/#en_US.UTF-8 UTF-8/en_US.UTF-8 UTF-8/g' /etc/locale.gen",
+                                  "locale-gen",
+                                  'echo "LANG=en_US.UTF-8" > /etc/locale.conf')
 
     @just_run("设置host")
     def set_host(self):
         """
         设置系统host
         """
-        self.run_cmd_chroot(f'echo "{self.hostname}" > /etc/hostname')
-        self.run_cmd_chroot('''tee /etc/hosts <<-'EOF'\n127.0.0.1	localhost\n::1		localhost\nEOF''')
+        self.run_cmd_chroot_batch(f'echo "{self.hostname}" > /etc/hostname',
+                                  '''tee /etc/hosts <<-'EOF'\n127.0.0.1	localhost\n::1		localhost\nEOF''')
 
     @just_run("设置网络")
     def set_network(self):
@@ -218,8 +255,7 @@ class Installation:
         设置系统网络：包括下载，自启动
         """
         self.run_cmd("pacstrap /mnt dhcpcd networkmanager")
-        self.run_cmd_chroot("systemctl enable dhcpcd")
-        self.run_cmd_chroot("systemctl enable NetworkManager")
+        self.run_cmd_chroot_batch("systemctl enable dhcpcd", "systemctl enable NetworkManager")
 
     @just_run("设置grub引导")
     def set_grub(self):
@@ -228,22 +264,21 @@ class Installation:
         """
         if self.boot == UEFI:
             self.run_cmd("pacstrap /mnt grub efibootmgr")
-            self.run_cmd_chroot("grub-install --target=x86_64-efi --efi-directory=/boot/EFI --bootloader-id=GRUB")
-            self.run_cmd_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
+            self.run_cmd_chroot_batch("grub-install --target=x86_64-efi --efi-directory=/boot/EFI --bootloader-id=GRUB",
+                                      "grub-mkconfig -o /boot/grub/grub.cfg")
         elif self.boot == BIOS:
             self.run_cmd("pacstrap /mnt grub")
-            self.run_cmd_chroot(f"grub-install {self.disk}")
-            self.run_cmd_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
+            self.run_cmd_chroot_batch(f"grub-install {self.disk}", "grub-mkconfig -o /boot/grub/grub.cfg")
 
     @just_run("设置用户名和密码")
     def set_user(self):
         """
         设置普通用户
         """
-        self.run_cmd_chroot(f"sh -c \"echo 'root:{self.password}' | chpasswd\"")
-        self.run_cmd_chroot(f"useradd -m -G wheel -s /bin/zsh {self.username}")
-        self.run_cmd_chroot(f"sh -c \"echo '{self.username}:{self.password}' | chpasswd\"")
-        self.run_cmd_chroot("sed -in-place -e 's/# %wheel ALL=(ALL) ALL/%wheel ALL=(ALL) ALL/g' /etc/sudoers")
+        self.run_cmd_chroot_batch(f"echo 'root:{self.password}' | chpasswd",
+                                  f"useradd -m -G wheel -s /bin/zsh {self.username}",
+                                  f"echo '{self.username}:{self.password}' | chpasswd",
+                                  "sed -in-place -e 's/# %wheel ALL=(ALL) ALL/%wheel ALL=(ALL) ALL/g' /etc/sudoers")
 
     @just_run("设置桌面环境")
     def set_desktop(self):
@@ -345,6 +380,7 @@ def main():
     installation.set_desktop()
     installation.finish()
 
+    print_timings()
     print("SUCCESS")
 
 
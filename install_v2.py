@@ -5,9 +5,38 @@
 # =============================================
 
 import os
+import stat
+import re
 import sys
+import json
+import argparse
+import copy
+import math
+import time
+import hashlib
+import difflib
+import signal
+import logging
+import resource
+import selectors
+import collections
+import logging.handlers
+import fnmatch
+import tarfile
 import platform
+import shutil
+import threading
 import subprocess
+import http.server
+import functools
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    tomllib = None
 
 # =================================== global values ====================================
 
@@ -25,14 +54,69 @@ support_shells = ["bash", "zsh", "fish"]
 support_desktops = [NODESKTOP, GNOME_DESKTOP, PLASMA_DESKTOP]
 support_language = ["en", "zh"]
 
-base_packages = ["base", "base-devel", "linux", "linux-firmware", "vim", "openssh", "zsh", "fish", "git", "wget", "curl", "grub", "dhcpcd", "net-tools"]
-desktop_base_packages = ["networkmanager", "xorg", "alsa-utils", "mesa", "pulseaudio", "pulseaudio-alsa", "xf86-input-synaptics", "ttf-dejavu wqy-microhei"]
+base_packages = ["base", "base-devel", "linux-firmware", "vim", "openssh", "zsh", "fish", "git", "wget", "curl", "dhcpcd", "net-tools"]
+desktop_base_packages = ["networkmanager", "xorg", "alsa-utils", "mesa", "pulseaudio", "pulseaudio-alsa", "xf86-input-synaptics", "ttf-dejavu", "wqy-microhei"]
 gnome_packages = ["gdm", "gnome", "gnome-extra"]
 plasma_packages = ["plasma", "kde-applications", "libdbusmenu-glib", "appmenu-gtk-module", "packagekit-qt5"]
 efi_packages = ["efibootmgr"]
 intel_packages = ["intel-ucode"]
 amd_packages = ["amd-ucode"]
 
+MIRRORLIST = "/etc/pacman.d/mirrorlist"
+MIRROR_CACHE = "/tmp/archinstall_mirrors.json"
+MIRROR_CACHE_TTL = 6 * 60 * 60  # 秒
+MIRROR_PROBE_DB = "core.db"
+MIRROR_PROBE_BYTES = 512 * 1024
+MIRROR_TOP = 5
+
+PACMAN_CONF = "/etc/pacman.conf"
+MOUNT_ROOT = "/mnt"  # 单盘安装的挂载点, 多盘安装时每块盘挂在MOUNT_ROOT/<磁盘名>
+INSTALL_PACMAN_CONF = "/tmp/pacman.install.conf"
+INSTALL_MIRRORLIST = "/tmp/mirrorlist.install"
+HOST_PKG_CACHE = "/var/cache/pacman/pkg"
+PARALLEL_DOWNLOADS_DEFAULT = 5
+PARALLEL_DOWNLOADS_TARGET_SPEED = 20 * 1024 * 1024  # 期望跑满的带宽, 字节/秒
+SYNC_DB_DIR = "/var/lib/pacman/sync"
+RESOLVE_CACHE = "/tmp/archinstall_resolve.json"
+SYS_ROOT = "/"  # 硬件探测读取的根目录, 测试时可以指向伪造的sysfs/procfs
+KERNEL_CMDLINE = "/proc/cmdline"
+CMDLINE_PREFIX = "archinstall."
+JOURNAL_RAM = "/run/archinstall/journal.json"
+JOURNAL_TARGET = "var/lib/archinstall/journal.json"  # 相对目标根目录
+SHARED_DOWNLOAD_DB = "/tmp/archinstall-download-db"  # 只下载不安装时用的空本地数据库
+PROGRESS_INTERVAL = 15  # 多盘安装时进度表的刷新间隔, 秒
+HISTORY_FILE = "/var/lib/archinstall/history.json"  # 各步骤历史耗时, 用--history放到持久化的位置
+HISTORY_KEEP = 10
+IMAGE_ZSTD_LEVEL = 3
+IMAGE_CHUNK = 1 << 20  # 镜像流水线每次转发的块大小
+IMAGE_EXCLUDES = ["./proc/*", "./sys/*", "./dev/*", "./run/*", "./tmp/*", "./mnt/*",
+                  "./boot/EFI/*", "./boot/loader/*",  # vfat不支持属主, 由引导安装步骤重新写入
+                  "./swap/*", "./swapfile", "./var/cache/pacman/pkg/*", "./var/log/journal/*",
+                  "./" + JOURNAL_TARGET,
+                  "./etc/machine-id", "./etc/ssh/ssh_host_*"]  # 每台机器单独生成
+IMAGE_BOOT_STAGING = "var/tmp/archinstall-boot"  # /boot是vfat的ESP时, 镜像里的/boot先解压到这里(相对目标根目录)
+TRACE_FILE = "/run/archinstall/trace.json"
+LOG_FILE = "/run/archinstall/install.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+TAIL_LINES = 40  # 失败时显示的输出行数
+TIMEOUT_CODE = 124  # 与coreutils timeout一致
+PKG_EXTS = (".pkg.tar.zst", ".pkg.tar.xz", ".pkg.tar.gz", ".pkg.tar")
+CACHE_SERVE_PORT = 9129
+PARTITION_WAIT = 10  # 分区后等待设备节点出现的时间, 秒
+
+candidate_mirrors = [
+    "https://mirrors.ustc.edu.cn/archlinux/$repo/os/$arch",
+    "https://mirrors.tuna.tsinghua.edu.cn/archlinux/$repo/os/$arch",
+    "https://mirrors.bfsu.edu.cn/archlinux/$repo/os/$arch",
+    "https://mirrors.aliyun.com/archlinux/$repo/os/$arch",
+    "https://mirrors.163.com/archlinux/$repo/os/$arch",
+    "https://mirror.sjtu.edu.cn/archlinux/$repo/os/$arch",
+    "https://geo.mirror.pkgbuild.com/$repo/os/$arch",
+    "https://mirrors.kernel.org/archlinux/$repo/os/$arch",
+    "https://mirror.rackspace.com/archlinux/$repo/os/$arch",
+]
+
 
 # ======================================================================================
 
@@ -66,38 +150,556 @@ def apply_cyan(s) -> str:
 # ======================================================================================
 
 
-def run_cmd(cmd: str, debug: bool = True, exit_: bool = True, stdout: bool = False) -> str:
+# =================================== tracer ===========================================
+
+def read_disk_written(disk: str) -> int:
+    """/sys/block/<disk>/stat 第7列是写入的扇区数(固定按512字节计)"""
+    if not disk:
+        return 0
+    try:
+        with open(f"/sys/block/{os.path.basename(disk)}/stat") as f:
+            return int(f.read().split()[6]) * 512
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def read_net_received() -> int:
+    total = 0
+    try:
+        with open("/proc/net/dev") as f:
+            for line in f.readlines()[2:]:
+                iface, data = line.split(":", 1)
+                if iface.strip() != "lo":
+                    total += int(data.split()[0])
+    except (OSError, ValueError):
+        pass
+    return total
+
+
+def read_child_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Tracer:
+    """记录每个步骤和命令的耗时与资源, 输出Chrome trace-event格式(chrome://tracing, perfetto)
+    步骤并发执行时子进程CPU、磁盘和网络计数是整个进程的增量, 只能作为参考"""
+
+    def __init__(self):
+        self.disk = None  # 目标磁盘, 用来统计写入量
+        self.events = []
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.threads = {}
+
+    def _tid(self) -> int:
+        ident = threading.get_ident()
+        with self.lock:
+            return self.threads.setdefault(ident, len(self.threads) + 1)
+
+    def add(self, name: str, cat: str, start: float, seconds: float, args: dict = None):
+        """start为time.time()时间戳"""
+        event = {"name": name, "cat": cat, "ph": "X", "pid": 1, "tid": self._tid(),
+                 "ts": int((start - self.start) * 1e6), "dur": int(seconds * 1e6), "args": args or {}}
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, cat: str):
+        start = time.time()
+        t0 = time.monotonic()
+        cpu0, disk0, net0 = read_child_cpu(), read_disk_written(self.disk), read_net_received()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time.monotonic() - t0, {
+                "child_cpu": round(read_child_cpu() - cpu0, 3),
+                "disk_written": read_disk_written(self.disk) - disk0,
+                "net_received": read_net_received() - net0,
+            })
+
+    def write(self, path: str = TRACE_FILE):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            data = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def print_summary(self, cat: str = "step", top: int = 10):
+        events = sorted((e for e in self.events if e["cat"] == cat), key=lambda e: e["dur"], reverse=True)
+        for e in events[:top]:
+            a = e["args"]
+            print("{} {}".format(apply_blue(f"{e['name']:<16}"), apply_green(
+                f"{e['dur'] / 1e6:>8.1f}s  cpu {a.get('child_cpu', 0):>7.1f}s  "
+                f"disk {a.get('disk_written', 0) / 1024 / 1024:>8.1f}MiB  "
+                f"net {a.get('net_received', 0) / 1024 / 1024:>8.1f}MiB")))
+
+
+tracer = Tracer()
+
+
+# =================================== progress =========================================
+
+class StepHistory:
+    """以前每次安装各步骤的实际耗时, 用来代替Step里写死的预估值; key为步骤名或"步骤名:变体"(如桌面环境)"""
+
+    def __init__(self, path: str = HISTORY_FILE):
+        self.path = path
+        self.runs = {}  # key -> [秒, ...], 最近HISTORY_KEEP次
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.runs = json.load(f).get("steps", {})
+        except (OSError, ValueError):
+            pass
+
+    def estimate(self, name: str, variant: str = None) -> float:
+        """历史耗时的中位数, 没有记录返回None"""
+        for key in ([f"{name}:{variant}"] if variant else []) + [name]:
+            runs = sorted(self.runs.get(key, []))
+            if runs:
+                return runs[len(runs) // 2]
+        return None
+
+    def record(self, name: str, seconds: float, variant: str = None):
+        with self.lock:
+            for key in ([f"{name}:{variant}"] if variant else []) + [name]:
+                self.runs[key] = (self.runs.get(key, []) + [round(seconds, 1)])[-HISTORY_KEEP:]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            data = {"steps": self.runs}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+class PacmanProgress:
+    """从pacman/pacstrap的输出(非终端时没有进度条, 每个包输出一行)中解析下载和安装进度;
+    --parallel-download时每组软件包是一次单独的pacstrap, 每次事务单独计数, 按组数合成整个步骤的进度"""
+
+    def __init__(self, transactions: int = 1):
+        self.transactions = transactions  # 预计的pacman事务数
+        self.finished = 0  # 已经结束的事务
+        self.reset()
+
+    def reset(self):
+        self.total = 0  # Packages (N)
+        self.download_size = 0  # Total Download Size, 字节
+        self.downloaded = 0
+        self.installed = 0
+        self.first_download = None
+
+    def feed(self, line: str):
+        m = re.search(r"Packages \((\d+)\)", line)
+        if m:
+            if self.total:  # 新事务的开头, 上一个事务已经结束
+                self.finished += 1
+                self.reset()
+            self.total = int(m.group(1))
+            return
+        m = re.search(r"Total Download Size:\s+([\d.]+) (KiB|MiB|GiB)", line)
+        if m:
+            self.download_size = int(float(m.group(1)) * 1024 ** ("KiB", "MiB", "GiB").index(m.group(2)) * 1024)
+            return
+        m = re.match(r"^\s*(\S+) downloading\.\.\.$", line.rstrip())
+        if m and not m.group(1).endswith(".db"):
+            self.downloaded += 1
+            self.first_download = self.first_download or time.monotonic()
+            return
+        m = re.match(r"^\(\s*(\d+)/\s*(\d+)\) (installing|upgrading|reinstalling|downgrading) ", line)
+        if m:
+            self.installed, self.total = int(m.group(1)), int(m.group(2))
+
+    def fraction(self) -> float:
+        """下载和安装各算一半, 开始安装说明已经全部下载完; 每个事务占相同的份额"""
+        current = 0.0
+        if self.total:
+            downloaded = self.total if self.installed else min(self.downloaded, self.total)
+            current = (downloaded + min(self.installed, self.total)) / (2 * self.total)
+        return min((self.finished + current) / max(self.transactions, self.finished + 1), 1.0)
+
+    def describe(self) -> str:
+        if not self.total:
+            return ""
+        group = f"{self.finished + 1}/{self.transactions}grp " if self.transactions > 1 else ""
+        return f"{group}{self.installed or min(self.downloaded, self.total)}/{self.total}pkg"
+
+    def speed(self) -> float:
+        """按下载的包数折算的平均下载速度, 字节/秒"""
+        if not self.first_download or not self.total or self.installed:
+            return 0.0
+        seconds = time.monotonic() - self.first_download
+        return self.download_size * self.downloaded / self.total / seconds if seconds > 0 else 0.0
+
+
+class Progress:
+    """按预估耗时给每个步骤加权计算总进度; pacstrap步骤按输出细分.
+    ETA开始时用预估的总耗时, 随着进度增加逐渐改用实际速度推算"""
+
+    def __init__(self):
+        self.weights = {}  # 步骤名 -> 预估秒数
+        self.expected = 0.0  # 按并发模拟的总耗时
+        self.done = {}  # 步骤名 -> 0~1
+        self.running = {}  # 步骤名 -> 开始时间
+        self.pacman = {}  # 步骤名 -> PacmanProgress
+        self.start = None
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+        self.rows = 0  # 终端行数, 0表示不是终端, 定期打印一行代替进度条
+
+    def setup(self, steps: list, expected: float):
+        self.weights = {s.name: max(s.estimate, 0.1) for s in steps}
+        self.expected = expected
+        self.start = time.monotonic()
+
+    def begin(self, name: str):
+        with self.lock:
+            self.running[name] = time.monotonic()
+            self.done[name] = 0.0
+            if name == "download_linux":
+                self.pacman[name] = PacmanProgress()
+
+    def expect_transactions(self, name: str, count: int):
+        with self.lock:
+            if name in self.pacman:
+                self.pacman[name].transactions = max(1, count)
+
+    def end(self, name: str, skipped: bool = False) -> float:
+        """返回步骤耗时; 跳过的步骤不计入进度, 否则会让实际速度看起来偏快"""
+        with self.lock:
+            t0 = self.running.pop(name, time.monotonic())
+            if skipped:
+                self.weights.pop(name, None)
+                self.done.pop(name, None)
+            else:
+                self.done[name] = 1.0
+            self.pacman.pop(name, None)
+        return time.monotonic() - t0
+
+    def feed(self, line: str):
+        if not self.pacman:
+            return
+        with self.lock:
+            for name, p in self.pacman.items():
+                p.feed(line)
+                self.done[name] = min(p.fraction(), 0.99)
+
+    def fraction(self) -> float:
+        total = sum(self.weights.values())
+        if total == 0:
+            return 0.0
+        return sum(w * self.done.get(n, 0.0) for n, w in self.weights.items()) / total
+
+    def eta(self) -> float:
+        p = self.fraction()
+        elapsed = time.monotonic() - self.start
+        model = self.expected * (1 - p)
+        if p <= 0:
+            return model
+        observed = elapsed * (1 - p) / p
+        return (1 - p) * model + p * observed
+
+    def render(self, width: int = 80) -> str:
+        with self.lock:
+            p = self.fraction()
+            eta = self.eta()
+            steps = ",".join(self.running) or "-"
+            speed = sum(x.speed() for x in self.pacman.values())
+            pkgs = " ".join(x.describe() for x in self.pacman.values() if x.total)
+        info = f" {p * 100:3.0f}% {steps} {pkgs}"
+        if speed:
+            info += f" {speed / 1024 / 1024:.1f}MiB/s"
+        info += f" ETA {int(eta) // 60:02d}:{int(eta) % 60:02d}"
+        bar = max(10, min(40, width - len(info) - 3))
+        filled = int(bar * p)
+        return f"[{'#' * filled}{'-' * (bar - filled)}]{info}"[:width - 1]
+
+    def draw(self):
+        if self.rows:
+            # 保存光标, 在保留的最后一行画进度条, 再回到原来的位置继续滚动输出
+            line = self.render(shutil.get_terminal_size().columns)
+            sys.stdout.write(f"\0337\033[{self.rows};1H\033[2K{line}\0338")
+            sys.stdout.flush()
+        else:
+            print("{} {}".format(apply_cyan("[PROGRESS]"), apply_yellow(self.render(120))), flush=True)
+
+    def show(self):
+        """终端上把最后一行留给进度条(设置滚动区域), 其他输出在上面正常滚动"""
+        if sys.stdout.isatty():
+            self.rows = shutil.get_terminal_size().lines
+            sys.stdout.write(f"\n\033[1;{self.rows - 1}r\033[{self.rows - 1};1H")
+
+        def loop():
+            interval = 1 if self.rows else PROGRESS_INTERVAL
+            while not self.stop.wait(interval):
+                self.draw()
+
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+
+    def hide(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.rows:
+            sys.stdout.write(f"\0337\033[r\033[{self.rows};1H\033[2K\0338")
+            sys.stdout.flush()
+
+
+progress = Progress()
+
+
+# =================================== command runner ===================================
+
+cancel_event = threading.Event()  # 置位后正在运行的命令都会被终止
+_running = set()  # 正在运行的Popen, 每个都是单独的进程组, 收不到终端的SIGINT
+_running_lock = threading.Lock()
+_logger = None
+
+
+def get_logger() -> logging.Logger:
+    """命令输出写入滚动日志文件"""
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger("archinstall")
+        _logger.setLevel(logging.INFO)
+        _logger.propagate = False
+        try:
+            os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            _logger.addHandler(handler)
+        except OSError:
+            _logger.addHandler(logging.NullHandler())
+    return _logger
+
+
+class CommandResult:
+    def __init__(self, code: int, output: str, tail: list):
+        self.code = code
+        self.output = output  # 只在capture时保存完整输出
+        self.tail = tail  # 最后TAIL_LINES行
+
+
+def _kill(p: subprocess.Popen):
+    """先TERM整个进程组, 5秒后还没退出就KILL"""
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        p.wait(5)
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def terminate_running():
+    """Ctrl-C时调用: 置位cancel_event并立即TERM所有正在运行的进程组, 5秒后的KILL由各自的run_stream负责"""
+    cancel_event.set()
+    with _running_lock:
+        procs = list(_running)
+    for p in procs:
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def run_stream(cmd, echo: bool = True, capture: bool = True, timeout: float = None, input_: str = None,
+               cancel: threading.Event = None, on_line=None) -> CommandResult:
+    """非阻塞读取stdout/stderr, 按行输出到终端和日志, 内存里只保留尾部若干行(capture时保留全部)
+    on_line(line)返回True表示该行已被处理, 不再输出和记录"""
+    cancel = cancel or cancel_event
+    logger = get_logger()
+    logger.info(f"[RUN] {cmd}")
+    p = subprocess.Popen(cmd, shell=isinstance(cmd, str), stdin=subprocess.PIPE if input_ is not None else None,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    with _running_lock:
+        _running.add(p)
+    if input_ is not None:
+        p.stdin.write(input_.encode())
+        p.stdin.close()
+
+    sel = selectors.DefaultSelector()
+    for f in (p.stdout, p.stderr):
+        os.set_blocking(f.fileno(), False)
+        sel.register(f, selectors.EVENT_READ)
+    partial = {p.stdout: b"", p.stderr: b""}
+    tail = collections.deque(maxlen=TAIL_LINES)
+    captured = []
+    deadline = time.monotonic() + timeout if timeout else None
+    code = None
+
+    def emit(raw: bytes, f):
+        line = raw.decode(errors="replace")
+        progress.feed(line)
+        if on_line is not None and on_line(line):
+            return
+        tail.append(line)
+        if capture:
+            captured.append(line)
+        logger.info(line.rstrip("\n"))
+        if echo:
+            (sys.stdout if f is p.stdout else sys.stderr).write(line)
+
+    while sel.get_map():
+        if cancel.is_set() or (deadline and time.monotonic() > deadline):
+            _kill(p)
+            code = TIMEOUT_CODE if not cancel.is_set() else -signal.SIGTERM
+            logger.info(f"[KILLED] {cmd}")
+            break
+        for key, _ in sel.select(0.5):
+            f = key.fileobj
+            chunk = os.read(f.fileno(), 65536)
+            if not chunk:
+                sel.unregister(f)
+                if partial[f]:
+                    emit(partial[f], f)
+                continue
+            data = partial[f] + chunk
+            *lines, partial[f] = data.split(b"\n")
+            for line in lines:
+                emit(line + b"\n", f)
+    sel.close()
+
+    if code is None:
+        code = p.wait()
+    else:
+        p.wait()
+    with _running_lock:
+        _running.discard(p)
+    return CommandResult(code, "".join(captured).rstrip("\n"), list(tail))
+
+
+def run_cmd(cmd: str, debug: bool = True, exit_: bool = True, stdout: bool = False, timeout: float = None) -> str:
+    """stdout=True时实时输出命令的输出, 否则只返回输出(用于探测类命令)"""
     if debug:
         print("{} {}".format(apply_cyan("[RUN]"), apply_yellow(cmd)))
 
-    if stdout:
-        code = os.system(cmd)
-        output = ""
-    else:
-        code, output = subprocess.getstatusoutput(cmd)
+    with tracer.span(cmd, "cmd"):
+        result = run_stream(cmd, echo=stdout, capture=not stdout, timeout=timeout)
 
     try:
-        assert code == 0
+        assert result.code == 0
     except AssertionError:
         if exit_:
-            print("{}".format(apply_red(f"RUN ERROR: {cmd}")))
-            sys.exit(code)
+            if not stdout:
+                sys.stderr.write("".join(result.tail))
+            state = "TIMEOUT" if result.code == TIMEOUT_CODE and timeout else "RUN ERROR"
+            print("{}".format(apply_red(f"{state}: {cmd}")))
+            sys.exit(result.code if result.code > 0 else 1)
         else:
             return ""
 
-    return output
+    return result.output
+
+
+class ChrootResult:
+    def __init__(self, cmd: str, code: int = None, seconds: float = 0.0, output: str = "", label: str = None):
+        self.cmd = cmd
+        self.label = label or cmd  # 打印和trace时代替cmd, 不让密码哈希之类的内容出现在日志里
+        self.code = code  # None 表示因前面的命令失败而没有执行
+        self.seconds = seconds
+        self.output = output
 
 
-def run_cmd_chroot(cmd: str, debug: bool = True, exit_: bool = True, stdout: bool = False) -> str:
-    return run_cmd(f"arch-chroot /mnt {cmd}", debug, exit_, stdout)
+_chroot_locks = {}  # 根目录 -> Lock
+_chroot_locks_guard = threading.Lock()
 
 
-def disk_partition(*ops):
-    cmd_format = 'echo -e "{args}" | fdisk '
-    args = []
-    for p in ops:
-        args.append(f"{p}\\n")
-    return cmd_format.format(args="".join(args))
+def chroot_lock(root: str) -> threading.Lock:
+    """同一个根目录同时只能有一个arch-chroot: 每个arch-chroot各自绑定挂载/proc /sys /dev /run,
+    先结束的那个卸载时会把还在运行的其他会话的挂载一起拆掉"""
+    with _chroot_locks_guard:
+        return _chroot_locks.setdefault(os.path.realpath(root), threading.Lock())
+
+
+class ChrootSession:
+    """只进入一次arch-chroot, 通过同一个shell依次执行一批命令, 每条命令单独记录退出码和耗时"""
+    MARK = "@@CHROOT@@"
+
+    def __init__(self, root: str = MOUNT_ROOT, name: str = "chroot", debug: bool = True, exit_: bool = True):
+        self.root = root
+        self.name = name
+        self.debug = debug
+        self.exit_ = exit_
+        self.results = []  # ChrootResult
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and any(r.code is None for r in self.results):
+            self.run()
+        return False
+
+    def add(self, cmd: str, label: str = None):
+        self.results.append(ChrootResult(cmd, label=label))
+        return self
+
+    def command(self) -> list:
+        return ["arch-chroot", self.root, "bash", "-s"]
+
+    def script(self) -> str:
+        lines = []
+        for i, r in enumerate(self.results):
+            # 每条命令在子shell中执行且stdin指向/dev/null, 避免吃掉后面的脚本内容;
+            # 标记前先换行, 命令输出没有以换行结尾时标记也能单独成行
+            lines.append(f"__t=$EPOCHREALTIME\n(\n{r.cmd}\n) </dev/null\n__c=$?\n"
+                         f"printf '\\n'; echo \"{self.MARK} {i} $__c $__t $EPOCHREALTIME\"\n[ $__c -eq 0 ] || exit $__c")
+        return "\n".join(lines) + "\n"
+
+    def run(self) -> list:
+        if self.debug:
+            for r in self.results:
+                print("{} {}".format(apply_cyan("[RUN]"), apply_yellow(f"({self.name}) {r.label}")))
+
+        output = []
+
+        def on_line(line: str) -> bool:
+            if not line.startswith(self.MARK):
+                output.append(line)
+                return False
+            _, i, code, t0, t1 = line.split()
+            r = self.results[int(i)]
+            r.code = int(code)
+            r.seconds = float(t1) - float(t0)
+            if output and output[-1] == "\n":
+                output.pop()  # 命令输出本来就以换行结尾时, 标记前补的换行会单独成一个空行
+            r.output = "".join(output)
+            output.clear()
+            tracer.add(r.label, "cmd", float(t0), r.seconds, {"exit": r.code})
+            return True
+
+        with chroot_lock(self.root):
+            start = time.monotonic()
+            with tracer.span(f"chroot {self.name}", "chroot"):
+                result = run_stream(self.command(), echo=self.debug, capture=False,
+                                    input_=self.script(), on_line=on_line)
+                code = result.code
+            total = time.monotonic() - start
+
+        commands = sum(r.seconds for r in self.results)
+        overhead = max(total - commands, 0)
+        if self.debug:
+            # 逐条arch-chroot时每条命令都要付一次挂载/卸载的开销
+            print("{} {}".format(apply_cyan("[CHROOT]"), apply_green(
+                f"{self.name}: {len(self.results)} cmds in {total:.2f}s, setup {overhead:.2f}s, "
+                f"saved ~{overhead * (len(self.results) - 1):.2f}s")))
+
+        failed = [r for r in self.results if r.code != 0]
+        if code != 0 or failed:
+            if not self.debug:
+                sys.stderr.write("".join(result.tail))
+            for r in failed:
+                state = "not run" if r.code is None else f"exit {r.code}"
+                print("{}".format(apply_red(f"RUN ERROR ({state}): {r.label}")))
+            if self.exit_:
+                sys.exit(code if code > 0 else 1)
+        return self.results
 
 
 def read_str(prompt: str) -> str:
@@ -141,6 +743,1621 @@ def choose_from_list(subject: str, items: list) -> object:
             return items[n]
 
 
+# =================================== mirror ranking ===================================
+
+class MirrorResult:
+    def __init__(self, server: str, latency: float = None, speed: float = None, error: str = None):
+        self.server = server
+        self.latency = latency  # 秒, 从发出请求到收到响应头
+        self.speed = speed  # 字节/秒
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> dict:
+        return {"server": self.server, "latency": self.latency, "speed": self.speed, "error": self.error}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(d["server"], d.get("latency"), d.get("speed"), d.get("error"))
+
+
+def read_mirrorlist_servers(path: str = MIRRORLIST) -> list:
+    """读取mirrorlist中已有的Server(包括注释掉的)"""
+    servers = []
+    if not os.path.exists(path):
+        return servers
+    with open(path) as f:
+        for line in f:
+            line = line.strip().lstrip("#").strip()
+            if line.startswith("Server") and "=" in line:
+                server = line.split("=", 1)[1].strip()
+                if server not in servers:
+                    servers.append(server)
+    return servers
+
+
+def mirror_candidates() -> list:
+    """内置镜像加上live环境mirrorlist里的镜像(改写过则读取备份)"""
+    servers = list(candidate_mirrors)
+    path = MIRRORLIST + ".bak" if os.path.exists(MIRRORLIST + ".bak") else MIRRORLIST
+    for s in read_mirrorlist_servers(path):
+        if s not in servers:
+            servers.append(s)
+    return servers
+
+
+def probe_mirror(server: str, timeout: float = 5, limit: int = MIRROR_PROBE_BYTES) -> MirrorResult:
+    """下载镜像中的core数据库, 测量延迟和吞吐"""
+    url = server.replace("$repo", "core").replace("$arch", "x86_64").rstrip("/") + "/" + MIRROR_PROBE_DB
+    try:
+        start = time.monotonic()
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            latency = time.monotonic() - start
+            received = 0
+            body_start = time.monotonic()
+            while received < limit:
+                chunk = resp.read(min(64 * 1024, limit - received))
+                if not chunk:
+                    break
+                received += len(chunk)
+            elapsed = max(time.monotonic() - body_start, 1e-6)
+    except Exception as e:
+        return MirrorResult(server, error=str(e))
+
+    if received == 0:
+        return MirrorResult(server, latency, error="empty response")
+    return MirrorResult(server, latency, received / elapsed)
+
+
+def load_mirror_cache(servers: list, path: str = MIRROR_CACHE, ttl: float = MIRROR_CACHE_TTL) -> list:
+    """读取未过期且候选列表一致的排名缓存, 没有则返回None"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - data.get("time", 0) > ttl or sorted(data.get("servers", [])) != sorted(servers):
+        return None
+    return [MirrorResult.from_dict(d) for d in data.get("results", [])]
+
+
+def save_mirror_cache(servers: list, results: list, path: str = MIRROR_CACHE):
+    try:
+        with open(path, "w") as f:
+            json.dump({"time": time.time(), "servers": servers, "results": [r.to_dict() for r in results]}, f)
+    except OSError:
+        pass
+
+
+def rank_mirrors(servers: list, workers: int = 8, timeout: float = 5, cache: str = MIRROR_CACHE,
+                 ttl: float = MIRROR_CACHE_TTL) -> list:
+    """并发测速, 按吞吐从高到低排序, 失败的镜像排在最后"""
+    if cache:
+        cached = load_mirror_cache(servers, cache, ttl)
+        if cached is not None:
+            return cached
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(servers)))) as pool:
+        results = list(pool.map(lambda s: probe_mirror(s, timeout), servers))
+
+    results.sort(key=lambda r: (not r.ok, -(r.speed or 0), r.latency or 0))
+    if cache:
+        save_mirror_cache(servers, results, cache)
+    return results
+
+
+def write_mirrorlist(results: list, path: str = MIRRORLIST, top: int = MIRROR_TOP):
+    """写入排名后的mirrorlist, 原文件备份为.bak"""
+    if os.path.exists(path) and not os.path.exists(path + ".bak"):
+        os.replace(path, path + ".bak")
+
+    lines = ["# Generated by install_v2.py, ranked by download speed\n"]
+    for r in [r for r in results if r.ok][:top]:
+        lines.append(f"# latency {r.latency * 1000:.0f}ms, speed {r.speed / 1024:.0f}KiB/s\n")
+        lines.append(f"Server = {r.server}\n")
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+# =================================== config edits =====================================
+
+def show_diff(path: str, old: str, new: str):
+    for line in difflib.unified_diff(old.splitlines(), new.splitlines(), path, path, n=0, lineterm=""):
+        if line.startswith(("---", "+++", "@@")):
+            continue
+        print(apply_green(line) if line.startswith("+") else apply_red(line))
+
+
+def edit_file(path: str, patch, mode: int = None) -> bool:
+    """patch(旧内容) -> 新内容, 文件不存在时旧内容为空; 内容没变不写, 变了就原子替换并打印diff"""
+    try:
+        with open(path) as f:
+            old = f.read()
+    except FileNotFoundError:
+        old = ""
+    new = patch(old)
+    if new == old:
+        return False
+
+    print("{} {}".format(apply_cyan("[EDIT]"), apply_yellow(path)))
+    show_diff(path, old, new)
+    get_logger().info(f"[EDIT] {path}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(new)
+    if mode is not None:
+        os.chmod(tmp, mode)
+    elif os.path.exists(path):
+        os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+    os.replace(tmp, path)
+    return True
+
+
+def replace_with(content: str):
+    """整个文件替换为固定内容的patch"""
+    return lambda _: content
+
+
+def uncomment(text: str, lines: list) -> str:
+    """把'#xxx'形式的注释行改为'xxx', 用于locale.gen这类文件; 已经生效的行不变,
+    '#  xxx'这种带缩进的说明示例不算"""
+    out = []
+    for line in text.splitlines():
+        if line.startswith("#") and line[1:].rstrip() in lines:
+            line = line[1:].rstrip()
+        out.append(line)
+    return "\n".join(out) + "\n"
+
+
+def prepend_lines(text: str, lines: list) -> str:
+    """在文件开头加上还没有的行"""
+    existing = set(text.splitlines())
+    missing = [line for line in lines if line not in existing]
+    return "".join(f"{line}\n" for line in missing) + text
+
+
+# =================================== pacman tuning ====================================
+
+def parallel_downloads_for(mirrors: list) -> int:
+    """根据单连接测速结果估算需要多少并发才能跑满带宽"""
+    speeds = [r.speed for r in mirrors if r.ok and r.speed]
+    if len(speeds) == 0:
+        return PARALLEL_DOWNLOADS_DEFAULT
+    n = math.ceil(PARALLEL_DOWNLOADS_TARGET_SPEED / max(speeds))
+    return max(3, min(n, 12))
+
+
+def tune_pacman_conf(text: str, parallel: int, cache_dirs: list, mirrorlist: str = None) -> str:
+    """改写pacman.conf: 设置ParallelDownloads和CacheDir, 可选替换仓库的mirrorlist"""
+    out = []
+    section = None
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            section = stripped[1:-1]
+            out.append(line)
+            if section == "options":
+                if parallel:
+                    out.append(f"ParallelDownloads = {parallel}")
+                out.extend(f"CacheDir = {d.rstrip('/')}/" for d in cache_dirs)
+            continue
+        key = stripped.lstrip("#").split("=", 1)[0].strip()
+        if section == "options" and key == "CacheDir":
+            continue
+        if section == "options" and key == "ParallelDownloads" and parallel:
+            continue
+        if mirrorlist and not stripped.startswith("#") and key == "Include" and stripped.endswith(MIRRORLIST):
+            line = f"Include = {mirrorlist}"
+        out.append(line)
+    return "\n".join(out) + "\n"
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DownloadStat:
+    def __init__(self, group: str, packages: int, size: int, seconds: float):
+        self.group = group
+        self.packages = packages
+        self.size = size  # 字节
+        self.seconds = seconds
+
+    @property
+    def speed(self) -> float:
+        return self.size / self.seconds if self.seconds > 0 else 0
+
+
+# =================================== package cache ====================================
+
+def strip_pkg_ext(filename: str) -> str:
+    for ext in PKG_EXTS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return None
+
+
+def read_local_db(root: str = MOUNT_ROOT) -> list:
+    """读取目标系统已安装的软件包, 返回 name-version-arch 列表"""
+    local = os.path.join(root, "var/lib/pacman/local")
+    packages = []
+    if not os.path.isdir(local):
+        return packages
+    for entry in sorted(os.listdir(local)):
+        desc = os.path.join(local, entry, "desc")
+        if not os.path.exists(desc):
+            continue
+        fields = {}
+        key = None
+        with open(desc) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("%") and line.endswith("%"):
+                    key = line[1:-1]
+                elif line and key and key not in fields:
+                    fields[key] = line
+        if "NAME" in fields and "VERSION" in fields:
+            packages.append(f"{fields['NAME']}-{fields['VERSION']}-{fields.get('ARCH', 'any')}")
+    return packages
+
+
+class CacheStat:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0  # 字节
+        self.lock = threading.Lock()
+
+    def add(self, hit: bool, size: int = 0):
+        with self.lock:
+            if hit:
+                self.hits += 1
+                self.saved += size
+            else:
+                self.misses += 1
+
+
+class PackageCache:
+    """局域网包缓存: 本地目录作为CacheDir, HTTP服务作为优先级最高的Server, 未命中时回落到上游镜像"""
+
+    def __init__(self, source: str):
+        self.source = source.rstrip("/")
+        self.remote = self.source.startswith(("http://", "https://"))
+        self.available = {}  # name-version-arch -> 文件大小(未知为None)
+        self.stat = CacheStat()
+
+    @property
+    def templated(self) -> bool:
+        """pacoloco这类按仓库分路径的代理, 无法列目录"""
+        return "$repo" in self.source
+
+    def server(self) -> str:
+        return self.source
+
+    def scan(self):
+        """安装前记录缓存里已有的包"""
+        self.available = {}
+        if not self.remote:
+            if os.path.isdir(self.source):
+                for name in os.listdir(self.source):
+                    key = strip_pkg_ext(name)
+                    if key:
+                        self.available[key] = os.path.getsize(os.path.join(self.source, name))
+            return
+        if self.templated:
+            return
+        try:
+            with urllib.request.urlopen(self.source + "/", timeout=10) as resp:
+                index = resp.read().decode(errors="ignore")
+        except Exception as e:
+            print("{}".format(apply_red(f"can't list package cache {self.source}: {e}")))
+            return
+        for href in re.findall(r'href="([^"?/]+)"', index):
+            key = strip_pkg_ext(urllib.request.unquote(href))
+            if key:
+                self.available[key] = None
+
+    def _remote_size(self, key: str) -> int:
+        for ext in PKG_EXTS:
+            req = urllib.request.Request(f"{self.source}/{key}{ext}", method="HEAD")
+            try:
+                with urllib.request.urlopen(req, timeout=10) as resp:
+                    return int(resp.headers.get("Content-Length", 0))
+            except Exception:
+                continue
+        return 0
+
+    def account(self, installed: list):
+        """按已安装的包统计命中/未命中"""
+        for pkg in installed:
+            if pkg in self.available:
+                size = self.available[pkg]
+                self.stat.add(True, size if size is not None else self._remote_size(pkg))
+            else:
+                self.stat.add(False)
+
+    def print_stat(self):
+        if self.templated:
+            print("{}: {}".format(apply_blue("CACHE"), apply_yellow("hit/miss unavailable for templated proxy")))
+            return
+        print("{}: {}".format(apply_blue("CACHE"), apply_green(
+            f"{self.stat.hits} hits, {self.stat.misses} misses, {self.stat.saved / 1024 / 1024:.1f}MiB saved")))
+
+
+class CacheRequestHandler(http.server.SimpleHTTPRequestHandler):
+    stat = CacheStat()
+
+    def send_head(self):
+        """只统计GET下载, PackageCache探测包大小时的HEAD请求不算"""
+        f = super().send_head()
+        if self.command == "GET" and strip_pkg_ext(os.path.basename(self.path)):
+            path = self.translate_path(self.path)
+            self.stat.add(f is not None, os.path.getsize(path) if f is not None else 0)
+        return f
+
+
+def serve_cache(directory: str, port: int = CACHE_SERVE_PORT):
+    """把本地目录作为局域网包缓存提供给其他机器, 缺失的包返回404由pacman回落到上游"""
+    handler = functools.partial(CacheRequestHandler, directory=directory)
+    with http.server.ThreadingHTTPServer(("", port), handler) as httpd:
+        print("{} {}".format(apply_cyan("[SERVE]"), apply_yellow(f"{directory} on port {port}")))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    st = CacheRequestHandler.stat
+    print("{}: {}".format(apply_blue("CACHE"), apply_green(
+        f"{st.hits} hits, {st.misses} misses, {st.saved / 1024 / 1024:.1f}MiB served")))
+
+
+# =================================== package resolver =================================
+
+def dep_name(dep: str) -> str:
+    """去掉依赖里的版本约束和描述, 例如 'glibc>=2.35' -> 'glibc'"""
+    return re.split(r"[<>=:]", dep, 1)[0].strip()
+
+
+class SyncPackage:
+    def __init__(self, repo: str, fields: dict):
+        self.repo = repo
+        self.name = fields["NAME"][0]
+        self.version = fields.get("VERSION", [""])[0]
+        self.csize = int(fields.get("CSIZE", ["0"])[0])  # 下载大小
+        self.isize = int(fields.get("ISIZE", ["0"])[0])  # 安装大小
+        self.depends = [dep_name(d) for d in fields.get("DEPENDS", [])]
+        self.provides = [dep_name(d) for d in fields.get("PROVIDES", [])]
+        self.groups = fields.get("GROUPS", [])
+
+
+def parse_desc(text: str) -> dict:
+    fields = {}
+    key = None
+    for line in text.splitlines():
+        if line.startswith("%") and line.endswith("%"):
+            key = line[1:-1]
+            fields[key] = []
+        elif line and key:
+            fields[key].append(line)
+    return fields
+
+
+def sync_db_files(db_dir: str = SYNC_DB_DIR) -> list:
+    """按pacman.conf中的仓库顺序返回同步数据库, 靠前的仓库优先"""
+    repos = []
+    if os.path.exists(PACMAN_CONF):
+        with open(PACMAN_CONF) as f:
+            for line in f:
+                m = re.match(r"^\[(.+)\]", line.strip())
+                if m and m.group(1) != "options":
+                    repos.append(m.group(1))
+    files = [os.path.join(db_dir, f"{r}.db") for r in repos if os.path.exists(os.path.join(db_dir, f"{r}.db"))]
+    if len(files) == 0 and os.path.isdir(db_dir):
+        files = [os.path.join(db_dir, f) for f in sorted(os.listdir(db_dir)) if f.endswith(".db")]
+    return files
+
+
+class Resolution:
+    def __init__(self, packages: list = None, download: int = 0, installed: int = 0, unknown: list = None,
+                 explicit: list = None):
+        self.packages = packages or []
+        self.download = download  # 字节
+        self.installed = installed  # 字节
+        self.unknown = unknown or []
+        # 直接要求安装的包和展开后的组成员; packages里的虚拟依赖只是猜的第一个提供者, pacman可能选了别的
+        self.explicit = explicit or []
+
+    def to_dict(self) -> dict:
+        return {"packages": self.packages, "download": self.download, "installed": self.installed,
+                "unknown": self.unknown, "explicit": self.explicit}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(d["packages"], d["download"], d["installed"], d["unknown"], d["explicit"])
+
+
+class Resolver:
+    """直接读取同步数据库, 展开软件包组并计算完整的依赖闭包"""
+
+    def __init__(self, db_files: list):
+        self.packages = {}  # name -> SyncPackage
+        self.providers = {}  # 虚拟包名 -> [name]
+        self.groups = {}  # 组名 -> [name]
+        for path in db_files:
+            self._load(path)
+
+    def _load(self, path: str):
+        repo = os.path.basename(path)[:-len(".db")]
+        try:
+            db = tarfile.open(path, "r:*")
+        except tarfile.TarError as e:
+            print("{}".format(apply_red(f"can't read sync db {path}: {e}")))
+            return
+        with db:
+            for member in db:
+                if not member.isfile() or not member.name.endswith("/desc"):
+                    continue
+                fields = parse_desc(db.extractfile(member).read().decode())
+                if "NAME" not in fields:
+                    continue
+                pkg = SyncPackage(repo, fields)
+                if pkg.name in self.packages:  # 前面仓库的同名包优先
+                    continue
+                self.packages[pkg.name] = pkg
+                for p in pkg.provides:
+                    self.providers.setdefault(p, []).append(pkg.name)
+                for g in pkg.groups:
+                    self.groups.setdefault(g, []).append(pkg.name)
+
+    def find(self, name: str) -> str:
+        if name in self.packages:
+            return name
+        providers = self.providers.get(name)
+        return providers[0] if providers else None
+
+    def resolve(self, names: list) -> Resolution:
+        queue = []
+        unknown = []
+        explicit = []
+        for entry in names:
+            for name in entry.split():
+                if name in self.packages:
+                    queue.append(name)
+                    explicit.append(name)
+                elif name in self.groups:
+                    queue.extend(sorted(self.groups[name]))
+                    explicit.extend(sorted(self.groups[name]))
+                elif self.find(name):
+                    queue.append(self.find(name))
+                else:
+                    unknown.append(name)
+
+        explicit = list(dict.fromkeys(explicit))
+        seen = set()
+        order = []
+        while queue:
+            name = queue.pop(0)
+            if name in seen:
+                continue
+            seen.add(name)
+            order.append(name)
+            for dep in self.packages[name].depends:
+                found = self.find(dep)
+                if found is None:
+                    unknown.append(dep)
+                elif found not in seen:
+                    queue.append(found)
+
+        return Resolution(order, sum(self.packages[n].csize for n in order),
+                          sum(self.packages[n].isize for n in order), unknown, explicit)
+
+
+def resolve_packages(names: list, db_dir: str = SYNC_DB_DIR, cache: str = RESOLVE_CACHE) -> Resolution:
+    """解析结果按(软件包列表, 数据库修改时间)缓存, 数据库没更新就不用重新解析"""
+    db_files = sync_db_files(db_dir)
+    key_src = json.dumps([sorted(names), [(f, os.path.getmtime(f)) for f in db_files]])
+    key = hashlib.sha256(key_src.encode()).hexdigest()
+    try:
+        with open(cache) as f:
+            data = json.load(f)
+        if data.get("key") == key:
+            return Resolution.from_dict(data["result"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    result = Resolver(db_files).resolve(names)
+    try:
+        with open(cache, "w") as f:
+            json.dump({"key": key, "result": result.to_dict()}, f)
+    except OSError:
+        pass
+    return result
+
+
+# =================================== hardware inventory ===============================
+
+class CpuInfo:
+    def __init__(self, vendor: str = None, model: str = None, threads: int = 0, flags: list = None):
+        self.vendor = vendor
+        self.model = model
+        self.threads = threads
+        self.flags = flags or []
+
+
+class BlockDevice:
+    def __init__(self, name: str, size: int, rotational: bool, removable: bool, model: str, discard: bool):
+        self.name = name
+        self.size = size  # 字节
+        self.rotational = rotational
+        self.removable = removable
+        self.model = model
+        self.discard = discard  # 是否支持TRIM
+
+    @property
+    def path(self) -> str:
+        return f"/dev/{self.name}"
+
+    @property
+    def kind(self) -> str:
+        if self.name.startswith("nvme"):
+            return "nvme"
+        return "hdd" if self.rotational else "ssd"
+
+    def describe(self) -> str:
+        flags = " removable" if self.removable else ""
+        return f"{self.path} ({self.size / 1024 ** 3:.1f}G {self.kind} {self.model or 'unknown'}{flags})"
+
+
+class PciDevice:
+    def __init__(self, slot: str, cls: int, vendor: int, device: int):
+        self.slot = slot  # 0000:01:00.0
+        self.cls = cls  # 0x030000, 高8位0x03为显示控制器
+        self.vendor = vendor
+        self.device = device
+
+    def describe(self) -> str:
+        return f"{self.slot} [{self.vendor:04x}:{self.device:04x}]"
+
+
+class Hardware:
+    def __init__(self, cpu: CpuInfo, disks: list, uefi: bool, memory: int, gpus: list = None):
+        self.cpu = cpu
+        self.disks = disks  # BlockDevice
+        self.uefi = uefi
+        self.memory = memory  # 字节
+        self.gpus = gpus or []  # PciDevice
+
+
+def _read(root: str, path: str, default: str = "") -> str:
+    try:
+        with open(os.path.join(root, path.lstrip("/"))) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def probe_cpu(root: str = SYS_ROOT) -> CpuInfo:
+    cpu = CpuInfo()
+    for line in _read(root, "/proc/cpuinfo").splitlines():
+        if ":" not in line:
+            continue
+        key, value = (x.strip() for x in line.split(":", 1))
+        if key == "processor":
+            cpu.threads += 1
+        elif key == "vendor_id" and cpu.vendor is None:
+            cpu.vendor = value
+        elif key == "model name" and cpu.model is None:
+            cpu.model = value
+        elif key == "flags" and not cpu.flags:
+            cpu.flags = value.split()
+    return cpu
+
+
+def probe_disks(root: str = SYS_ROOT) -> list:
+    """/sys/block下的物理磁盘, 过滤掉loop/ram/光驱/zram等"""
+    disks = []
+    block = os.path.join(root, "sys/block")
+    if not os.path.isdir(block):
+        return disks
+    for name in sorted(os.listdir(block)):
+        if name.startswith(("loop", "ram", "sr", "zram", "fd", "dm-", "md")):
+            continue
+        base = f"/sys/block/{name}"
+        size = int(_read(root, f"{base}/size", "0") or 0) * 512  # 固定按512字节扇区计
+        if size == 0:
+            continue
+        disks.append(BlockDevice(
+            name, size,
+            rotational=_read(root, f"{base}/queue/rotational", "0") == "1",
+            removable=_read(root, f"{base}/removable", "0") == "1",
+            model=_read(root, f"{base}/device/model") or None,
+            discard=int(_read(root, f"{base}/queue/discard_max_bytes", "0") or 0) > 0,
+        ))
+    return disks
+
+
+def probe_memory(root: str = SYS_ROOT) -> int:
+    for line in _read(root, "/proc/meminfo").splitlines():
+        if line.startswith("MemTotal:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def probe_gpus(root: str = SYS_ROOT) -> list:
+    """/sys/bus/pci/devices下class为0x03xxxx(VGA/3D/显示控制器)的设备"""
+    gpus = []
+    devices = os.path.join(root, "sys/bus/pci/devices")
+    if not os.path.isdir(devices):
+        return gpus
+    for slot in sorted(os.listdir(devices)):
+        base = f"/sys/bus/pci/devices/{slot}"
+        try:
+            cls = int(_read(root, f"{base}/class", "0"), 16)
+            vendor = int(_read(root, f"{base}/vendor", "0"), 16)
+            device = int(_read(root, f"{base}/device", "0"), 16)
+        except ValueError:
+            continue
+        if cls >> 16 == 0x03:
+            gpus.append(PciDevice(slot, cls, vendor, device))
+    return gpus
+
+
+def probe_storage_modules(disk: str, root: str = SYS_ROOT) -> list:
+    """从磁盘沿sysfs设备路径往上找驱动模块(控制器在前), 例如nvme0n1 -> [nvme], sda -> [ahci, sd_mod];
+    编进内核的驱动没有module链接, 不需要也不会出现"""
+    modules = []
+    path = os.path.realpath(os.path.join(root, f"sys/block/{disk}/device"))
+    top = os.path.realpath(os.path.join(root, "sys/devices"))
+    while path.startswith(top + os.sep):
+        module = os.path.join(path, "driver", "module")
+        if os.path.exists(module):
+            name = os.path.basename(os.path.realpath(module))
+            if name not in modules:
+                modules.insert(0, name)
+        path = os.path.dirname(path)
+    return modules
+
+
+def hostonly_modules(disk: str, fs: str, root: str = SYS_ROOT) -> list:
+    """host-only initramfs的MODULES; 找不到存储驱动时(loop设备/稀疏镜像文件, 驱动编进内核)返回空列表,
+    这时保留通用的block/filesystems钩子, 否则initramfs里没有能挂载根分区的驱动"""
+    storage = probe_storage_modules(disk, root)
+    return storage + [fs] if storage else []
+
+
+_hardware = {}
+
+
+def hardware(root: str = SYS_ROOT) -> Hardware:
+    """探测一次, 整个运行期间复用"""
+    if root not in _hardware:
+        _hardware[root] = Hardware(probe_cpu(root), probe_disks(root),
+                                   os.path.exists(os.path.join(root, "sys/firmware/efi/efivars")),
+                                   probe_memory(root), probe_gpus(root))
+    return _hardware[root]
+
+
+def parse_size(s: str) -> int:
+    """'512M' / '200G' / '1T' -> 字节"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    s = s.strip().upper().rstrip("B").rstrip("I")
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def select_disks(disks: list, spec: str) -> list:
+    """按规则筛选磁盘, 规则用逗号分隔, 例如:
+    /dev/sda | auto | nvme,largest | ssd,min=200G | model=Samsung*,smallest
+    """
+    picked = list(disks)
+    for token in [t.strip() for t in spec.split(",") if t.strip()]:
+        if token.startswith("/dev/"):
+            picked = [d for d in picked if d.path == token]
+        elif token == "auto":
+            continue
+        elif token in ("nvme", "ssd", "hdd"):
+            picked = [d for d in picked if d.kind == token]
+        elif token.startswith("model="):
+            picked = [d for d in picked if fnmatch.fnmatch(d.model or "", token[len("model="):])]
+        elif token.startswith("min="):
+            picked = [d for d in picked if d.size >= parse_size(token[len("min="):])]
+        elif token.startswith("max="):
+            picked = [d for d in picked if d.size <= parse_size(token[len("max="):])]
+        elif token in ("largest", "smallest"):
+            picked = sorted(picked, key=lambda d: d.size, reverse=token == "largest")[:1]
+        elif token == "fixed":
+            picked = [d for d in picked if not d.removable]
+        else:
+            raise ValueError(f"unknown disk selector {token}")
+    return picked
+
+
+# =================================== gpu drivers ======================================
+
+# 厂商ID 设备ID范围 驱动 软件包; 同一厂商按顺序匹配第一条, *表示该厂商的所有设备
+# nvidia的包名后面带+dkms表示非默认内核(linux-lts/linux-zen)时换成-dkms版本并装上对应的headers
+GPU_DRIVER_TABLE = """
+10de 1e00-ffff nvidia-open     nvidia-open+dkms nvidia-utils libva-nvidia-driver
+10de *         nouveau         mesa vulkan-nouveau
+1002 *         amdgpu          mesa vulkan-radeon xf86-video-amdgpu
+8086 0100-0fff i915-legacy     mesa vulkan-intel libva-intel-driver
+8086 *         i915            mesa vulkan-intel intel-media-driver
+1af4 *         virtio-gpu      mesa
+15ad *         vmwgfx          mesa xf86-video-vmware
+80ee *         vboxvideo       mesa virtualbox-guest-utils
+1234 *         bochs           mesa
+"""
+
+
+class GpuDriver:
+    def __init__(self, vendor: int, first: int, last: int, name: str, packages: list):
+        self.vendor = vendor
+        self.first = first
+        self.last = last
+        self.name = name
+        self.packages = packages
+
+    def match(self, device: int) -> bool:
+        return self.first <= device <= self.last
+
+    def packages_for(self, kernel: str = "linux") -> list:
+        pkgs = []
+        for p in self.packages:
+            if p.endswith("+dkms"):
+                p = p[:-len("+dkms")]
+                pkgs += [p] if kernel == "linux" else [f"{p}-dkms", f"{kernel}-headers"]
+            else:
+                pkgs.append(p)
+        return pkgs
+
+
+_gpu_drivers = {}  # 厂商ID -> [GpuDriver], 第一次用到时才解析GPU_DRIVER_TABLE
+
+
+def gpu_drivers(vendor: int) -> list:
+    if not _gpu_drivers:
+        for line in GPU_DRIVER_TABLE.strip().splitlines():
+            vendor_id, devices, name, *packages = line.split()
+            first, last = (0, 0xffff) if devices == "*" else (int(x, 16) for x in devices.split("-"))
+            _gpu_drivers.setdefault(int(vendor_id, 16), []).append(GpuDriver(int(vendor_id, 16), first, last, name,
+                                                                             packages))
+    return _gpu_drivers.get(vendor, [])
+
+
+def resolve_gpu_drivers(gpus: list, kernel: str = "linux") -> tuple:
+    """返回 ([(PciDevice, GpuDriver或None)], 软件包); 独显和核显同时存在且有nvidia时加上nvidia-prime"""
+    matched, packages = [], []
+    for gpu in gpus:
+        driver = next((d for d in gpu_drivers(gpu.vendor) if d.match(gpu.device)), None)
+        matched.append((gpu, driver))
+        if driver is not None:
+            packages += [p for p in driver.packages_for(kernel) if p not in packages]
+    if len(gpus) > 1 and any(d is not None and d.name == "nvidia-open" for _, d in matched):
+        packages.append("nvidia-prime")
+    return matched, packages
+
+
+# =================================== disk layout ======================================
+
+ESP = "esp"
+BOOT = "boot"
+SWAP = "swap"
+ROOT = "root"
+HOME = "home"
+BIOS_BOOT = "bios_boot"  # BIOS启动的GPT磁盘上给grub core.img用的无文件系统分区
+
+support_roles = [ESP, BOOT, SWAP, ROOT, HOME, BIOS_BOOT]
+sfdisk_types = {ESP: "U", BOOT: "L", SWAP: "S", ROOT: "L", HOME: "L",  # sfdisk的通用类型别名, gpt和dos都适用
+                BIOS_BOOT: "21686148-6449-6E6F-744E-656564454649"}  # 没有别名, 只用于gpt
+
+
+def partition_path(disk: str, number: int) -> str:
+    """/dev/sda -> /dev/sda1, /dev/nvme0n1 -> /dev/nvme0n1p1, /dev/mmcblk0 -> /dev/mmcblk0p1"""
+    return f"{disk}p{number}" if disk[-1].isdigit() else f"{disk}{number}"
+
+
+def is_block_device(path: str) -> bool:
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def device_size(path: str) -> int:
+    """块设备或者镜像文件的大小, 字节"""
+    with open(path, "rb") as f:
+        return f.seek(0, os.SEEK_END)
+
+
+class Partition:
+    def __init__(self, role: str, size: str = None):
+        self.role = role
+        if isinstance(size, (int, float)) and not isinstance(size, bool):
+            size = f"{size}M"  # 配置里直接写数字按MiB算
+        self.size = size  # '512M' / '8G' / '25%', None表示剩余全部空间
+        self.number = None
+        self.device = None
+
+    def size_mib(self, disk_size: int) -> int:
+        if self.size is None:
+            return None
+        if str(self.size).endswith("%"):
+            return int(disk_size * float(self.size[:-1]) / 100 / 1024 ** 2)
+        return parse_size(str(self.size)) // 1024 ** 2
+
+
+class DiskLayout:
+    """声明式分区: 一次生成完整的sfdisk脚本, 一条命令写入分区表"""
+
+    def __init__(self, disk: str, label: str, partitions: list):
+        self.disk = disk
+        self.label = label  # gpt / dos
+        self.partitions = partitions
+        for i, p in enumerate(self.partitions):
+            p.number = i + 1
+            p.device = partition_path(disk, p.number)
+
+    def part(self, role: str) -> Partition:
+        for p in self.partitions:
+            if p.role == role:
+                return p
+        return None
+
+    def validate(self, boot: str = None) -> list:
+        """boot为UEFI/BIOS时同时检查引导需要的分区"""
+        errors = []
+        roles = [p.role for p in self.partitions]
+        for r in roles:
+            if r not in support_roles:
+                errors.append(f"unknown partition role {r}")
+        if roles.count(ROOT) != 1:
+            errors.append("layout needs exactly one root partition")
+        if boot == UEFI and ESP not in roles:
+            errors.append("UEFI boot needs an esp partition")
+        if boot == BIOS and self.label == "gpt" and BIOS_BOOT not in roles:
+            errors.append("BIOS boot from a GPT disk needs a bios_boot partition")
+        if self.label == "dos" and BIOS_BOOT in roles:
+            errors.append("bios_boot partition only works on GPT")
+        for p in self.partitions:
+            if p.size is None or str(p.size).endswith("%"):
+                continue
+            try:
+                if p.size_mib(0) < 1:
+                    errors.append(f"{p.role} partition size {p.size} is smaller than 1MiB")
+            except ValueError:
+                errors.append(f"{p.role} partition has invalid size {p.size}")
+        if any(p.size is None for p in self.partitions[:-1]):
+            errors.append("only the last partition may take the rest of the disk")
+        percent = sum(float(p.size[:-1]) for p in self.partitions if p.size and str(p.size).endswith("%"))
+        if percent > 100:
+            errors.append(f"partitions take {percent}% of the disk")
+        return errors
+
+    def script(self, disk_size: int) -> str:
+        lines = [f"label: {self.label}", ""]
+        for p in self.partitions:
+            fields = []
+            mib = p.size_mib(disk_size)
+            if mib is not None:
+                fields.append(f"size={mib}MiB")
+            fields.append(f"type={sfdisk_types[p.role]}")
+            if self.label == "dos" and p.role == BOOT:
+                fields.append("bootable")
+            lines.append(", ".join(fields))
+        return "\n".join(lines) + "\n"
+
+    def apply(self, script_path: str = None) -> list:
+        """清除旧的分区签名并写入新分区表, 返回分区列表(带设备名)"""
+        script_path = script_path or f"/tmp/archinstall-{os.path.basename(self.disk)}.sfdisk"
+        with open(script_path, "w") as f:
+            f.write(self.script(device_size(self.disk)))
+        run_cmd(f"sfdisk --wipe always --wipe-partitions always {self.disk} < {script_path}")
+        self.wait_partitions()
+        return self.partitions
+
+    def wait_partitions(self, timeout: float = PARTITION_WAIT):
+        """sfdisk返回时udev可能还没创建分区设备节点, 直接mkfs会偶尔找不到设备;
+        等udev处理完, 节点还没出现就让内核重新读一次分区表"""
+        run_cmd("udevadm settle", exit_=False)
+        deadline = time.monotonic() + timeout
+        reread = False
+        while True:
+            missing = [p.device for p in self.partitions if not is_block_device(p.device)]
+            if not missing:
+                return
+            if time.monotonic() > deadline:
+                print("{}".format(apply_red(f"partition devices did not appear: {' '.join(missing)}")))
+                sys.exit(1)
+            if not reread and time.monotonic() > deadline - timeout / 2:
+                reread = True
+                run_cmd(f"blockdev --rereadpt {self.disk}", exit_=False)
+                run_cmd("udevadm settle", exit_=False)
+            time.sleep(0.2)
+
+
+class FsProfile:
+    def __init__(self, name: str, mkfs: str, options: str, packages: list = None, subvolumes: dict = None):
+        self.name = name
+        self.mkfs = mkfs
+        self.options = options  # 挂载参数, 同时写入fstab
+        self.packages = packages or []
+        self.subvolumes = subvolumes or {}  # btrfs子卷 -> 挂载点(相对目标根目录)
+
+    def mount_options(self, disk: BlockDevice = None) -> str:
+        opts = self.options
+        if self.name == "btrfs" and disk is not None and disk.discard and not disk.rotational:
+            opts += ",ssd,discard=async"
+        return opts
+
+
+fs_profiles = {
+    "ext4": FsProfile("ext4", "mkfs.ext4 -F", "noatime"),
+    "btrfs": FsProfile("btrfs", "mkfs.btrfs -f", "noatime,compress=zstd:1,space_cache=v2", ["btrfs-progs"],
+                       {"@": "/", "@home": "/home", "@var_cache": "/var/cache"}),
+    "xfs": FsProfile("xfs", "mkfs.xfs -f", "noatime", ["xfsprogs"]),
+    "f2fs": FsProfile("f2fs", "mkfs.f2fs -f -O extra_attr,inode_checksum,sb_checksum,compression",
+                      "noatime,compress_algorithm=zstd,compress_chksum", ["f2fs-tools"]),
+}
+support_filesystems = ["auto"] + list(fs_profiles)
+
+
+def choose_filesystem(disk: BlockDevice, grub_root: bool = False) -> str:
+    """SD卡/U盘这类可移动闪存用f2fs, NVMe/SSD用btrfs, 机械盘用ext4;
+    grub_root: GRUB要从根分区读/boot, 它读不了带extra_attr/compression特性的f2fs, 这时闪存也用ext4"""
+    if disk is None:
+        return "ext4"
+    if disk.removable and not disk.rotational:
+        return "ext4" if grub_root else "f2fs"
+    return "ext4" if disk.rotational else "btrfs"
+
+
+def grub_reads_root(bootloader: str, boot: str, layout: list = None) -> bool:
+    """用GRUB且没有单独的/boot分区时, 内核和initramfs要由GRUB从根文件系统读取"""
+    return bootloader == BOOT_GRUB and default_layout("/dev/x", boot, 0, layout).part(BOOT) is None
+
+
+def find_disk(path: str) -> BlockDevice:
+    for d in hardware().disks:
+        if d.path == path:
+            return d
+    return None
+
+
+# =================================== memory / swap ====================================
+
+SWAP_ZRAM = "zram"
+SWAP_FILE = "file"
+SWAP_PARTITION = "partition"
+SWAP_NONE = "none"
+
+support_swap_modes = ["auto", SWAP_ZRAM, SWAP_FILE, SWAP_PARTITION, SWAP_NONE]
+
+
+def default_swap(memory: int, disk_size: int, hibernate: bool) -> tuple:
+    """按内存和磁盘大小决定swap方式和大小(G):
+    需要休眠时swap必须能放下整个内存, 用swapfile; 否则用zram, 不占磁盘"""
+    mem_g = max(1, math.ceil(memory / 1024 ** 3))
+    if hibernate:
+        if disk_size and mem_g * 1024 ** 3 > disk_size / 4:
+            return SWAP_NONE, 0  # 磁盘太小, 放不下休眠用的swap
+        return SWAP_FILE, mem_g
+    return SWAP_ZRAM, max(1, min(mem_g // 2, 8))
+
+
+def zram_generator_conf(size_g: int) -> str:
+    return f"[zram0]\nzram-size = {size_g * 1024}\ncompression-algorithm = zstd\n"
+
+
+# zram比磁盘swap快得多, 内核应该更积极地使用它
+zram_sysctl = "vm.swappiness = 180\nvm.watermark_boost_factor = 0\nvm.watermark_scale_factor = 125\nvm.page-cluster = 0\n"
+
+
+def add_resume_hook(conf: str) -> str:
+    """在mkinitcpio.conf的HOOKS里filesystems后面加上resume, 使用systemd钩子时不需要"""
+    lines = []
+    for line in conf.splitlines():
+        m = re.match(r"^HOOKS=\((.*)\)", line)
+        if m:
+            hooks = m.group(1).split()
+            if "systemd" not in hooks and "resume" not in hooks:
+                idx = hooks.index("filesystems") + 1 if "filesystems" in hooks else len(hooks)
+                hooks.insert(idx, "resume")
+                line = f"HOOKS=({' '.join(hooks)})"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def add_kernel_params(grub_default: str, params: list) -> str:
+    """往/etc/default/grub的GRUB_CMDLINE_LINUX_DEFAULT追加内核参数"""
+    lines = []
+    for line in grub_default.splitlines():
+        m = re.match(r'^GRUB_CMDLINE_LINUX_DEFAULT="(.*)"', line)
+        if m:
+            old = [p for p in m.group(1).split() if p.split("=")[0] not in [x.split("=")[0] for x in params]]
+            line = f'GRUB_CMDLINE_LINUX_DEFAULT="{" ".join(old + params)}"'
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def default_layout(disk: str, boot: str, swap_size: int, spec: list = None) -> DiskLayout:
+    """spec为配置文件中的layout: [{"role": "esp", "size": "512M"}, ...], 没有则用默认布局"""
+    if spec:
+        parts = [Partition(p["role"], p.get("size")) for p in spec]
+    else:
+        parts = [Partition(ESP if boot == UEFI else BOOT, "512M")]
+        if swap_size:
+            parts.append(Partition(SWAP, f"{swap_size}G"))
+        parts.append(Partition(ROOT))
+    label = "gpt" if boot == UEFI or any(p.role == BIOS_BOOT for p in parts) else "dos"
+    return DiskLayout(disk, label, parts)
+
+
+# =================================== bootloader =======================================
+
+BOOT_GRUB = "grub"
+BOOT_SYSTEMD = "systemd-boot"
+BOOT_UKI = "uki"
+
+
+class Bootloader:
+    def __init__(self, name: str, packages: list, esp: str, install: str, params_file: str, check: str,
+                 uefi_only: bool = False):
+        self.name = name
+        self.packages = packages
+        self.esp = esp  # ESP挂载点(相对目标根目录)
+        self.install = install  # Installation上执行安装的方法名
+        self.params_file = params_file  # 内核参数写在哪(相对目标根目录)
+        self.check = check  # 安装完成后一定存在的文件, 断点续装时检查
+        self.uefi_only = uefi_only
+
+
+# systemd-boot只能读ESP, 所以把ESP直接挂在/boot, 内核和initramfs都放在上面;
+# UKI把内核/initramfs/命令行打包成一个EFI程序, systemd-boot自动发现, 不需要写启动项
+bootloaders = {
+    BOOT_GRUB: Bootloader(BOOT_GRUB, ["grub"], "boot/EFI", "install_grub", "etc/default/grub",
+                          "boot/grub/grub.cfg"),
+    BOOT_SYSTEMD: Bootloader(BOOT_SYSTEMD, [], "boot", "install_systemd_boot", "etc/kernel/cmdline",
+                             "boot/loader/loader.conf", True),
+    BOOT_UKI: Bootloader(BOOT_UKI, [], "boot", "install_uki", "etc/kernel/cmdline", "boot/loader/loader.conf", True),
+}
+support_bootloaders = list(bootloaders)
+
+BOOT_TIME_FILE = "/var/lib/archinstall/boot-time.txt"
+BOOT_TIME_UNIT = "archinstall-boot-time"
+BOOT_TIME_DELAY = "2min"  # 开机后等一会再读, 这时systemd-analyze已经能给出完整结果
+
+
+def add_cmdline_params(cmdline: str, params: list) -> str:
+    """往/etc/kernel/cmdline追加内核参数, 同名参数被替换"""
+    keys = [p.split("=")[0] for p in params]
+    old = [p for p in cmdline.split() if p.split("=")[0] not in keys]
+    return " ".join(old + params) + "\n"
+
+
+def loader_conf(default: str, timeout: int = 0) -> str:
+    """timeout为0时直接启动默认项, 开机时按住空格才显示菜单"""
+    return f"default {default}\ntimeout {timeout}\nconsole-mode max\neditor no\n"
+
+
+def loader_entry(title: str, kernel: str, initrds: list, options: str) -> str:
+    lines = [f"title {title}", f"linux /{kernel}"] + [f"initrd /{i}" for i in initrds] + [f"options {options}"]
+    return "\n".join(lines) + "\n"
+
+
+def uki_preset(preset: str, esp: str = "/boot") -> str:
+    """mkinitcpio预设改为生成UKI: 注释掉*_image, 写入*_uki"""
+    lines = []
+    for line in preset.splitlines():
+        m = re.match(r'^#?(\w+)_(image|uki)="?/\S*?initramfs-(\S+?)(-fallback)?\.img"?$', line) or \
+            re.match(r'^#?(\w+)_(image|uki)="?\S*/arch-(\S+?)(-fallback)?\.efi"?$', line)
+        if m is None:
+            lines.append(line)
+            continue
+        name, kind, kernel, fallback = m.groups()
+        if kind == "image":
+            lines.append(line if line.startswith("#") else "#" + line)
+        else:
+            continue  # 统一在下面按image重新生成
+        lines.append(f'{name}_uki="{esp}/EFI/Linux/arch-{kernel}{fallback or ""}.efi"')
+    return "\n".join(lines) + "\n"
+
+
+def boot_time_units(bootloader: str) -> dict:
+    """首次开机时记录systemd-analyze的结果, 用定时器触发, 不在开机事务里, 不会拖慢或卡住启动"""
+    service = ("[Unit]\nDescription=Record first boot time\n"
+               f"ConditionPathExists=!{BOOT_TIME_FILE}\n\n"
+               "[Service]\nType=oneshot\n"
+               f"ExecStart=/bin/sh -c '{{ echo bootloader={bootloader}; systemd-analyze time; "
+               f"systemd-analyze blame --no-pager | head -n 20; }} > {BOOT_TIME_FILE}.tmp "
+               f"&& mv {BOOT_TIME_FILE}.tmp {BOOT_TIME_FILE}'\n")
+    timer = (f"[Unit]\nDescription=Record first boot time\n\n"
+             f"[Timer]\nOnBootSec={BOOT_TIME_DELAY}\n\n[Install]\nWantedBy=timers.target\n")
+    return {f"etc/systemd/system/{BOOT_TIME_UNIT}.service": service,
+            f"etc/systemd/system/{BOOT_TIME_UNIT}.timer": timer}
+
+
+# =================================== initramfs ========================================
+
+support_kernels = ["linux", "linux-lts", "linux-zen"]
+
+INITRAMFS_GENERIC = "generic"
+INITRAMFS_HOSTONLY = "hostonly"
+support_initramfs = [INITRAMFS_GENERIC, INITRAMFS_HOSTONLY]
+support_initramfs_compression = ["default", "zstd", "lz4"]
+
+# host-only时只保留这些钩子, 需要的驱动全部写在MODULES里, 不再由block/filesystems钩子整类加入
+HOSTONLY_HOOKS = ["base", "udev", "systemd", "microcode", "modconf", "fsck", "resume"]
+MKINITCPIO_GENERIC = "etc/mkinitcpio.conf.generic"  # host-only调整之前的配置(相对目标根目录), 从镜像安装时以它为起点
+
+
+class InitramfsStat:
+    def __init__(self, label: str, seconds: float, images: dict):
+        self.label = label
+        self.seconds = seconds  # mkinitcpio -P耗时, None表示已有的镜像, 没有重新构建
+        self.images = images  # 相对目标根目录的路径 -> 字节
+
+
+def tune_mkinitcpio(conf: str, modules: list = None, compression: str = "default") -> str:
+    """modules不为空时生成host-only配置: MODULES写死本机存储和文件系统驱动, 去掉autodetect/block/filesystems等钩子"""
+    lines = []
+    for line in conf.splitlines():
+        if modules and re.match(r"^MODULES=\(", line):
+            line = f"MODULES=({' '.join(modules)})"
+        elif modules and re.match(r"^HOOKS=\(", line):
+            hooks = re.match(r"^HOOKS=\((.*)\)", line).group(1).split()
+            line = f"HOOKS=({' '.join(h for h in hooks if h in HOSTONLY_HOOKS)})"
+        elif compression != "default" and re.match(r"^#?COMPRESSION=", line):
+            line = f'COMPRESSION="{compression}"'
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def drop_fallback_preset(preset: str) -> str:
+    """只生成default镜像, fallback是不带autodetect的通用镜像, 构建时间和体积都是大头"""
+    return re.sub(r"^PRESETS=\(.*\)$", "PRESETS=('default')", preset, flags=re.M)
+
+
+def initramfs_images(root: str) -> dict:
+    images = {}
+    for d, pattern in (("boot", "initramfs-*.img"), ("boot/EFI/Linux", "*.efi")):
+        path = os.path.join(root, d)
+        if os.path.isdir(path):
+            for f in sorted(fnmatch.filter(os.listdir(path), pattern)):
+                images[f"{d}/{f}"] = os.path.getsize(os.path.join(path, f))
+    return images
+
+
+def print_initramfs_stat(before: InitramfsStat, after: InitramfsStat):
+    stats = [s for s in (before, after) if s is not None]
+    for s in stats:
+        total = sum(s.images.values())
+        build = f", build {s.seconds:.1f}s" if s.seconds is not None else ""
+        print("{} {}".format(apply_cyan("[INITRAMFS]"), apply_green(
+            f"{s.label}: {len(s.images)} images, {total / 1024 ** 2:.1f}M{build}")))
+        for path, size in s.images.items():
+            print("{} {}".format(apply_cyan("[INITRAMFS]"), apply_yellow(f"  {path} {size / 1024 ** 2:.1f}M")))
+    if before is not None and after is not None and sum(before.images.values()):
+        build = f", build {before.seconds:.1f}s -> {after.seconds:.1f}s" if before.seconds is not None else ""
+        print("{} {}".format(apply_cyan("[INITRAMFS]"), apply_green(
+            f"size {sum(after.images.values()) * 100 / sum(before.images.values()):.0f}%{build}")))
+
+
+# =================================== unattended config ================================
+
+settings_keys = ["disk", "desktop", "root_password", "users", "users_file", "swap", "hostname", "packages", "layout",
+                 "filesystem", "swap_mode", "hibernate", "bootloader", "measure_boot", "kernel", "initramfs",
+                 "initramfs_compression", "initramfs_fallback", "initramfs_compare"]
+
+
+def read_settings_file(path: str) -> dict:
+    """读取TOML/JSON格式的安装配置, path也可以是http(s)地址"""
+    if path.startswith(("http://", "https://")):
+        with urllib.request.urlopen(path, timeout=30) as resp:
+            data = resp.read()
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ValueError("TOML config needs python >= 3.11")
+        return tomllib.loads(data.decode())
+    return json.loads(data)
+
+
+def read_cmdline_settings(path: str = KERNEL_CMDLINE) -> dict:
+    """从内核参数读取配置, 例如:
+    archinstall.config=http://10.0.0.1/node.toml
+    archinstall.disk=/dev/nvme0n1 archinstall.desktop=plasma archinstall.users=alice:passwd:zsh,bob:passwd
+    """
+    try:
+        with open(path) as f:
+            params = f.read().split()
+    except OSError:
+        return None
+
+    raw = {}
+    for p in params:
+        if p.startswith(CMDLINE_PREFIX) and "=" in p:
+            k, v = p[len(CMDLINE_PREFIX):].split("=", 1)
+            raw[k] = v
+    if len(raw) == 0:
+        return None
+
+    settings = read_settings_file(raw.pop("config")) if "config" in raw else {}
+    for k, v in raw.items():
+        if k == "users":
+            users = []
+            for item in v.split(","):
+                name, passwd, *shell = item.split(":")
+                users.append({"name": name, "password": passwd, "shell": shell[0] if shell else "bash"})
+            settings["users"] = users
+        elif k == "packages":
+            settings["packages"] = v.split(",")
+        elif k == "swap":
+            settings["swap"] = int(v) if v.isdigit() else v
+        elif k in ("hibernate", "measure_boot", "initramfs_fallback", "initramfs_compare"):
+            settings[k] = v.lower() in ("1", "yes", "true")
+        else:
+            settings[k] = v
+    return settings
+
+
+def validate_settings(settings: dict, boot: str = UEFI) -> list:
+    """一次性检查所有配置项, 返回错误列表; boot为本机的启动方式, 决定默认分区布局"""
+    errors = []
+    for k in settings:
+        if k not in settings_keys:
+            errors.append(f"unknown key {k}")
+    if "disk" in settings:
+        try:
+            select_disks([], str(settings["disk"]))
+        except ValueError as e:
+            errors.append(f"disk: {e}")
+    if settings.get("filesystem", "auto") not in support_filesystems:
+        errors.append(f"filesystem must be one of {support_filesystems}")
+    if settings.get("bootloader", BOOT_GRUB) not in support_bootloaders:
+        errors.append(f"bootloader must be one of {support_bootloaders}")
+
+    if settings.get("kernel", "linux") not in support_kernels:
+        errors.append(f"kernel must be one of {support_kernels}")
+    if settings.get("initramfs", INITRAMFS_GENERIC) not in support_initramfs:
+        errors.append(f"initramfs must be one of {support_initramfs}")
+    if settings.get("initramfs_compression", "default") not in support_initramfs_compression:
+        errors.append(f"initramfs_compression must be one of {support_initramfs_compression}")
+    if settings.get("desktop", NODESKTOP) not in support_desktops:
+        errors.append(f"desktop must be one of {support_desktops}")
+    if not settings.get("root_password"):
+        errors.append("root_password is required")
+    if not settings.get("hostname"):
+        errors.append("hostname is required")
+    swap = settings.get("swap", 0)
+    if not isinstance(swap, int) or isinstance(swap, bool) or swap < 0:
+        errors.append("swap must be a positive integer (G)")
+    if settings.get("swap_mode", "auto") not in support_swap_modes:
+        errors.append(f"swap_mode must be one of {support_swap_modes}")
+    if settings.get("hibernate") and settings.get("swap_mode") in (SWAP_ZRAM, SWAP_NONE):
+        errors.append("hibernate needs swap_mode file or partition")
+    if not isinstance(settings.get("packages", []), list):
+        errors.append("packages must be a list")
+    layout_ok = True
+    if "layout" in settings:
+        if not isinstance(settings["layout"], list) or not all(isinstance(p, dict) and "role" in p
+                                                               for p in settings["layout"]):
+            errors.append("layout must be a list of {role, size}")
+            layout_ok = False
+        else:
+            errors.extend("layout: " + e for e in default_layout("/dev/x", boot, 0, settings["layout"]).validate(boot))
+    if layout_ok and settings.get("filesystem") == "f2fs" and \
+            grub_reads_root(settings.get("bootloader", BOOT_GRUB), boot, settings.get("layout")):
+        errors.append("GRUB can't read an f2fs root with /boot on it, "
+                      "use bootloader systemd-boot/uki or a layout with a boot partition")
+
+    names = ["root"]
+    for i, u in enumerate(settings.get("users", [])):
+        if not isinstance(u, dict) or not u.get("name") or not u.get("password"):
+            errors.append(f"users[{i}] needs name and password")
+            continue
+        if u["name"] in names:
+            errors.append(f"users[{i}] {u['name']} already taken")
+        names.append(u["name"])
+        if not re.match(r"^[a-z_][a-z0-9_-]*$", u["name"]):
+            errors.append(f"users[{i}] invalid name {u['name']}")
+        if u.get("shell", "bash") not in support_shells:
+            errors.append(f"users[{i}] shell must be one of {support_shells}")
+        if not isinstance(u.get("groups", []), list) or not all(re.match(r"^[a-z_][a-z0-9_-]*$", g)
+                                                                for g in u.get("groups", [])):
+            errors.append(f"users[{i}] groups must be a list of group names")
+        if u.get("sudo") not in (None, "nopasswd"):
+            errors.append(f"users[{i}] sudo must be nopasswd")
+    return errors
+
+
+def load_settings(path: str = None) -> dict:
+    """读取并校验无人值守配置, 没有配置返回None(交互式安装)"""
+    try:
+        settings = read_settings_file(path) if path else read_cmdline_settings()
+        if settings is not None and settings.get("users_file"):
+            settings["users"] = settings.get("users", []) + read_users_file(settings["users_file"])
+    except (OSError, ValueError) as e:
+        print("{}".format(apply_red(f"can't load config: {e}")))
+        sys.exit(1)
+    if settings is None:
+        return None
+
+    errors = validate_settings(settings, UEFI if hardware().uefi else BIOS)
+    if errors:
+        for e in errors:
+            print("{}".format(apply_red(f"CONFIG ERROR: {e}")))
+        sys.exit(1)
+    return settings
+
+
+# =================================== step journal =====================================
+
+def fingerprint(inputs: dict) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class Journal:
+    """记录已完成的安装步骤及其输入, 同时写到目标盘和live环境内存里"""
+
+    def __init__(self, root: str = MOUNT_ROOT, ram_path: str = JOURNAL_RAM):
+        self.root = root
+        self.ram_path = ram_path
+        self.steps = {}  # name -> {"inputs": 指纹, "time": 完成时间}
+        self.salt = None  # 密码类输入的盐, 每次全新安装生成一个
+        self.lock = threading.Lock()
+
+    @property
+    def target_path(self) -> str:
+        return os.path.join(self.root, JOURNAL_TARGET)
+
+    def load(self) -> bool:
+        """优先读内存中的日志, live环境重启过则读目标盘上的"""
+        for path in (self.ram_path, self.target_path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.steps = data["steps"]
+                self.salt = data.get("salt") or self.new_salt()
+                return True
+            except (OSError, ValueError, KeyError):
+                continue
+        return False
+
+    def reset(self):
+        with self.lock:
+            self.steps = {}
+            self.salt = self.new_salt()
+            self._save()
+
+    @staticmethod
+    def new_salt() -> str:
+        return "".join(CRYPT_ALPHABET[b % 64] for b in os.urandom(16))
+
+    def secret(self, value: str) -> str:
+        """密码不能直接做指纹(无盐sha256很容易反推), 用本次安装的盐算成shadow同款的SHA-512 crypt"""
+        return sha512_crypt(value, self.salt or self.new_salt())
+
+    def done(self, name: str, inputs: dict) -> bool:
+        entry = self.steps.get(name)
+        return entry is not None and entry["inputs"] == fingerprint(inputs)
+
+    def record(self, name: str, inputs: dict):
+        with self.lock:
+            self.steps[name] = {"inputs": fingerprint(inputs), "time": time.time()}
+            self._save()
+
+    def _save(self):
+        paths = [self.ram_path]
+        # 目标盘还没挂载时写进去的文件会被挂载盖住
+        if os.path.ismount(self.root):
+            paths.append(self.target_path)
+        data = json.dumps({"steps": self.steps, "salt": self.salt}, indent=2)
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.chmod(path + ".tmp", 0o600)  # 已经存在的tmp文件不受O_CREAT的mode影响
+            os.replace(path + ".tmp", path)
+
+    def remove_target(self):
+        """安装完成后不再需要断点续装, 不在装好的系统里留下任何和密码有关的东西"""
+        try:
+            os.remove(self.target_path)
+        except FileNotFoundError:
+            pass
+
+
+def per_target(path: str, root: str) -> str:
+    """多盘安装时每个目标单独一份的文件: /tmp/x.conf -> /tmp/sdb/x.conf, 单盘保持原路径"""
+    if root == MOUNT_ROOT:
+        return path
+    head, tail = os.path.split(path)
+    return os.path.join(head, os.path.basename(root), tail)
+
+
+# =================================== golden image =====================================
+
+class StreamStat:
+    def __init__(self, label: str, size: int, seconds: float):
+        self.label = label
+        self.size = size  # 流过的未压缩字节数
+        self.seconds = seconds
+
+    @property
+    def speed(self) -> float:
+        return self.size / self.seconds if self.seconds > 0 else 0
+
+
+def run_pipe(src: str, dst: str, label: str, cancel: threading.Event = None) -> StreamStat:
+    """把src的输出按块转给dst, 整个镜像不会落在内存里, 顺便统计吞吐量; 任一端失败则退出"""
+    cancel = cancel or cancel_event
+    logger = get_logger()
+    logger.info(f"[PIPE] {src} | {dst}")
+    print("{} {}".format(apply_cyan("[PIPE]"), apply_yellow(f"{src} | {dst}")))
+    start = last = time.monotonic()
+    size = 0
+    p_src = subprocess.Popen(src, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                             start_new_session=True)
+    p_dst = subprocess.Popen(dst, shell=True, stdin=subprocess.PIPE, start_new_session=True)
+    try:
+        with tracer.span(label, "cmd"):
+            while True:
+                if cancel.is_set():
+                    raise KeyboardInterrupt
+                chunk = os.read(p_src.stdout.fileno(), IMAGE_CHUNK)
+                if not chunk:
+                    break
+                try:
+                    p_dst.stdin.write(chunk)
+                except BrokenPipeError:  # dst提前退出, 退出码在下面检查
+                    _kill(p_src)
+                    break
+                size += len(chunk)
+                if time.monotonic() - last >= 5:
+                    last = time.monotonic()
+                    print("{} {}".format(apply_cyan(f"[{label}]"), apply_yellow(
+                        f"{size / 1e6:.0f}MB {size / 1e6 / (last - start):.1f}MB/s")))
+            try:
+                p_dst.stdin.close()
+            except BrokenPipeError:
+                pass
+            code_src, code_dst = p_src.wait(), p_dst.wait()
+    except BaseException:
+        _kill(p_src)
+        _kill(p_dst)
+        raise
+    code = code_dst or code_src
+    if code != 0:
+        print("{}".format(apply_red(f"RUN ERROR: {src} | {dst}")))
+        sys.exit(code if code > 0 else 1)
+    return StreamStat(label, size, time.monotonic() - start)
+
+
+def image_source(path: str) -> str:
+    """镜像可以是本地文件也可以是http(s)地址, 都是边读边解压"""
+    if path.startswith(("http://", "https://")):
+        return f"curl -fsSL {path} | zstd -dc -"
+    return f"zstd -dc {path}"
+
+
+def read_image_meta(path: str) -> dict:
+    try:
+        if path.startswith(("http://", "https://")):
+            with urllib.request.urlopen(path + ".json", timeout=10) as resp:
+                return json.loads(resp.read())
+        with open(path + ".json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def print_stream_stat(st: StreamStat, compressed: int = 0):
+    ratio = f", image {compressed / 1e6:.0f}MB ({st.size / compressed:.1f}x)" if compressed else ""
+    print("{}: {}".format(apply_blue(st.label.upper()), apply_green(
+        f"{st.size / 1e6:.0f}MB in {st.seconds:.1f}s ({st.speed / 1e6:.1f}MB/s){ratio}")))
+
+
+# =================================== users ============================================
+
+CRYPT_ALPHABET = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+_sha512_order = [(0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4), (47, 5, 26), (6, 27, 48),
+                 (28, 49, 7), (50, 8, 29), (9, 30, 51), (31, 52, 10), (53, 11, 32), (12, 33, 54), (34, 55, 13),
+                 (56, 14, 35), (15, 36, 57), (37, 58, 16), (59, 17, 38), (18, 39, 60), (40, 61, 19), (62, 20, 41)]
+
+
+def _b64_24bit(b2: int, b1: int, b0: int, n: int) -> str:
+    w = (b2 << 16) | (b1 << 8) | b0
+    out = ""
+    for _ in range(n):
+        out += CRYPT_ALPHABET[w & 0x3f]
+        w >>= 6
+    return out
+
+
+def sha512_crypt(password: str, salt: str = None, rounds: int = 5000) -> str:
+    """glibc的SHA-512 crypt($6$), 与chpasswd -e/shadow兼容; python 3.13起标准库没有crypt模块"""
+    if salt is None:
+        salt = "".join(CRYPT_ALPHABET[b % 64] for b in os.urandom(16))
+    p, s = password.encode(), salt.encode()[:16]
+    alt = hashlib.sha512(p + s + p).digest()
+    ctx = hashlib.sha512(p + s)
+    n = len(p)
+    while n > 64:
+        ctx.update(alt)
+        n -= 64
+    ctx.update(alt[:n])
+    n = len(p)
+    while n > 0:
+        ctx.update(alt if n & 1 else p)
+        n >>= 1
+    c = ctx.digest()
+    dp = hashlib.sha512(p * len(p)).digest()
+    pp = (dp * (len(p) // 64 + 1))[:len(p)]
+    ds = hashlib.sha512(s * (16 + c[0])).digest()
+    ss = (ds * (len(s) // 64 + 1))[:len(s)]
+    for i in range(rounds):
+        ctx = hashlib.sha512(pp if i & 1 else c)
+        if i % 3:
+            ctx.update(ss)
+        if i % 7:
+            ctx.update(pp)
+        ctx.update(c if i & 1 else pp)
+        c = ctx.digest()
+    out = "".join(_b64_24bit(c[a], c[b], c[d], 4) for a, b, d in _sha512_order) + _b64_24bit(0, 0, c[63], 2)
+    prefix = "$6$" if rounds == 5000 else f"$6$rounds={rounds}$"
+    return f"{prefix}{s.decode()}${out}"
+
+
+def is_crypt_hash(value: str) -> bool:
+    """已经是shadow格式的哈希($6$ SHA-512, $y$ yescrypt等), 原样交给chpasswd -e"""
+    return re.match(r"^\$(1|5|6|y|gy|7|2[aby])\$", value or "") is not None
+
+
+def hash_password(value: str) -> str:
+    return value if is_crypt_hash(value) else sha512_crypt(value)
+
+
+def read_users_file(path: str) -> list:
+    """每行一个用户: 名字:密码或哈希[:shell[:附加组,逗号分隔[:nopasswd]]], #开头为注释"""
+    if path.startswith(("http://", "https://")):
+        with urllib.request.urlopen(path, timeout=30) as resp:
+            text = resp.read().decode()
+    else:
+        with open(path) as f:
+            text = f.read()
+    users = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, passwd, *rest = line.split(":")
+        user = {"name": name, "password": passwd, "shell": rest[0] if rest and rest[0] else "bash"}
+        if len(rest) > 1 and rest[1]:
+            user["groups"] = rest[1].split(",")
+        if len(rest) > 2 and rest[2]:
+            user["sudo"] = rest[2]
+        users.append(user)
+    return users
+
+
+# ======================================================================================
+
+
 class DiskMount:
     def __init__(self, disk: str, mount_point: str):
         self.disk = disk
@@ -148,37 +2365,73 @@ class DiskMount:
 
 
 class User:
-    def __init__(self, name: str, passwd: str, shell: str = "bash"):
+    def __init__(self, name: str, passwd: str, shell: str = "bash", groups: list = None, sudo: str = None):
         self.name = name
-        self.passwd = passwd
+        self.passwd = passwd  # 明文或者crypt格式的哈希, 只以哈希的形式传进chroot
         self.shell = shell
+        self.groups = groups if groups is not None else ["wheel"]
+        self.sudo = sudo  # nopasswd: 单独写一个免密码的sudoers.d文件
+        self._hash = None
+
+    @property
+    def password_hash(self) -> str:
+        if self._hash is None:
+            self._hash = hash_password(self.passwd)
+        return self._hash
 
 
 class Config:
-    def __init__(self):
+    def __init__(self, settings: dict = None, targets: list = None):
+        self.settings = settings  # 无人值守配置, None则交互式输入
+        self.targets = targets or []  # 多盘安装的目标磁盘, 第一块作为install_disk
         self.boot = None
+        self.bootloader = None
+        self.measure_boot = False  # 首次开机时记录启动耗时
+        self.kernel = None
+        self.initramfs = INITRAMFS_GENERIC
+        self.initramfs_compression = "default"
+        self.initramfs_fallback = True
+        self.initramfs_compare = False  # 先按原配置构建一次, 比较构建耗时
         self.cpu_vendor = None
+        self.gpus = []  # (PciDevice, GpuDriver或None)
         self.install_disk = None
+        self.filesystem = None
         self.disk_mount = []  # DiskMount TODO
         self.desktop = None
         self.root_passwd = None
         self.common_users = []  # User
         self.language = None  # TODO
-        self.swap_size = None
+        self.swap_mode = None
+        self.swap_size = None  # G
+        self.hibernate = False
         self.hostname = None
-        self.packages = base_packages
+        self.packages = []
+        self.package_groups = {}  # 分组名 -> 软件包, 按安装顺序
+        self.add_packages("base", base_packages)
 
         self._detect_platform()
         self._detect_network()
         self._detect_boot()
         self._detect_cpu_vendor()
 
+        self.set_bootloader()
+        self.set_kernel()
         self.set_install_disk()
+        self.set_filesystem()
         self.set_desktop()
         self.set_root_passwd()
         self.set_common_users()
-        self.set_swap_size()
+        self.set_swap()
         self.set_hostname()
+        self.set_extra_packages()
+
+    @property
+    def unattended(self) -> bool:
+        return self.settings is not None
+
+    def add_packages(self, group: str, packages: list):
+        self.packages.extend(packages)
+        self.package_groups.setdefault(group, []).extend(packages)
 
     @staticmethod
     def _detect_platform():
@@ -194,60 +2447,123 @@ class Config:
 
     def _detect_boot(self):
         """自动检测启动类型"""
-        if os.path.exists("/sys/firmware/efi/efivars"):
+        if hardware().uefi:
             self.boot = UEFI
-            self.packages.extend(efi_packages)
+            self.add_packages("base", efi_packages)
         else:
             self.boot = BIOS
 
     def _detect_cpu_vendor(self):
         """自动检测CPU类型"""
-        self.cpu_vendor = run_cmd("lscpu | grep Vendor | grep -v BIOS | awk '{print $3}'", False, False)
+        self.cpu_vendor = hardware().cpu.vendor
         if self.cpu_vendor == CPU_AMD:
-            self.packages.extend(amd_packages)
+            self.add_packages("base", amd_packages)
         elif self.cpu_vendor == CPU_INTEL:
-            self.packages.extend(intel_packages)
+            self.add_packages("base", intel_packages)
+
+    def set_bootloader(self):
+        """引导方式, 默认grub; UEFI下可以选systemd-boot或UKI, 启动更快"""
+        if self.unattended:
+            self.bootloader = self.settings.get("bootloader", BOOT_GRUB)
+            self.measure_boot = bool(self.settings.get("measure_boot", False))
+        elif self.boot == UEFI:
+            self.bootloader = choose_from_list("bootloader", support_bootloaders)
+        else:
+            self.bootloader = BOOT_GRUB
+        if bootloaders[self.bootloader].uefi_only and self.boot != UEFI:
+            print("{}".format(apply_red(f"{self.bootloader} needs UEFI boot")))
+            sys.exit(1)
+        self.add_packages("base", bootloaders[self.bootloader].packages)
+
+    def set_kernel(self):
+        """内核和initramfs, 交互式安装只选择内核, initramfs使用默认的通用配置"""
+        settings = self.settings if self.unattended else {}
+        self.kernel = settings.get("kernel", "linux") if self.unattended else choose_from_list("kernel", support_kernels)
+        self.initramfs = settings.get("initramfs", INITRAMFS_GENERIC)
+        self.initramfs_compression = settings.get("initramfs_compression", "default")
+        self.initramfs_fallback = bool(settings.get("initramfs_fallback", True))
+        self.initramfs_compare = bool(settings.get("initramfs_compare", False))
+        self.add_packages("base", [self.kernel])
 
     def set_install_disk(self):
         """设置安装磁盘"""
-        all_disk = run_cmd("fdisk -l | grep 'Disk /dev/' | awk '{print $2}'", False, True).split("\n")
-        real_disks = []
-        for d in all_disk:
-            if d.count("loop") > 0 or d.count("rom") > 0 or d.count("airoot") > 0 or d.count("ram") > 0:
-                pass
-            else:
-                real_disks.append(d[:len(d) - 1])
+        if self.targets:
+            self.install_disk = self.targets[0]
+            return
+
+        real_disks = hardware().disks
+        if self.unattended:
+            real_disks = select_disks(real_disks, str(self.settings.get("disk", "auto")))
 
         if len(real_disks) == 0:
             print("{}".format(apply_red("there no disk in this node!")))
-            sys.exit(0)
+            sys.exit(0 if not self.unattended else 1)
         elif len(real_disks) == 1:
-            self.install_disk = real_disks[0]
+            self.install_disk = real_disks[0].path
+        elif self.unattended:
+            names = ", ".join(d.describe() for d in real_disks)
+            print("{}".format(apply_red(f"disk selector matches more than one disk: {names}")))
+            sys.exit(1)
         else:
-            self.install_disk = choose_from_list("disk", real_disks)
+            labels = [d.describe() for d in real_disks]
+            self.install_disk = real_disks[labels.index(choose_from_list("disk", labels))].path
+
+    def for_disk(self, disk: str) -> "Config":
+        """多盘安装时每块盘一份配置, 文件系统为auto时按各自的磁盘重新选择"""
+        cfg = copy.copy(self)
+        cfg.install_disk = disk
+        cfg.packages = list(self.packages)
+        cfg.package_groups = {g: list(pkgs) for g, pkgs in self.package_groups.items()}
+        fs = self.settings.get("filesystem", "auto") if self.unattended else "auto"
+        if fs == "auto":
+            cfg.filesystem = choose_filesystem(find_disk(disk), self.grub_root)
+            cfg.add_packages("base", [p for p in fs_profiles[cfg.filesystem].packages if p not in cfg.packages])
+        return cfg
+
+    def set_filesystem(self):
+        """根分区文件系统, 默认按磁盘类型选择"""
+        fs = self.settings.get("filesystem", "auto") if self.unattended else "auto"
+        self.filesystem = choose_filesystem(find_disk(self.install_disk), self.grub_root) if fs == "auto" else fs
+        self.add_packages("base", fs_profiles[self.filesystem].packages)
+
+    @property
+    def grub_root(self) -> bool:
+        layout = self.settings.get("layout") if self.unattended else None
+        return grub_reads_root(self.bootloader, self.boot, layout)
 
     def set_desktop(self):
         """设置桌面环境"""
-        self.desktop = choose_from_list("desktop", support_desktops)
+        if self.unattended:
+            self.desktop = self.settings.get("desktop", NODESKTOP)
+        else:
+            self.desktop = choose_from_list("desktop", support_desktops)
         if self.desktop != NODESKTOP:
-            self.packages.extend(desktop_base_packages)
+            self.add_packages("desktop", desktop_base_packages)
 
-            if self.cpu_vendor == CPU_AMD:
-                self.packages.append("xf86-video-amdgpu")
-            elif self.cpu_vendor == CPU_INTEL:
-                self.packages.append("xf86-video-intel")
+            # 按PCI显卡选驱动, 不能按CPU厂商猜: Intel CPU配NVIDIA/AMD独显很常见
+            self.gpus, packages = resolve_gpu_drivers(hardware().gpus, self.kernel)
+            self.add_packages("desktop", [p for p in packages if p not in self.packages])
 
             if self.desktop == GNOME_DESKTOP:
-                self.packages.extend(gnome_packages)
+                self.add_packages(GNOME_DESKTOP, gnome_packages)
             elif self.desktop == PLASMA_DESKTOP:
-                self.packages.extend(plasma_packages)
+                self.add_packages(PLASMA_DESKTOP, plasma_packages)
 
     def set_root_passwd(self):
         """设置root用户密码"""
-        self.root_passwd = read_str("please set root's password")
+        if self.unattended:
+            self.root_passwd = self.settings["root_password"]
+        else:
+            self.root_passwd = read_str("please set root's password")
 
     def set_common_users(self):
         """设置普通用户"""
+        if self.unattended:
+            for u in self.settings.get("users", []):
+                self.common_users.append(User(u["name"], u["password"], u.get("shell", "bash"), u.get("groups"),
+                                              u.get("sudo")))
+            return
+
         yn = read_str("need common users? [y/n]")
         if yn.lower() != "y":
             return
@@ -264,37 +2580,299 @@ class Config:
             if yn.lower() != "y":
                 return
 
-    def set_swap_size(self):
-        """设置 swap 大小"""
-        self.swap_size = read_int("please set swap size (G)", True)
+    def set_swap(self):
+        """设置swap: zram / swapfile / 分区 / 不使用, 没有指定时按内存和磁盘大小计算"""
+        settings = self.settings if self.unattended else {}
+        if not self.unattended:
+            settings["swap_mode"] = choose_from_list("swap mode", support_swap_modes)
+            if settings["swap_mode"] in (SWAP_FILE, SWAP_PARTITION):
+                settings["hibernate"] = read_str("need hibernate? [y/n]").lower() == "y"
+        self.hibernate = bool(settings.get("hibernate", False))
+        mode = settings.get("swap_mode", "auto")
+        if mode == "auto" and settings.get("swap"):
+            mode = SWAP_PARTITION  # 兼容只写了swap大小的旧配置
+        disk = find_disk(self.install_disk)
+        auto_mode, auto_size = default_swap(hardware().memory, disk.size if disk else 0, self.hibernate)
+        self.swap_mode = auto_mode if mode == "auto" else mode
+        if self.hibernate and self.swap_mode not in (SWAP_FILE, SWAP_PARTITION):
+            # 自动选择时磁盘太小放不下和内存一样大的swap, 关掉休眠, 后面的resume钩子和内核参数都以此为准
+            print("{}".format(apply_yellow(f"disk too small for a {math.ceil(hardware().memory / 1024 ** 3)}G "
+                                           f"hibernation swap, hibernation disabled")))
+            self.hibernate = False
+        if self.swap_mode == SWAP_NONE:
+            self.swap_size = 0
+        else:
+            self.swap_size = settings.get("swap") or auto_size or max(1, math.ceil(hardware().memory / 1024 ** 3))
+        if self.swap_mode == SWAP_ZRAM:
+            self.add_packages("base", ["zram-generator"])
 
     def set_hostname(self):
         """设置hostname"""
-        self.hostname = read_str("please set hostname")
+        if self.unattended:
+            self.hostname = self.settings["hostname"]
+        else:
+            self.hostname = read_str("please set hostname")
+
+    def set_extra_packages(self):
+        """配置文件中额外安装的软件包"""
+        if self.unattended and self.settings.get("packages"):
+            self.add_packages("extra", self.settings["packages"])
 
     def print_info(self):
-        print("{}: {}".format(apply_blue("BOOT"), apply_green(f"{self.boot}")))
+        print("{}: {}".format(apply_blue("BOOT"), apply_green(
+            f"{self.boot} {self.bootloader}" + (" (measure)" if self.measure_boot else ""))))
         print("{}: {}".format(apply_blue("CPU"), apply_green(f"{self.cpu_vendor}")))
-        print("{}: {}".format(apply_blue("INSTALLATION"), apply_green(f"{self.install_disk}")))
+        print("{}: {}".format(apply_blue("KERNEL"), apply_green(
+            f"{self.kernel} initramfs={self.initramfs} compression={self.initramfs_compression}"
+            + ("" if self.initramfs_fallback else " no-fallback"))))
+        print("{}: {}".format(apply_blue("INSTALLATION"), apply_green(", ".join(self.targets) or f"{self.install_disk}")))
+        print("{}: {}".format(apply_blue("FILESYSTEM"), apply_green(f"{self.filesystem}")))
         print("{}: {}".format(apply_blue("DESKTOP"), apply_green(f"{self.desktop}")))
+        for gpu, driver in self.gpus:
+            print("{}: {}".format(apply_blue("GPU"), apply_green(
+                f"{gpu.describe()} {driver.name if driver else 'unknown, mesa only'}")))
         print("{}: {}".format(apply_blue("HOSTNAME"), apply_green(f"{self.hostname}")))
-        print("{}: {}".format(apply_blue("SWAP_SIZE"), apply_green(f"{self.swap_size}G")))
-        print("{}: {}".format(apply_blue("ROOT_PASSWORD"), apply_green(f"{self.root_passwd}")))
+        print("{}: {}".format(apply_blue("SWAP"), apply_green(
+            f"{self.swap_mode} {self.swap_size}G" + (" (hibernate)" if self.hibernate else ""))))
+        print("{}: {}".format(apply_blue("ROOT_PASSWORD"), apply_green("(hashed)" if is_crypt_hash(self.root_passwd)
+                                                                      else "*" * 8)))
 
         for i, u in enumerate(self.common_users):
             assert isinstance(u, User)
-            print("{}: {}".format(apply_blue(f"USER{i + 1}"), apply_green(f"{u.name}")))
-            print("{}: {}".format(apply_blue(f"PASSWORD{i + 1}"), apply_green(f"{u.passwd}")))
-            print("{}: {}".format(apply_blue(f"SHELL{i + 1}"), apply_green(f"{u.shell}")))
+            sudo = " sudo=nopasswd" if u.sudo else ""
+            print("{}: {}".format(apply_blue(f"USER{i + 1}"),
+                                  apply_green(f"{u.name} shell={u.shell} groups={','.join(u.groups)}{sudo}")))
+
+
+class SharedDownload:
+    """多盘安装时软件包只下载一次: 第一个到download_linux的目标下载到自己盘上, 其他目标作为只读缓存使用"""
+
+    def __init__(self, targets: int):
+        self.dir = None  # 已下载好的缓存目录, 在下载者的目标盘上
+        self.owner = None  # 下载者的挂载点
+        self.lock = threading.Lock()
+        self.pending = targets
+        self.released = set()
+        self.idle = threading.Event()  # 所有目标都不再需要这个缓存
+        if targets == 0:
+            self.idle.set()
+
+    def fetch(self, install: "Installation", conf: str):
+        """没有下载过就用当前目标下载, 其他目标阻塞到下载完成; 下载失败时下一个目标接着尝试"""
+        with self.lock:
+            if self.dir is not None:
+                return
+            os.makedirs(os.path.join(SHARED_DOWNLOAD_DB, "local"), exist_ok=True)
+            sync = os.path.join(SHARED_DOWNLOAD_DB, "sync")
+            if not os.path.islink(sync):
+                os.symlink(SYNC_DB_DIR, sync)
+            # 空的本地数据库, 否则live环境里已经装了的包不会下载
+            run_cmd(f"pacman -Sw --noconfirm --config {conf} --dbpath {SHARED_DOWNLOAD_DB} "
+                    f"--cachedir {install.download_cache} " + " ".join(install.cfg.packages), stdout=True)
+            self.dir = install.download_cache
+            self.owner = install.root
+
+    def release(self, install: "Installation"):
+        """目标的pacstrap结束(或者安装失败)后调用"""
+        with self.lock:
+            if install.root in self.released:
+                return
+            self.released.add(install.root)
+            self.pending -= 1
+            if self.pending <= 0:
+                self.idle.set()
+
+    def wait(self, install: "Installation"):
+        """缓存所在的目标卸载前要等其他目标都用完"""
+        if self.owner == install.root:
+            self.release(install)
+            self.idle.wait()
 
 
 class Installation:
-    def __init__(self, cfg: Config):
+    def __init__(self, cfg: Config, parallel_download: bool = False, cache: PackageCache = None,
+                 resume: bool = False, root: str = MOUNT_ROOT, shared: SharedDownload = None,
+                 image: str = None, make_image: str = None, history: StepHistory = None):
         self.cfg = cfg
+        self.parallel_download = parallel_download
+        self.cache = cache
+        self.resume = resume
+        self.root = root  # 目标系统的挂载点
+        self.name = os.path.basename(cfg.install_disk)
+        self.shared = shared
+        self.running = []  # 正在执行的步骤
+        self.steps_done = 0
+        self.failed = None  # 失败的步骤
+        self.image = image  # 从这个镜像恢复, 代替download_linux和通用的chroot步骤
+        self.make_image = make_image  # 安装完成后把根目录打包成镜像
+        self.history = history  # 记录每个步骤的耗时, 下次安装时用来估算进度
+        self.stream_stats = []  # StreamStat
+        self.journal = Journal(root, per_target(JOURNAL_RAM, root))
+        self.layout = default_layout(cfg.install_disk, cfg.boot,
+                                     cfg.swap_size if cfg.swap_mode == SWAP_PARTITION else 0,
+                                     cfg.settings.get("layout") if cfg.unattended else None)
+        self.fs = fs_profiles[cfg.filesystem]
+        self.loader = bootloaders[cfg.bootloader]
+        self.fs_options = self.fs.mount_options(find_disk(cfg.install_disk))
+        self.mirrors = []  # MirrorResult
+        self.download_stats = []  # DownloadStat
+        self.download_cache = self.target(HOST_PKG_CACHE)  # pacman实际下载到的目录
+
+    def target(self, path: str) -> str:
+        """目标系统里的路径"""
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def step_label(self, name: str) -> str:
+        return name if self.root == MOUNT_ROOT else f"{self.name}:{name}"
+
+    def step_inputs(self, name: str) -> dict:
+        """步骤依赖的配置, 配置变了该步骤就要重做"""
+        cfg = self.cfg
+        if name == "set_user":
+            users = [(u.name, u.shell, u.groups, u.sudo, self.journal.secret(u.passwd)) for u in cfg.common_users]
+            return {"root": self.journal.secret(cfg.root_passwd), "users": users}
+        return {
+            "disk_part": {"disk": cfg.install_disk, "script": self.layout.script(0), "fs": cfg.filesystem,
+                          "swap": cfg.swap_mode},
+            "set_swap": {"mode": cfg.swap_mode, "size": cfg.swap_size, "hibernate": cfg.hibernate},
+            "download_linux": {"packages": cfg.packages},
+            "set_hostname": {"hostname": cfg.hostname},
+            "set_network": {"desktop": cfg.desktop},
+            "set_initramfs": {"kernel": cfg.kernel, "initramfs": cfg.initramfs, "fs": cfg.filesystem,
+                              "compression": cfg.initramfs_compression, "fallback": cfg.initramfs_fallback,
+                              "loader": cfg.bootloader},
+            "set_bootloader": {"disk": cfg.install_disk, "boot": cfg.boot, "loader": cfg.bootloader},
+            "set_desktop": {"desktop": cfg.desktop},
+            "restore_image": {"image": self.image},
+        }.get(name, {})
+
+    def history_variant(self, name: str) -> str:
+        """耗时差别很大的配置分开记录, 例如装不装桌面时pacstrap的包数量差了几倍"""
+        if name == "download_linux":
+            return f"{self.cfg.desktop}:{'image' if self.image else 'pacstrap'}"
+        return None
+
+    def verify_step(self, name: str) -> bool:
+        """检查已完成步骤的产物是否还在"""
+        if name == "disk_part":
+            self.mount_target()
+            return os.path.ismount(self.root)
+        if name == "download_linux":
+            installed = {p.rsplit("-", 3)[0] for p in read_local_db(self.root)}
+            return len(installed) > 0 and all(p in installed for p in resolve_packages(self.cfg.packages).explicit)
+        if name == "gen_fstab":
+            if not os.path.exists(self.target("etc/fstab")):
+                return False
+            with open(self.target("etc/fstab")) as f:
+                return "UUID=" in f.read()
+        if name == "set_timezone":
+            return os.path.islink(self.target("etc/localtime"))
+        if name == "set_locale":
+            return os.path.exists(self.target("etc/locale.conf"))
+        if name == "set_hostname":
+            if not os.path.exists(self.target("etc/hostname")):
+                return False
+            with open(self.target("etc/hostname")) as f:
+                return f.read().strip() == self.cfg.hostname
+        if name == "set_bootloader":
+            return os.path.exists(self.target(self.loader.check))
+        if name == "restore_image":
+            return os.path.exists(self.target("etc/os-release"))
+        if name == "set_machine":
+            return os.path.exists(self.target("etc/machine-id")) and os.path.getsize(self.target("etc/machine-id")) > 0
+        if name == "finish" or name in host_steps:
+            return False
+        return True
+
+    def start_journal(self):
+        if not self.resume:
+            self.journal.reset()
+            return
+        if not self.journal.load():
+            # live环境重启过, 内存里的日志没了: 先挂载已有的分区再读目标盘上的那份
+            root = self.layout.part(ROOT).device
+            if os.path.exists(root) and run_cmd(f"blkid -o value -s TYPE {root}", debug=False, exit_=False):
+                self.mount_target()
+            if not self.journal.load():
+                # 从头开始会重新分区, 正好毁掉--resume想保住的东西
+                print("{}".format(apply_red(f"--resume: no install journal found on {self.cfg.install_disk}")))
+                sys.exit(1)
+        print("{} {}".format(apply_cyan("[RESUME]"), apply_yellow(", ".join(self.journal.steps))))
+
+    def run_step(self, name: str):
+        """执行单个步骤并记入日志, --resume时跳过已完成且产物完好的步骤;
+        只改live环境的步骤每次都重新执行, live环境重启后keyring/mirrorlist/测速结果都没了"""
+        inputs = self.step_inputs(name)
+        journaled = name != "finish" and name not in host_steps
+        if self.resume and journaled and self.journal.done(name, inputs) and self.verify_step(name):
+            print("{} {}".format(apply_cyan("[SKIP]"), apply_yellow(f"{self.step_label(name)} already done")))
+            progress.end(name, skipped=True)
+            self.steps_done += 1
+            return
+        self.running.append(name)
+        progress.begin(name)
+        try:
+            with tracer.span(self.step_label(name), "step"):
+                getattr(self, name)()
+        except BaseException:
+            self.failed = name
+            raise
+        finally:
+            self.running.remove(name)
+        seconds = progress.end(name)
+        if self.history is not None:
+            self.history.record(name, seconds, self.history_variant(name))
+        self.steps_done += 1
+        if journaled:
+            self.journal.record(name, inputs)
+
+    def preflight(self) -> Resolution:
+        """安装前解析所有软件包, 统计下载量并估算时间, 有不存在的包直接退出"""
+        if len(sync_db_files()) == 0:
+            run_cmd("pacman -Sy", stdout=True)
+        res = resolve_packages(self.cfg.packages)
+        if res.unknown:
+            print("{}".format(apply_red("unknown packages: " + " ".join(sorted(set(res.unknown))))))
+            sys.exit(1)
+
+        speeds = [r.speed for r in rank_mirrors(mirror_candidates()) if r.ok]
+        print("{}: {}".format(apply_blue("PACKAGES"), apply_green(f"{len(res.packages)}")))
+        print("{}: {}".format(apply_blue("DOWNLOAD_SIZE"), apply_green(f"{res.download / 1024 / 1024:.1f}MiB")))
+        print("{}: {}".format(apply_blue("INSTALLED_SIZE"), apply_green(f"{res.installed / 1024 / 1024:.1f}MiB")))
+        if speeds:
+            print("{}: {}".format(apply_blue("DOWNLOAD_TIME"), apply_green(
+                f"~{res.download / max(speeds) / 60:.1f}min at {max(speeds) / 1024 / 1024:.2f}MiB/s")))
+        return res
+
+    def preflight_image(self, ignore_boot: bool = False):
+        """分区之前检查镜像: UEFI镜像装到BIOS机器(或反过来)上无法启动, 这时磁盘还没被清空"""
+        meta = read_image_meta(self.image)
+        if meta.get("boot") in (None, self.cfg.boot):
+            return
+        msg = f"image was built for {meta['boot']} boot, this machine is {self.cfg.boot}"
+        if ignore_boot:
+            print("{}".format(apply_yellow(msg)))
+            return
+        print("{}".format(apply_red(msg + " (use --ignore-image-boot to install anyway)")))
+        sys.exit(1)
+
+    def set_mirror(self, servers: list = None):
+        """测速并按速度重写mirrorlist"""
+        if servers is None:
+            servers = mirror_candidates()
+
+        print("{} {}".format(apply_cyan("[RUN]"), apply_yellow(f"ranking {len(servers)} mirrors")))
+        self.mirrors = [r for r in rank_mirrors(servers) if r.ok]
+        if len(self.mirrors) == 0:
+            print("{}".format(apply_red("all mirrors failed, fallback to ustc")))
+            edit_file(MIRRORLIST, lambda text: prepend_lines(text, [
+                "Server = http://mirrors.ustc.edu.cn/archlinux/$repo/os/$arch",
+                "Server = https://mirrors.ustc.edu.cn/archlinux/$repo/os/$arch"]))
+            return
 
-    @staticmethod
-    def set_mirror():
-        run_cmd("sed -i '1i\Server = http://mirrors.ustc.edu.cn/archlinux/$repo/os/$arch\\nServer = https://mirrors.ustc.edu.cn/archlinux/$repo/os/$arch' /etc/pacman.d/mirrorlist")
+        for r in self.mirrors[:MIRROR_TOP]:
+            print("{} {}".format(apply_green(f"{r.speed / 1024:>8.0f}KiB/s {r.latency * 1000:>5.0f}ms"), r.server))
+        write_mirrorlist(self.mirrors)
 
     @staticmethod
     def install_keyring():
@@ -307,145 +2885,845 @@ class Installation:
 
     def disk_part(self):
         """磁盘分区"""
-        if self.cfg.boot == UEFI:
-            part = disk_partition("d", "", "d", "", "d", "", "d", "", "d", "", "d", "", "d", "",  # 删除现有分区
-                                  "g",  # 新建gpt分区表
-                                  "n", "", "", "", "+512M",  # 新建EFI分区/boot分区
-                                  "n", "", "", "", f"+{self.cfg.swap_size}G",  # swap分区
-                                  "n", "", "", "", "",  # 根分区
-                                  "w"  # 写入
-                                  )
-            run_cmd(part+self.cfg.install_disk)
-            # 格式化
-            run_cmd(f"mkfs.vfat {self.cfg.install_disk}1")
-            run_cmd(f"mkswap {self.cfg.install_disk}2")
-            run_cmd(f"mkfs.ext4 {self.cfg.install_disk}3")
-            # 挂载
-            run_cmd(f"mount {self.cfg.install_disk}3 /mnt")
-            run_cmd("mkdir -p /mnt/boot/EFI")
-            run_cmd(f"mount {self.cfg.install_disk}1 /mnt/boot/EFI")
-            run_cmd(f"swapon {self.cfg.install_disk}2")
-        elif self.cfg.boot == BIOS:
-            part = disk_partition("d", "", "d", "", "d", "", "d", "", "d", "", "d", "", "d", "",  # 删除现有分区
-                                  "o",  # 新建mbr分区表
-                                  "n", "", "", "", "+512M",  # 新建EFI分区/boot分区
-                                  "n", "", "", "", f"+{self.cfg.swap_size}G",  # swap分区
-                                  "n", "", "", "", "",  # 根分区
-                                  "w"  # 写入
-                                  )
-            run_cmd(part+self.cfg.install_disk)
-            # 格式化
-            run_cmd(f"mkfs.ext2 {self.cfg.install_disk}1")
-            run_cmd(f"mkswap {self.cfg.install_disk}2")
-            run_cmd(f"mkfs.ext4 {self.cfg.install_disk}3")
-            # 挂载
-            run_cmd(f"mount {self.cfg.install_disk}3 /mnt")
-            run_cmd("mkdir -p /mnt/boot")
-            run_cmd(f"mount {self.cfg.install_disk}1 /mnt/boot")
-            run_cmd(f"swapon {self.cfg.install_disk}2")
-        else:
+        if self.cfg.boot not in (UEFI, BIOS):
             print("{}".format(apply_red(f"unsupported boot {self.cfg.boot}")))
             sys.exit(0)
 
+        self.layout.apply()
+        # 格式化
+        for p in self.layout.partitions:
+            if p.role == ESP:
+                run_cmd(f"mkfs.vfat -F 32 {p.device}")
+            elif p.role == BOOT:
+                run_cmd(f"mkfs.ext2 -F {p.device}")
+            elif p.role == SWAP:
+                run_cmd(f"mkswap {p.device}")
+            elif p.role == BIOS_BOOT:
+                continue  # grub-install直接写入, 不需要文件系统
+            else:
+                run_cmd(f"{self.fs.mkfs} {p.device}")
+        self.create_subvolumes()
+        self.mount_target()
+
+    def subvolumes(self) -> dict:
+        """单独的home分区时不再建@home子卷, swapfile放在单独的@swap子卷里(不会被快照)"""
+        subvolumes = {sv: mp for sv, mp in self.fs.subvolumes.items()
+                      if not (mp == "/home" and self.layout.part(HOME) is not None)}
+        if subvolumes and self.cfg.swap_mode == SWAP_FILE:
+            subvolumes["@swap"] = "/swap"
+        return subvolumes
+
+    @property
+    def swapfile(self) -> str:
+        """swapfile在目标系统中的路径"""
+        return "/swap/swapfile" if "@swap" in self.subvolumes() else "/swapfile"
+
+    def create_subvolumes(self):
+        if len(self.subvolumes()) == 0:
+            return
+        root = self.layout.part(ROOT).device
+        os.makedirs(self.root, exist_ok=True)
+        run_cmd(f"mount {root} {self.root}")
+        for sv in self.subvolumes():
+            run_cmd(f"btrfs subvolume create {self.root}/{sv}")
+        run_cmd(f"umount {self.root}")
+
+    def target_mounts(self) -> list:
+        """(设备, 挂载点, 挂载参数), 按挂载顺序"""
+        mounts = []
+        root = self.layout.part(ROOT).device
+        subvolumes = sorted(self.subvolumes().items(), key=lambda kv: len(kv[1]))
+        if subvolumes:
+            for sv, mp in subvolumes:
+                mounts.append((root, self.root + mp.rstrip("/"), f"{self.fs_options},subvol={sv}"))
+        else:
+            mounts.append((root, self.root, self.fs_options))
+        for role, mp in ((BOOT, self.target("boot")), (ESP, self.target(self.loader.esp))):
+            if self.layout.part(role) is not None:
+                mounts.append((self.layout.part(role).device, mp, None))
+        if self.layout.part(HOME) is not None:
+            mounts.append((self.layout.part(HOME).device, self.target("home"), self.fs_options))
+        return mounts
+
+    def mount_target(self):
+        """挂载分区, 已经挂载的跳过(断点续装时重新挂载)"""
+        for device, mp, opts in self.target_mounts():
+            if os.path.ismount(mp):
+                continue
+            run_cmd(f"mkdir -p {mp}")
+            run_cmd(f"mount -o {opts} {device} {mp}" if opts else f"mount {device} {mp}")
+        if self.layout.part(SWAP) is not None:
+            run_cmd(f"swapon {self.layout.part(SWAP).device}", exit_=False)
+
+    def write_pacman_conf(self) -> str:
+        """生成安装用的pacman.conf, 包缓存直接放在目标盘上并复用live环境已有的缓存"""
+        target_cache = self.target(HOST_PKG_CACHE)
+        os.makedirs(target_cache, exist_ok=True)
+        with open(PACMAN_CONF) as f:
+            text = f.read()
+
+        # pacman下载到第一个可写的CacheDir, live环境的缓存在内存里, 所以目标盘放前面
+        cache_dirs = [target_cache, HOST_PKG_CACHE]
+        if self.shared is not None and self.shared.dir not in (None, target_cache):
+            cache_dirs.insert(1, self.shared.dir)
+        mirrorlist = None
+        if self.cache is not None and not self.cache.remote:
+            # 共享目录可写时让未命中的包直接下载进去, 下一台机器就能命中
+            if os.access(self.cache.source, os.W_OK):
+                cache_dirs.insert(0, self.cache.source)
+            else:
+                cache_dirs.insert(1, self.cache.source)
+        elif self.cache is not None:
+            mirrorlist = per_target(INSTALL_MIRRORLIST, self.root)
+            os.makedirs(os.path.dirname(mirrorlist), exist_ok=True)
+            with open(MIRRORLIST) as f:
+                servers = f.read()
+            with open(mirrorlist, "w") as f:
+                f.write(f"Server = {self.cache.server()}\n" + servers)
+        self.download_cache = cache_dirs[0]
+
+        parallel = parallel_downloads_for(self.mirrors) if self.parallel_download else None
+        conf = per_target(INSTALL_PACMAN_CONF, self.root)
+        os.makedirs(os.path.dirname(conf), exist_ok=True)
+        with open(conf, "w") as f:
+            f.write(tune_pacman_conf(text, parallel, cache_dirs, mirrorlist))
+        print("{} {}".format(apply_cyan("[CONF]"), apply_yellow(f"{conf} ParallelDownloads={parallel}")))
+        return conf
+
     def download_linux(self):
-        packages = " ".join(self.cfg.packages)
-        run_cmd("pacstrap /mnt " + packages, stdout=True)
+        if not self.parallel_download and self.cache is None and self.shared is None:
+            packages = " ".join(self.cfg.packages)
+            run_cmd(f"pacstrap {self.root} " + packages, stdout=True)
+            return
 
-    @staticmethod
-    def gen_fstab():
-        """生成fstab文件"""
-        run_cmd("genfstab -U /mnt >> /mnt/etc/fstab")
+        conf = self.write_pacman_conf()
+        if self.shared is not None and self.shared.dir is None:
+            self.shared.fetch(self, conf)
+            conf = self.write_pacman_conf()  # 别的目标下载的缓存要加进CacheDir
+        if self.cache is not None:
+            self.cache.scan()
+        groups = self.cfg.package_groups.items() if self.parallel_download else [("all", self.cfg.packages)]
+        progress.expect_transactions("download_linux", len(groups))
+        for group, pkgs in groups:
+            before = dir_size(self.download_cache)
+            start = time.monotonic()
+            # -c: 使用配置文件里的CacheDir而不是目标盘默认路径
+            run_cmd(f"pacstrap -c -C {conf} {self.root} " + " ".join(pkgs), stdout=True)
+            self.download_stats.append(
+                DownloadStat(group, len(pkgs), dir_size(self.download_cache) - before, time.monotonic() - start))
+        if self.cache is not None:
+            self.cache.account(read_local_db(self.root))
+        if self.shared is not None and self.shared.owner != self.root:
+            self.shared.release(self)
+
+    def print_fs_throughput(self):
+        """pacstrap阶段写入目标盘的速度, 用于比较不同文件系统配置"""
+        for e in tracer.events:
+            if e["cat"] == "step" and e["name"] == self.step_label("download_linux") and e["dur"] > 0:
+                written = e["args"].get("disk_written", 0)
+                print("{}: {}".format(apply_blue(f"FILESYSTEM {self.fs.name}"), apply_green(
+                    f"pacstrap wrote {written / 1024 / 1024:.1f}MiB at "
+                    f"{written / 1024 / 1024 / (e['dur'] / 1e6):.2f}MiB/s ({self.fs_options})")))
+
+    def print_summary(self):
+        """安装结束后的汇总"""
+        self.print_download_stats()
+        for st in self.stream_stats:
+            print_stream_stat(st)
+        self.print_fs_throughput()
+        if self.cache is not None:
+            self.cache.print_stat()
+        print("{}".format(apply_yellow("========= slowest steps ============")))
+        tracer.print_summary()
+
+    def print_download_stats(self):
+        for st in self.download_stats:
+            print("{}: {}".format(apply_blue(f"DOWNLOAD {self.step_label(st.group)}"),
+                                  apply_green(f"{st.size / 1024 / 1024:.1f}MiB in {st.seconds:.1f}s "
+                                              f"({st.speed / 1024 / 1024:.2f}MiB/s)")))
+
+    def gen_fstab(self):
+        """生成fstab文件, 根分区和home的挂载参数与文件系统配置保持一致"""
+        fstab = run_cmd(f"genfstab -U {self.root}")
+        targets = {mp[len(self.root):] or "/": opts for _, mp, opts in self.target_mounts() if opts}
+        # genfstab会列出live环境里所有启用的swap, 多盘安装时包括其他目标盘的swap分区
+        swap = self.layout.part(SWAP)
+        own_swap = {swap.device, f"UUID={run_cmd(f'blkid -s UUID -o value {swap.device}')}"} if swap else set()
+        lines = []
+        for line in fstab.splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and not line.startswith("#") and fields[2] == "swap" and fields[0] not in own_swap:
+                if lines and lines[-1].startswith("# /dev/"):
+                    lines.pop()  # genfstab在每一项前面写的设备名注释
+                continue
+            if len(fields) >= 4 and not line.startswith("#") and fields[1] in targets:
+                subvol = [o for o in fields[3].split(",") if o.startswith("subvol=")]
+                opts = [o for o in targets[fields[1]].split(",") if not o.startswith("subvol=")]
+                fields[3] = ",".join(["rw"] + opts + subvol)
+                line = "\t".join(fields)
+            lines.append(line)
+        if self.cfg.swap_mode == SWAP_FILE:
+            lines.append(f"{self.swapfile}\tnone\tswap\tdefaults\t0 0")
+        edit_file(self.target("etc/fstab"), replace_with("\n".join(lines) + "\n"))
+
+    def resume_params(self) -> list:
+        """休眠恢复需要的内核参数"""
+        if self.cfg.swap_mode == SWAP_PARTITION:
+            return [f"resume=UUID={run_cmd(f'blkid -s UUID -o value {self.layout.part(SWAP).device}')}"]
+        root_uuid = run_cmd(f"blkid -s UUID -o value {self.layout.part(ROOT).device}")
+        if self.fs.name == "btrfs":
+            offset = run_cmd(f"btrfs inspect-internal map-swapfile -r {self.root}{self.swapfile}")
+        else:
+            # filefrag第一段的物理起始块: ' 0: 0.. 0: 34816.. 34816: ...'
+            offset = "0"
+            for line in run_cmd(f"filefrag -v {self.root}{self.swapfile}").splitlines():
+                fields = line.split()
+                if fields and fields[0] == "0:":
+                    offset = fields[3].rstrip(".:")
+                    break
+        return [f"resume=UUID={root_uuid}", f"resume_offset={offset}"]
+
+    def set_swap(self):
+        """创建swapfile/zram配置, 需要时写入休眠恢复参数"""
+        mode = self.cfg.swap_mode
+        if mode == SWAP_ZRAM:
+            edit_file(self.target("etc/systemd/zram-generator.conf"), replace_with(zram_generator_conf(self.cfg.swap_size)))
+            edit_file(self.target("etc/sysctl.d/99-vm-zram-parameters.conf"), replace_with(zram_sysctl))
+        elif mode == SWAP_FILE and not os.path.exists(self.target(self.swapfile)):
+            if self.fs.name == "btrfs":
+                run_cmd(f"btrfs filesystem mkswapfile --size {self.cfg.swap_size}g {self.root}{self.swapfile}")
+            else:
+                run_cmd(f"mkswap -U clear --size {self.cfg.swap_size}G --file {self.root}{self.swapfile}")
 
-    @staticmethod
-    def set_timezone():
+        if not self.cfg.hibernate or mode not in (SWAP_FILE, SWAP_PARTITION):
+            return
+        self.set_kernel_params(self.resume_params())
+        edit_file(self.target("etc/mkinitcpio.conf"), add_resume_hook)  # 由set_initramfs重新生成
+
+    def set_timezone(self):
         """设置时区"""
-        run_cmd_chroot("ln -sf /usr/share/zoneinfo/Asia/Shanghai /etc/localtime")
-        run_cmd_chroot("hwclock --systohc")
+        with ChrootSession(self.root, name="set_timezone") as chroot:
+            chroot.add("ln -sf /usr/share/zoneinfo/Asia/Shanghai /etc/localtime")
+            chroot.add("hwclock --systohc")
 
-    @staticmethod
-    def set_locale():
+    def set_locale(self):
         """本地化设置"""
-        run_cmd_chroot("sed -in-place -e 's/#zh_CN.UTF-8 UTF-8/zh_CN.UTF-8 UTF-8/g' /etc/locale.gen")
-        run_cmd_chroot("sed -in-place -e 's/#en_US.UTF-8 UTF-8/en_US.UTF-8 UTF-8/g' /etc/locale.gen")
-        run_cmd_chroot("locale-gen", stdout=True)
-        run_cmd_chroot('echo "LANG=en_US.UTF-8" > /etc/locale.conf')
+        edit_file(self.target("etc/locale.gen"), lambda text: uncomment(text, ["zh_CN.UTF-8 UTF-8", "en_US.UTF-8 UTF-8"]))
+        edit_file(self.target("etc/locale.conf"), replace_with("LANG=en_US.UTF-8\n"))
+        with ChrootSession(self.root, name="set_locale") as chroot:
+            chroot.add("locale-gen")
 
     def set_hostname(self):
         """设置hostname"""
-        run_cmd_chroot(f'echo "{self.cfg.hostname}" > /etc/hostname')
-        run_cmd_chroot('''tee /etc/hosts <<-'EOF'\n127.0.0.1	localhost\n::1		localhost\nEOF''')
+        edit_file(self.target("etc/hostname"), replace_with(f"{self.cfg.hostname}\n"))
+        edit_file(self.target("etc/hosts"), lambda text: prepend_lines(text, ["127.0.0.1\tlocalhost", "::1\t\tlocalhost"]))
 
     def set_network(self):
         """网络设置"""
-        run_cmd_chroot("systemctl enable dhcpcd")
-        if self.cfg.desktop != NODESKTOP:
-            run_cmd_chroot("systemctl enable NetworkManager")
+        with ChrootSession(self.root, name="set_network") as chroot:
+            chroot.add("systemctl enable dhcpcd")
+            if self.cfg.desktop != NODESKTOP:
+                chroot.add("systemctl enable NetworkManager")
 
     def set_user(self):
         """用户设置"""
-        run_cmd_chroot(f"sh -c \"echo 'root:{self.cfg.root_passwd}' | chpasswd\"")
-
+        # 放在sudoers.d里而不是改/etc/sudoers, 重复执行也只有一份
+        edit_file(self.target("etc/sudoers.d/10-wheel"), replace_with("%wheel ALL=(ALL:ALL) ALL\n"), mode=0o440)
         for u in self.cfg.common_users:
-            run_cmd_chroot(f"useradd -m -G wheel -s /bin/{u.shell} {u.name}")
-            run_cmd_chroot(f"sh -c \"echo '{u.name}:{u.passwd}' | chpasswd\"")
+            if u.sudo == "nopasswd":
+                edit_file(self.target(f"etc/sudoers.d/20-{u.name}"),
+                          replace_with(f"{u.name} ALL=(ALL:ALL) NOPASSWD: ALL\n"), mode=0o440)
+
+        # 所有账号在一次chroot里完成, 密码只以哈希的形式通过chpasswd -e的stdin传入
+        accounts = [("root", hash_password(self.cfg.root_passwd))]
+        accounts += [(u.name, u.password_hash) for u in self.cfg.common_users]
+        groups = sorted({g for u in self.cfg.common_users for g in u.groups})
+        with ChrootSession(self.root, name="set_user") as chroot:
+            if groups:
+                chroot.add(" && ".join(f"{{ getent group {g} >/dev/null || groupadd {g}; }}" for g in groups),
+                           label=f"groupadd {' '.join(groups)}")
+            for u in self.cfg.common_users:
+                # 从镜像恢复时用户可能已经存在
+                opts = f"-G {','.join(u.groups)} -s /bin/{u.shell}" if u.groups else f"-s /bin/{u.shell}"
+                chroot.add(f"if id -u {u.name} >/dev/null 2>&1; then usermod {'-a ' if u.groups else ''}{opts} "
+                           f"{u.name}; else useradd -m {opts} {u.name}; fi")
+            lines = "\n".join(f"{name}:{h}" for name, h in accounts)
+            chroot.add(f"chpasswd -e <<'__PASSWD__'\n{lines}\n__PASSWD__",
+                       label=f"chpasswd -e <{len(accounts)} accounts>")
+            chroot.add("visudo -c >/dev/null")
+
+    def build_initramfs(self, label: str) -> InitramfsStat:
+        with ChrootSession(self.root, name="set_initramfs") as chroot:
+            chroot.add("mkinitcpio -P")
+        return InitramfsStat(label, chroot.results[0].seconds, initramfs_images(self.root))
+
+    def set_initramfs(self):
+        """按配置重新生成initramfs: host-only只带本机存储和文件系统驱动, 可选压缩方式, 可以不要fallback镜像;
+        有改动时和已有的镜像(pacstrap或镜像里带的)比较大小, initramfs_compare时再按原配置构建一次比较构建耗时;
+        UKI也在这里生成, 整个安装只构建一次"""
+        cfg = self.cfg
+        tuned = cfg.initramfs == INITRAMFS_HOSTONLY or cfg.initramfs_compression != "default" or not cfg.initramfs_fallback
+        resume = cfg.hibernate and cfg.swap_mode in (SWAP_FILE, SWAP_PARTITION)
+        uki = self.loader.name == BOOT_UKI
+        if not tuned and not resume and not self.image and not uki:
+            return  # pacstrap生成的initramfs可以直接用
+        before = None
+        if tuned and cfg.initramfs_compare:
+            before = self.build_initramfs("generic")
+        elif tuned:
+            before = InitramfsStat("image" if self.image else "generic", None, initramfs_images(self.root))
+
+        conf = self.target("etc/mkinitcpio.conf")
+        generic = self.target(MKINITCPIO_GENERIC)
+        if self.image and os.path.exists(generic):
+            # 镜像可能是host-only安装做的, MODULES和HOOKS只适合制作镜像的那台机器
+            with open(generic) as f:
+                text = f.read()
+            edit_file(conf, replace_with(add_resume_hook(text) if resume else text))
+        modules = []
+        if cfg.initramfs == INITRAMFS_HOSTONLY:
+            modules = hostonly_modules(self.name, self.fs.name)
+            if not modules:
+                print("{}".format(apply_yellow(f"no storage driver found for {self.name}, keeping the generic hooks")))
+            elif not os.path.exists(generic):
+                with open(conf) as f:
+                    edit_file(generic, replace_with(f.read()))
+        edit_file(conf, lambda text: tune_mkinitcpio(text, modules, cfg.initramfs_compression))
+        if not cfg.initramfs_fallback:
+            presets = self.target("etc/mkinitcpio.d")
+            for f in sorted(os.listdir(presets)):
+                if f.endswith(".preset"):
+                    edit_file(os.path.join(presets, f), drop_fallback_preset)
+            for path in initramfs_images(self.root):
+                if "-fallback." in path:
+                    os.remove(self.target(path))
+        if uki:
+            self.prepare_uki()
+
+        after = self.build_initramfs(INITRAMFS_HOSTONLY if modules else INITRAMFS_GENERIC)
+        print_initramfs_stat(before, after)
+
+    def set_kernel_params(self, params: list):
+        """内核参数写到引导方式对应的位置, 同名参数被替换"""
+        if self.loader.name == BOOT_GRUB:
+            edit_file(self.target(self.loader.params_file), lambda text: add_kernel_params(text, params))
+        else:
+            edit_file(self.target(self.loader.params_file), lambda text: add_cmdline_params(text, params))
+
+    def root_params(self) -> list:
+        """systemd-boot/UKI没有grub-mkconfig那样的探测, 根分区要自己写进命令行"""
+        params = [f"root=UUID={run_cmd(f'blkid -s UUID -o value {self.layout.part(ROOT).device}')}", "rw"]
+        root_sv = [sv for sv, mp in self.subvolumes().items() if mp == "/"]
+        if root_sv:
+            params.append(f"rootflags=subvol={root_sv[0]}")
+        return params
 
-        run_cmd_chroot("sed -in-place -e 's/# %wheel ALL=(ALL:ALL) ALL/%wheel ALL=(ALL:ALL) ALL/g' /etc/sudoers")
+    def kernels(self) -> list:
+        """/boot里的内核, vmlinuz-linux -> linux"""
+        return sorted(f[len("vmlinuz-"):] for f in os.listdir(self.target("boot")) if f.startswith("vmlinuz-"))
 
-    def set_grub(self):
+    def set_bootloader(self):
         """引导设置"""
-        if self.cfg.boot == UEFI:
-            run_cmd_chroot("grub-install --target=x86_64-efi --efi-directory=/boot/EFI --bootloader-id=GRUB", stdout=True)
-            run_cmd_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
-        elif self.cfg.boot == BIOS:
-            run_cmd_chroot(f"grub-install {self.cfg.install_disk}", stdout=True)
-            run_cmd_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
+        getattr(self, self.loader.install)()
+
+    def install_grub(self):
+        with ChrootSession(self.root, name="set_bootloader") as chroot:
+            if self.cfg.boot == UEFI:
+                chroot.add(f"grub-install --target=x86_64-efi --efi-directory=/{self.loader.esp} --bootloader-id=GRUB")
+            elif self.cfg.boot == BIOS:
+                chroot.add(f"grub-install {self.cfg.install_disk}")
+            chroot.add("grub-mkconfig -o /boot/grub/grub.cfg")
+
+    def install_systemd_boot(self):
+        """启动项直接写文件, 不需要像grub-mkconfig那样探测所有磁盘"""
+        self.set_kernel_params(self.root_params())
+        with open(self.target(self.loader.params_file)) as f:
+            options = f.read().strip()
+        ucode = sorted(f for f in os.listdir(self.target("boot")) if fnmatch.fnmatch(f, "*-ucode.img"))
+        kernels = self.kernels()
+        for k in kernels:
+            edit_file(self.target(f"boot/loader/entries/arch-{k}.conf"), replace_with(
+                loader_entry(f"Arch Linux ({k})", f"vmlinuz-{k}", ucode + [f"initramfs-{k}.img"], options)))
+            if os.path.exists(self.target(f"boot/initramfs-{k}-fallback.img")):
+                edit_file(self.target(f"boot/loader/entries/arch-{k}-fallback.conf"), replace_with(
+                    loader_entry(f"Arch Linux ({k}, fallback)", f"vmlinuz-{k}", ucode + [f"initramfs-{k}-fallback.img"],
+                                 options)))
+        edit_file(self.target("boot/loader/loader.conf"), replace_with(loader_conf(f"arch-{kernels[0]}.conf")))
+        with ChrootSession(self.root, name="set_bootloader") as chroot:
+            chroot.add("bootctl install --esp-path=/boot")
+            chroot.add("systemctl enable systemd-boot-update.service")
+
+    def prepare_uki(self):
+        """set_initramfs构建之前调用: UKI里打包了内核命令行, 参数要先写好; 预设改为生成UKI"""
+        self.set_kernel_params(self.root_params())
+        presets = self.target("etc/mkinitcpio.d")
+        for f in sorted(os.listdir(presets)):
+            if f.endswith(".preset"):
+                edit_file(os.path.join(presets, f), lambda text: uki_preset(text, "/" + self.loader.esp))
+        os.makedirs(self.target("boot/EFI/Linux"), exist_ok=True)
+        for path in initramfs_images(self.root):
+            if path.endswith(".img"):
+                os.remove(self.target(path))  # 已经打包进UKI, 留着只占ESP空间
+
+    def install_uki(self):
+        """UKI已由set_initramfs放到ESP/EFI/Linux, systemd-boot自动发现, 固件到内核只经过一次加载"""
+        edit_file(self.target("boot/loader/loader.conf"), replace_with(loader_conf(f"arch-{self.kernels()[0]}.efi")))
+        with ChrootSession(self.root, name="set_bootloader") as chroot:
+            chroot.add("bootctl install --esp-path=/boot")
+            chroot.add("systemctl enable systemd-boot-update.service")
+
+    def set_boot_measure(self):
+        """首次开机后把systemd-analyze的结果写到BOOT_TIME_FILE, 用来比较不同引导方式"""
+        for path, text in boot_time_units(self.cfg.bootloader).items():
+            edit_file(self.target(path), replace_with(text))
+        os.makedirs(self.target(os.path.dirname(BOOT_TIME_FILE)), exist_ok=True)
 
     def set_desktop(self):
         """设置桌面环境"""
         if self.cfg.desktop == NODESKTOP:
             return
 
-        run_cmd_chroot(f"sh -c \"echo 'LANG=zh_CN.UTF-8' > /etc/locale.conf\"")
-        if self.cfg.desktop == GNOME_DESKTOP:
-            run_cmd_chroot("systemctl enable gdm")
-        elif self.cfg.desktop == PLASMA_DESKTOP:
-            run_cmd_chroot("systemctl enable sddm")
+        edit_file(self.target("etc/locale.conf"), replace_with("LANG=zh_CN.UTF-8\n"))
+        with ChrootSession(self.root, name="set_desktop") as chroot:
+            if self.cfg.desktop == GNOME_DESKTOP:
+                chroot.add("systemctl enable gdm")
+            elif self.cfg.desktop == PLASMA_DESKTOP:
+                chroot.add("systemctl enable sddm")
 
-    @staticmethod
-    def finish():
+    def finish(self):
         """一些收尾工作"""
-        run_cmd_chroot("systemctl enable sshd")
-        run_cmd("umount -R /mnt")
+        disk = find_disk(self.cfg.install_disk)
+        with ChrootSession(self.root, name="finish") as chroot:
+            chroot.add("systemctl enable sshd")
+            if disk is not None and disk.discard and "discard" not in self.fs_options:
+                chroot.add("systemctl enable fstrim.timer")  # 没有在线discard的SSD定期trim
+            if self.cfg.measure_boot:
+                self.set_boot_measure()
+                chroot.add(f"systemctl enable {BOOT_TIME_UNIT}.timer")
+        self.journal.remove_target()
+        if self.make_image:
+            self.capture_image()
+        if self.shared is not None:
+            self.shared.wait(self)
+        run_cmd(f"umount -R {self.root}")
+
+    def capture_image(self):
+        """把装好的根目录(包括/boot和/home等挂载点)以tar+zstd流的形式写成镜像, 附带一个.json说明文件"""
+        excludes = " ".join(f"--exclude='{e}'" for e in IMAGE_EXCLUDES)
+        os.makedirs(os.path.dirname(os.path.abspath(self.make_image)), exist_ok=True)
+        st = run_pipe(f"tar --xattrs --xattrs-include='*' --acls {excludes} -C {self.root} -cpf - .",
+                      f"zstd -T0 -{IMAGE_ZSTD_LEVEL} -q -f -o {self.make_image}", "capture_image")
+        self.stream_stats.append(st)
+        meta = {"format": "tar.zst", "created": time.time(), "size": st.size, "boot": self.cfg.boot,
+                "filesystem": self.cfg.filesystem, "desktop": self.cfg.desktop, "packages": self.cfg.packages}
+        with open(self.make_image + ".json", "w") as f:
+            json.dump(meta, f, indent=2)
+        print_stream_stat(st, os.path.getsize(self.make_image))
+
+    def restore_image(self):
+        """把镜像边下载边解压写到新分好区的目标盘上, 引导方式在preflight_image里已经检查过"""
+        # systemd-boot/UKI把vfat的ESP挂在/boot, 在上面设置属主/权限/xattr会失败导致tar退出码非0;
+        # 先把/boot解压到根文件系统上, 再不带属性复制过去, initramfs和启动项由后面的步骤重新生成
+        vfat_boot = self.loader.esp == "boot"
+        transform = f" --transform='s,^\\./boot\\(/\\|$\\),./{IMAGE_BOOT_STAGING}\\1,'" if vfat_boot else ""
+        st = run_pipe(image_source(self.image),
+                      f"tar --xattrs --xattrs-include='*' --acls --numeric-owner{transform} -C {self.root} -xpf -",
+                      f"restore_image:{self.name}" if self.root != MOUNT_ROOT else "restore_image")
+        self.stream_stats.append(st)
+        print_stream_stat(st)
+        staging = self.target(IMAGE_BOOT_STAGING)
+        if vfat_boot and os.path.isdir(staging):
+            run_cmd(f"cp -r --no-preserve=mode,ownership,timestamps {staging}/. {self.target('boot')}/")
+            run_cmd(f"rm -rf {staging}")
+
+    def set_machine(self):
+        """镜像里去掉的每台机器独有的东西: machine-id, ssh主机密钥; initramfs由set_initramfs按本机硬件重新生成"""
+        with ChrootSession(self.root, name="set_machine") as chroot:
+            chroot.add("rm -f /etc/machine-id && systemd-machine-id-setup")
+            chroot.add("ssh-keygen -A")
+
+
+# =================================== step scheduler ===================================
+
+class Step:
+    def __init__(self, name: str, deps: list = None, estimate: float = 1.0):
+        self.name = name  # Installation的方法名
+        self.deps = deps or []
+        self.estimate = estimate  # 预估耗时, 秒
+
+
+install_steps = [
+    Step("set_mirror", [], 15),
+    Step("install_keyring", ["set_mirror"], 20),
+    Step("update_time", [], 1),
+    Step("disk_part", [], 10),
+    Step("download_linux", ["install_keyring", "disk_part"], 900),
+    Step("gen_fstab", ["download_linux"], 1),
+    Step("set_timezone", ["download_linux"], 2),
+    Step("set_locale", ["download_linux"], 20),
+    Step("set_hostname", ["download_linux"], 2),
+    Step("set_network", ["download_linux"], 2),
+    Step("set_user", ["download_linux"], 5),
+    Step("set_swap", ["gen_fstab"], 2),
+    Step("set_initramfs", ["set_swap"], 30),  # resume钩子由set_swap写入
+    Step("set_bootloader", ["set_initramfs"], 15),  # 休眠恢复参数要在写入启动项之前准备好
+    Step("set_desktop", ["set_locale"], 2),  # 会覆盖set_locale写的locale.conf
+    Step("finish", ["gen_fstab", "set_timezone", "set_hostname", "set_network", "set_user", "set_bootloader",
+                    "set_desktop", "update_time"], 3),
+]
+
+# 从镜像安装: 只做每台机器不同的部分
+image_steps = [
+    Step("update_time", [], 1),
+    Step("disk_part", [], 10),
+    Step("restore_image", ["disk_part"], 120),
+    Step("gen_fstab", ["restore_image"], 1),
+    Step("set_hostname", ["restore_image"], 2),
+    Step("set_user", ["restore_image"], 5),
+    Step("set_machine", ["restore_image"], 20),
+    Step("set_swap", ["gen_fstab", "set_machine"], 2),
+    Step("set_initramfs", ["set_swap"], 30),
+    Step("set_bootloader", ["set_initramfs"], 15),
+    Step("finish", ["set_hostname", "set_user", "set_bootloader", "update_time"], 3),
+]
+
+
+def calibrated_steps(steps: list, history: StepHistory, variant=lambda name: None) -> list:
+    """用历史耗时的中位数代替写死的预估值, 没有历史记录的步骤保持不变"""
+    return [Step(s.name, s.deps, history.estimate(s.name, variant(s.name)) or s.estimate) for s in steps]
+
+
+class StepScheduler:
+    """按依赖关系调度安装步骤, 没有依赖关系的步骤在线程池里并发执行"""
+
+    def __init__(self, steps: list, workers: int = 4):
+        self.steps = {s.name: s for s in steps}
+        self.workers = max(1, workers)
+        self.order = self._topo_order()
+
+    def _topo_order(self) -> list:
+        order = []
+        state = {}  # name -> 1 访问中, 2 已完成
+
+        def visit(name, path):
+            if name not in self.steps:
+                raise ValueError(f"unknown step {name} required by {path[-1]}")
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise ValueError("dependency cycle: " + " -> ".join(path + [name]))
+            state[name] = 1
+            for d in self.steps[name].deps:
+                visit(d, path + [name])
+            state[name] = 2
+            order.append(name)
+
+        for name in self.steps:
+            visit(name, [])
+        return order
+
+    def critical_path(self) -> tuple:
+        """返回(最长路径上的步骤, 路径总耗时)"""
+        finish = {}
+        prev = {}
+        for name in self.order:
+            step = self.steps[name]
+            start = 0
+            for d in step.deps:
+                if finish[d] > start:
+                    start = finish[d]
+                    prev[name] = d
+            finish[name] = start + step.estimate
+        last = max(finish, key=finish.get)
+        path = [last]
+        while path[-1] in prev:
+            path.append(prev[path[-1]])
+        return list(reversed(path)), finish[last]
+
+    def simulate(self) -> float:
+        """用预估耗时模拟有限线程下的总耗时"""
+        done = {}
+        running = []  # (结束时间, name)
+        pending = list(self.order)
+        now = 0.0
+        while pending or running:
+            ready = [n for n in pending if all(d in done for d in self.steps[n].deps)]
+            while ready and len(running) < self.workers:
+                n = ready.pop(0)
+                pending.remove(n)
+                running.append((now + self.steps[n].estimate, n))
+            running.sort()
+            now, n = running.pop(0)
+            done[n] = now
+        return now
+
+    def print_plan(self):
+        for name in self.order:
+            step = self.steps[name]
+            deps = ", ".join(step.deps) if step.deps else "-"
+            print("{} {} {}".format(apply_cyan(f"{name:<16}"), apply_yellow(f"~{step.estimate:>5.0f}s"), deps))
+        path, length = self.critical_path()
+        serial = sum(s.estimate for s in self.steps.values())
+        parallel = self.simulate()
+        print("{}: {}".format(apply_blue("CRITICAL PATH"), apply_green(" -> ".join(path) + f" ({length:.0f}s)")))
+        print("{}: {}".format(apply_blue("EXPECTED"), apply_green(
+            f"serial {serial:.0f}s, {self.workers} jobs {parallel:.0f}s, speedup {serial / parallel:.2f}x")))
+
+    def run(self, runner, label=str):
+        """runner(name)执行单个步骤; 任一步骤失败后不再启动新步骤, 等待已启动的结束后抛出;
+        Ctrl-C时终止正在运行的命令, 不等已启动的步骤结束"""
+        done = set()
+        pending = list(self.order)
+        running = {}  # future -> name
+        error = None
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while pending or running:
+                if error is None:
+                    for n in [n for n in pending if all(d in done for d in self.steps[n].deps)]:
+                        if len(running) >= self.workers:
+                            break
+                        pending.remove(n)
+                        print("{} {}".format(apply_purple("[STEP]"), apply_yellow(label(n))))
+                        running[pool.submit(runner, n)] = n
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    n = running.pop(f)
+                    if f.exception() is not None:
+                        if error is None:
+                            error = f.exception()
+                        print("{}".format(apply_red(f"STEP FAILED: {label(n)}")))
+                    else:
+                        done.add(n)
+        except KeyboardInterrupt:
+            terminate_running()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+        if error is not None:
+            raise error
+
+
+# =================================== multi-disk install ===============================
+
+host_steps = ["set_mirror", "install_keyring", "update_time"]  # 只改live环境, 多盘安装时只做一次
+
+
+def target_steps(steps: list) -> list:
+    """去掉只针对live环境的步骤, 剩下的每个目标盘各跑一遍"""
+    return [Step(s.name, [d for d in s.deps if d not in host_steps], s.estimate)
+            for s in steps if s.name not in host_steps]
+
+
+def resolve_targets(specs: list) -> list:
+    """--target参数转成磁盘路径: /dev/xxx直接使用(包括loop设备), 其他按磁盘选择规则匹配所有符合的盘"""
+    disks = []
+    for spec in specs:
+        if spec.startswith("/dev/") and "," not in spec:
+            matched = [spec]
+        else:
+            matched = [d.path for d in select_disks(hardware().disks, spec)]
+        for path in matched:
+            if path not in disks:
+                disks.append(path)
+    return disks
+
+
+class TargetResult:
+    def __init__(self, install: Installation, seconds: float, error: BaseException = None):
+        self.name = install.name
+        self.disk = install.cfg.install_disk
+        self.root = install.root
+        self.filesystem = install.cfg.filesystem
+        self.steps_done = install.steps_done
+        self.failed = install.failed
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def describe(self) -> str:
+        if self.ok:
+            return "OK"
+        if isinstance(self.error, SystemExit):
+            return f"FAILED at {self.failed} (exit {self.error.code})"
+        return f"FAILED at {self.failed} ({self.error!r})"
+
+
+class MultiInstall:
+    """从同一个live环境同时安装到多块盘, 每块盘挂在MOUNT_ROOT/<磁盘名>, 软件包只下载一次"""
+
+    def __init__(self, cfg: Config, jobs: int = 4, parallel_download: bool = False, cache: PackageCache = None,
+                 resume: bool = False, steps: list = None, image: str = None):
+        self.shared = SharedDownload(len(cfg.targets) if image is None else 0)
+        self.installs = [Installation(cfg.for_disk(disk), parallel_download, cache, resume,
+                                      root=os.path.join(MOUNT_ROOT, os.path.basename(disk)), shared=self.shared,
+                                      image=image)
+                         for disk in cfg.targets]
+        self.jobs = jobs
+        self.steps = target_steps(steps or install_steps)
+        self.host_steps = [s.name for s in (steps or install_steps) if s.name in host_steps]
+        self.results = []  # TargetResult
+        self.stop = threading.Event()
+
+    def run_host_steps(self):
+        """镜像测速/keyring/时间同步只做一次, 测速结果给所有目标用"""
+        first = self.installs[0]
+        for name in self.host_steps:
+            with tracer.span(name, "step"):
+                getattr(first, name)()
+        for install in self.installs[1:]:
+            install.mirrors = first.mirrors
+
+    def run_target(self, install: Installation) -> TargetResult:
+        start = time.monotonic()
+        error = None
+        try:
+            install.start_journal()
+            StepScheduler(self.steps, self.jobs).run(install.run_step, install.step_label)
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:  # 某块盘失败(run_cmd会sys.exit)不影响其他盘
+            error = e
+        finally:
+            self.shared.release(install)
+        return TargetResult(install, time.monotonic() - start, error)
+
+    def progress(self):
+        """定时打印每块盘的进度"""
+        total = len(self.steps)
+        start = time.monotonic()
+        while not self.stop.wait(PROGRESS_INTERVAL):
+            elapsed = time.monotonic() - start
+            print("{}".format(apply_yellow(f"========= targets {elapsed / 60:.1f}min =========")))
+            for install in self.installs:
+                state = ", ".join(install.running) or ("failed " + install.failed if install.failed else "-")
+                print("{} {} {}".format(apply_blue(f"{install.name:<10}"),
+                                        apply_green(f"[{install.steps_done:>2}/{total}]"), apply_yellow(state)))
+
+    def run(self) -> list:
+        self.run_host_steps()
+        monitor = threading.Thread(target=self.progress, daemon=True)
+        monitor.start()
+        pool = ThreadPoolExecutor(max_workers=len(self.installs))
+        try:
+            self.results = list(pool.map(self.run_target, self.installs))
+        except KeyboardInterrupt:
+            terminate_running()  # 各目标盘的调度器不在主线程里, 收不到KeyboardInterrupt
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            self.stop.set()
+        pool.shutdown()
+        return self.results
+
+    def print_report(self):
+        print("{}".format(apply_yellow("========= targets ==================")))
+        for r in self.results:
+            color = apply_green if r.ok else apply_red
+            print("{} {}".format(apply_blue(f"{r.disk:<16}"), color(
+                f"{r.describe():<32} {r.filesystem:<6} {r.steps_done:>2}/{len(self.steps)} steps "
+                f"{r.seconds / 60:>6.1f}min")))
+        for install in self.installs:
+            install.print_download_stats()
+            for st in install.stream_stats:
+                print_stream_stat(st)
 
 
 # ======================================================================================
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Archlinux installation script")
+    parser.add_argument("--parallel-download", action="store_true",
+                        help="pacstrap with a tuned pacman.conf (ParallelDownloads, shared cache)")
+    parser.add_argument("--cache", metavar="DIR|URL",
+                        help="local package cache directory or LAN cache server, tried before the mirrors")
+    parser.add_argument("--serve-cache", metavar="DIR", help="serve a package directory to other machines and exit")
+    parser.add_argument("--port", type=int, default=CACHE_SERVE_PORT, help="port for --serve-cache")
+    parser.add_argument("--jobs", type=int, default=4, help="max installation steps running at the same time")
+    parser.add_argument("--dry-run", action="store_true", help="print the step plan and critical path, then exit")
+    parser.add_argument("--trace", default=TRACE_FILE, help="where to write the Chrome trace-event file")
+    parser.add_argument("--history", default=HISTORY_FILE,
+                        help="step duration history used for the progress bar and ETA (keep it on persistent storage)")
+    parser.add_argument("--resume", action="store_true", help="skip steps already completed by a previous run")
+    parser.add_argument("--config", metavar="FILE|URL",
+                        help="unattended install from a TOML/JSON config (default: archinstall.* kernel parameters)")
+    parser.add_argument("--make-image", metavar="FILE",
+                        help="after installing, save the root filesystem as a zstd-compressed golden image")
+    parser.add_argument("--from-image", metavar="FILE|URL",
+                        help="restore a golden image instead of pacstrap, then apply per-machine settings only")
+    parser.add_argument("--ignore-image-boot", action="store_true",
+                        help="restore a --from-image image even if it was built for the other boot mode (UEFI/BIOS)")
+    parser.add_argument("--target", action="append", default=[], metavar="DISK|SELECTOR",
+                        help="install onto several disks at once, e.g. --target /dev/loop0 --target hdd,fixed; "
+                             f"each disk is mounted at {MOUNT_ROOT}/<name> (loop devices need losetup -P)")
+    return parser.parse_args()
+
+
 def main():
-    cfg = Config()
+    args = parse_args()
+    if args.serve_cache:
+        serve_cache(args.serve_cache, args.port)
+        return
+
+    history = StepHistory(args.history)
+    steps = image_steps if args.from_image else install_steps
+    scheduler = StepScheduler(calibrated_steps(steps, history), args.jobs)
+    if args.dry_run:
+        scheduler.print_plan()
+        return
+
+    targets = resolve_targets(args.target)
+    if args.target and len(targets) == 0:
+        print("{}".format(apply_red("no disk matches --target")))
+        sys.exit(1)
+
+    cfg = Config(load_settings(args.config), targets)
     print("{}".format(apply_yellow("========= please check info ========")))
     cfg.print_info()
+    cache = PackageCache(args.cache) if args.cache else None
+    install = Installation(cfg, parallel_download=args.parallel_download, cache=cache, resume=args.resume,
+                           image=args.from_image, make_image=args.make_image, history=history)
+    if args.from_image:
+        install.preflight_image(args.ignore_image_boot)
+    else:
+        install.preflight()
     print("{}".format(apply_yellow("====================================")))
 
-    yn = read_str("ready to install [y/n]")
-    if yn.lower() != "y":
-        return
+    if not cfg.unattended:
+        yn = read_str("ready to install [y/n]")
+        if yn.lower() != "y":
+            return
 
-    install = Installation(cfg)
-
-    install.set_mirror()
-    install.install_keyring()
-    install.update_time()
-    install.disk_part()
-    install.download_linux()
-    install.gen_fstab()
-    install.set_timezone()
-    install.set_locale()
-    install.set_hostname()
-    install.set_network()
-    install.set_user()
-    install.set_grub()
-    install.set_desktop()
-    install.finish()
+    if len(targets) > 1:
+        multi = MultiInstall(cfg, args.jobs, args.parallel_download, cache, args.resume, steps, args.from_image)
+        try:
+            multi.run()
+        finally:
+            tracer.write(args.trace)
+            print("{} {}".format(apply_cyan("[TRACE]"), apply_yellow(args.trace)))
+        multi.print_report()
+        if cache is not None:
+            cache.print_stat()
+        sys.exit(0 if all(r.ok for r in multi.results) else 1)
+
+    tracer.disk = cfg.install_disk
+    install.start_journal()
+    scheduler = StepScheduler(calibrated_steps(steps, history, install.history_variant), args.jobs)
+    progress.setup(scheduler.steps.values(), scheduler.simulate())
+    progress.show()
+    try:
+        scheduler.run(install.run_step)  # Ctrl-C时由调度器终止正在运行的命令
+    finally:
+        progress.hide()
+        history.save()
+        tracer.write(args.trace)
+        print("{} {}".format(apply_cyan("[TRACE]"), apply_yellow(args.trace)))
+    install.print_summary()
 
     print("{}".format(apply_green("install successfully please reboot your computer")))
 
@@ -1,12 +1,46 @@
 #!/usr/bin/python
 
 import os
+import re
 import sys
+import json
+import time
+import signal
+import argparse
+import difflib
+import tempfile
+import logging
+import resource
+import selectors
+import threading
 import subprocess
+import urllib.request
+import functools
+import collections
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 # 这是archlinux安装后的脚本
 
+LOG_FILE = os.path.expanduser("~/.cache/setup_plasma.log")
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 2
+TAIL_LINES = 40  # 失败时显示的输出行数
+TIMEOUT_CODE = 124
+IO_WORKERS = 4  # 同时执行的文件/配置任务数
+AUR_BUILD_MEM = 2 * 1024 * 1024 * 1024  # 每个AUR编译任务预留的内存
+PACMAN_LOCK = "/tmp/setup_plasma-pacman.lock"
+PACMAN_WRAPPER = os.path.expanduser("~/.cache/setup_plasma/pacman")
+PACMAN_LOCAL_DB = "/var/lib/pacman/local"
+DEFAULT_PROFILE = "minimal"
+AUR_URL = "https://aur.archlinux.org"
+AUR_REPO_NAME = "aurcache"
+AUR_REPO_DIR = "~/.cache/setup_plasma/repo"  # 编译好的AUR包组成的pacman仓库, 可以用http共享给其他机器
+AUR_BUILD_DIR = os.path.expanduser("~/.cache/setup_plasma/build")
+AUR_CHROOT_DIR = os.path.expanduser("~/.cache/setup_plasma/chroot")
+AUR_CCACHE_DIR = os.path.expanduser("~/.cache/setup_plasma/ccache")
+
 # =================================== color function ===================================
 
 def apply_red(s) -> str:
@@ -36,193 +70,817 @@ def apply_cyan(s) -> str:
 # ======================================================================================
 
 
-def run_cmd(cmd: str, debug: bool = True, exit_: bool = True, stdout: bool = False) -> str:
+cancel_event = threading.Event()  # 置位后正在运行的命令会被终止
+_logger = None
+
+
+def get_logger() -> logging.Logger:
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger("setup_plasma")
+        _logger.setLevel(logging.INFO)
+        _logger.propagate = False
+        try:
+            os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            _logger.addHandler(handler)
+        except OSError:
+            _logger.addHandler(logging.NullHandler())
+    return _logger
+
+
+def child_pids(pid: int) -> list:
+    """pid的所有后代进程(从/proc读取父进程号), 子进程和当前脚本在同一个会话里, 不能按进程组结束"""
+    parents = {}
+    for d in os.listdir("/proc"):
+        if not d.isdigit():
+            continue
+        try:
+            with open(f"/proc/{d}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents.setdefault(ppid, []).append(int(d))
+    pids, todo = [], [pid]
+    while todo:
+        for c in parents.get(todo.pop(), []):
+            pids.append(c)
+            todo.append(c)
+    return pids
+
+
+def _kill(p: subprocess.Popen):
+    """先TERM shell和它的所有后代, 5秒后还没退出就KILL"""
+    pids = [p.pid] + child_pids(p.pid)
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+        try:
+            p.wait(5)
+            return
+        except subprocess.TimeoutExpired:
+            pids = [p.pid] + child_pids(p.pid)
+
+
+def run_stream(cmd: str, echo: bool = True, capture: bool = True, timeout: float = None) -> tuple:
+    """非阻塞读取输出, 实时显示(不等换行, 交互提示也能看到)并按行写入日志
+    返回(退出码, 输出, 最后TAIL_LINES行)"""
+    logger = get_logger()
+    logger.info(f"[RUN] {cmd}")
+    # 不能用新会话: sudo要在当前终端上询问密码, sudo -v的凭证也只对同一个终端会话有效
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    sel = selectors.DefaultSelector()
+    for f in (p.stdout, p.stderr):
+        os.set_blocking(f.fileno(), False)
+        sel.register(f, selectors.EVENT_READ)
+    partial = {p.stdout: b"", p.stderr: b""}
+    tail = collections.deque(maxlen=TAIL_LINES)
+    captured = []
+    deadline = time.monotonic() + timeout if timeout else None
+    code = None
+
+    while sel.get_map():
+        if cancel_event.is_set() or (deadline and time.monotonic() > deadline):
+            _kill(p)
+            code = TIMEOUT_CODE if not cancel_event.is_set() else -signal.SIGTERM
+            logger.info(f"[KILLED] {cmd}")
+            break
+        for key, _ in sel.select(0.5):
+            f = key.fileobj
+            chunk = os.read(f.fileno(), 65536)
+            if not chunk:
+                sel.unregister(f)
+                chunk = b"\n" if partial[f] else b""
+            elif echo:
+                out = sys.stdout if f is p.stdout else sys.stderr
+                out.write(chunk.decode(errors="replace"))
+                out.flush()
+            *lines, partial[f] = (partial[f] + chunk).split(b"\n")
+            for line in lines:
+                line = line.decode(errors="replace")
+                tail.append(line)
+                if capture:
+                    captured.append(line)
+                logger.info(line)
+    sel.close()
+
+    if code is None:
+        code = p.wait()
+    else:
+        p.wait()
+    return code, "\n".join(captured), list(tail)
+
+
+def run_cmd(cmd: str, debug: bool = True, exit_: bool = True, stdout: bool = True, timeout: float = None) -> str:
     if debug:
         print("{} {}".format(apply_cyan("[RUN]"), apply_yellow(cmd)))
 
-    if stdout:
-        code = os.system(cmd)
-        output = ""
-    else:
-        code, output = subprocess.getstatusoutput(cmd)
+    code, output, tail = run_stream(cmd, echo=stdout, timeout=timeout)
 
     try:
         assert code == 0
     except AssertionError:
         if exit_:
+            if not stdout:
+                sys.stderr.write("\n".join(tail) + "\n")
             print("{}".format(apply_red(f"RUN ERROR: {cmd}")))
-            sys.exit(code)
+            sys.exit(code if code > 0 else 1)
         else:
             return ""
 
     return output
 
 
-def just_run(prompt: str):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            print("{}".format(apply_yellow(f"正在{prompt}...")))
-            func(*args, **kwargs)
-            print("{}".format(apply_green("OK")))
-
-        return wrapper
-
-    return decorator
-
-
-# 1. 必要软件安装
-class BaseConfig:
-    @just_run("配置archlinuxcn源")
-    def set_archlinuxcn(self):
-        run_cmd("sudo sed -in-place -e 's/#Color/Color/g' /etc/pacman.conf")
-        run_cmd("sudo sh -c 'cat >> /etc/pacman.conf <<EOF\n[archlinuxcn]\nServer = https://mirrors.tuna.tsinghua.edu.cn/archlinuxcn/\$arch\nEOF'")
-        run_cmd("sudo pacman -Syu")
-        run_cmd("sudo pacman -S --noconfirm archlinuxcn-keyring")
-
-    @just_run("设置AUR")
-    def set_aur(self):
-        run_cmd("sudo pacman -S yay")
-        run_cmd('yay --aururl "https://aur.tuna.tsinghua.edu.cn" --save')
-
-    @just_run("安装输入法")
-    def set_fcitx(self):
-        run_cmd("sudo pacman -S --noconfirm fcitx fcitx-table-other kcm-fcitx fcitx-skin-material")  # kcm 针对kde桌面
-        run_cmd("touch ~/.xprofile")
-        run_cmd("echo -e 'export XIM=fcitx\\nexport XIM_PROGRAM=fcitx\\nexport GTK_IM_MODULE=fcitx\\nexport QT_IM_MODULE=fcitx\\nexport XMODIFIERS=\"@im=fcitx\"\\n' >> ~/.xprofile")
-        run_cmd("source ~/.xprofile")
-
-    @just_run("安装nerd-font字体")
-    def set_font(self):
-        run_cmd("sudo pacman -S --noconfirm nerd-fonts-complete")
-
-    @just_run("设置ohmyzsh")
-    def set_oh_my_zsh(self):
-        run_cmd('sh -c "$(wget https://gitee.com/shenghaiyang/ohmyzsh/raw/master/tools/install.sh -O -)"')
-        run_cmd('git clone git://github.com/zsh-users/zsh-autosuggestions.git ~/.oh-my-zsh/plugins/zsh-autosuggestions')
-        run_cmd('git clone https://github.com/zsh-users/zsh-syntax-highlighting.git ~/.oh-my-zsh/plugins/zsh-syntax-highlighting')
-        run_cmd("sed -in-place -e 's/plugins=(git)/plugins=(docker git sudo zsh-syntax-highlighting zsh-autosuggestions)/g' ~/.zshrc")
-        run_cmd("zsh -c 'source ~/.zshrc'")
-
-    @just_run("修改中文目录为英文")
-    def set_user_dir(self):
-        run_cmd("mv ~/公共 ~/Public")
-        run_cmd("sed -in-place -e 's/公共/Public/g' ~/.config/user-dirs.dirs")
-
-        run_cmd("mv ~/模板 ~/Template")
-        run_cmd("sed -in-place -e 's/模板/Template/g' ~/.config/user-dirs.dirs")
-
-        run_cmd("mv ~/视频 ~/Video")
-        run_cmd("sed -in-place -e 's/视频/Video/g' ~/.config/user-dirs.dirs")
-
-        run_cmd("mv ~/图片 ~/Picture")
-        run_cmd("sed -in-place -e 's/图片/Picture/g' ~/.config/user-dirs.dirs")
-
-        run_cmd("mv ~/文档 ~/Documents")
-        run_cmd("sed -in-place -e 's/文档/Documents/g' ~/.config/user-dirs.dirs")
-
-        run_cmd("mv ~/下载 ~/Download")
-        run_cmd("sed -in-place -e 's/下载/Download/g' ~/.config/user-dirs.dirs")
-
-        run_cmd("mv ~/音乐 ~/Music")
-        run_cmd("sed -in-place -e 's/音乐/Music/g' ~/.config/user-dirs.dirs")
-
-        run_cmd("mv ~/桌面 ~/Desktop")
-        run_cmd("sed -in-place -e 's/桌面/Desktop/g' ~/.config/user-dirs.dirs")
-
-
-# 2. 各类开发环境
-class Develop:
-    @just_run("安装golang")
-    def set_golang(self):
-        run_cmd('sudo pacman -S --noconfirm go')
-        run_cmd('mkdir ~/.go')
-        run_cmd('mkdir ~/.go/bin')
-        run_cmd('mkdir ~/.go/src')
-        run_cmd('mkdir ~/.go/pkg')
-        run_cmd('echo -e "export GOROOT=/usr/lib/go\\nexport GOPATH=~/Documents/go\\nexport GOBIN=~/Documents/go/bin\\nexport PATH=$PATH:$GOROOT/bin:$GOBIN\\n" >> ~/.xprofile')
-        run_cmd('source ~/.xprofile')
-        run_cmd('go env -w GOPROXY=https://goproxy.io,direct')
-        run_cmd('sudo pacman -S --noconfirm goland-jre goland')
-
-    @just_run("安装docker")
-    def set_docker(self):
-        run_cmd('sudo pacman -S --noconfirm docker')
-        run_cmd('sudo gpasswd -a ${USER} docker')
-        run_cmd("sudo mkdir /etc/docker")
-        run_cmd("sudo touch /etc/docker/daemon.json")
-        run_cmd('''sudo tee /etc/docker/daemon.json <<-'EOF'\n{\n	"registry-mirrors": ["http://hub-mirror.c.163.com"]\n}\nEOF''')
-        run_cmd("sudo systemctl enable docker")
-
-
-# 3. 常用软件
-class Software:
-    @just_run("安装virtualbox")
-    def set_virtualbox(self):
-        run_cmd('sudo pacman -S --noconfirm virtualbox virtualbox-ext-oracle virtualbox-guest-iso net-tools')
-
-    @just_run("安装telegram")
-    def set_telegram(self):
-        run_cmd('sudo pacman -S --noconfirm telegram-desktop')
-
-    @just_run("安装google-chrome")
-    def set_chrome(self):
-        run_cmd('yay -S --noconfirm google-chrome')
-
-    @just_run("安装typora")
-    def set_typora(self):
-        run_cmd("sudo pacman -S --noconfirm typora")
-
-    @just_run("安装vscode")
-    def set_vscode(self):
-        run_cmd("yay -S --noconfirm visual-studio-code-bin")
-
-    @just_run("安装qq音乐")
-    def set_qqmusic(self):
-        run_cmd("yay -S --noconfirm qqmusic-bin")
-
-
-# 4. 美化
-class Beauty:
-    @just_run("安装papirus图标主题")
-    def set_icon_theme(self):
-        run_cmd("sudo pacman -S --noconfirm papirus-icon-theme")
-
-    @just_run("安装layan全局主题")
-    def set_layan_theme(self):
-        run_cmd("yay -S --noconfirm layan-kde-git")
+step_timings = []  # (步骤, 耗时, 子进程CPU时间)
 
-    @just_run("安装tela-2k grub主题")
-    def set_grub_theme(self):
-        run_cmd("yay -S --noconfirm grub-theme-tela-color-2k-git")
 
+def child_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
 
-def main():
-    base = BaseConfig()
-    base.set_archlinuxcn()
-    base.set_aur()
-    base.set_fcitx()
-    base.set_font()
-    base.set_user_dir()
-    #
-    # dev = Develop()
-    # dev.set_golang()
-    # dev.set_docker()
-    #
-    # soft = Software()
-    # soft.set_chrome()
-    # soft.set_typora()
-    # # soft.set_virtualbox()
-    # soft.set_telegram()
-    # soft.set_vscode()
-    # soft.set_qqmusic()
-    #
-    # b = Beauty()
-    # b.set_grub_theme()
-    # b.set_icon_theme()
-    # b.set_layan_theme()
 
+def print_timings(top: int = 10):
+    """按耗时从高到低打印各步骤"""
+    for prompt, seconds, cpu in sorted(step_timings, key=lambda t: t[1], reverse=True)[:top]:
+        print("{} {}".format(apply_blue(prompt), apply_green(f"{seconds:.1f}s (cpu {cpu:.1f}s)")))
+
+
+def timed(prompt: str, func, *args):
+    """执行一个步骤并记录耗时"""
+    print("{}".format(apply_yellow(f"正在{prompt}...")))
+    start = time.monotonic()
+    cpu = child_cpu()
+    func(*args)
+    seconds = time.monotonic() - start
+    step_timings.append((prompt, seconds, child_cpu() - cpu))
+    print("{}".format(apply_green(f"OK {prompt} ({seconds:.1f}s)")))
+
+
+# =================================== config edits =====================================
+
+def show_diff(path: str, old: str, new: str):
+    for line in difflib.unified_diff(old.splitlines(), new.splitlines(), path, path, n=0, lineterm=""):
+        if line.startswith(("---", "+++", "@@")):
+            continue
+        print(apply_green(line) if line.startswith("+") else apply_red(line))
+
+
+_edit_locks = {}  # 路径 -> Lock
+_edit_locks_guard = threading.Lock()
+
+
+def edit_lock(path: str) -> threading.Lock:
+    """同一个文件的读-改-写要串行: 例如fcitx和golang的任务会同时改~/.xprofile"""
+    with _edit_locks_guard:
+        return _edit_locks.setdefault(os.path.realpath(path), threading.Lock())
+
+
+def edit_file(path: str, patch, sudo: bool = False, mode: int = None) -> bool:
+    """patch(旧内容) -> 新内容, 文件不存在时旧内容为空; 内容没变不写, 变了就原子替换并打印diff
+    sudo=True用于/etc下的文件: 先写到自己的缓存目录, 再用一条sudo命令装到目标位置"""
+    path = os.path.expanduser(path)
+    with edit_lock(path):
+        return _edit_file(path, patch, sudo, mode)
+
+
+def _edit_file(path: str, patch, sudo: bool, mode: int) -> bool:
+    try:
+        with open(path) as f:
+            old = f.read()
+    except FileNotFoundError:
+        old = ""
+    new = patch(old)
+    if new == old:
+        return False
+
+    print("{} {}".format(apply_cyan("[EDIT]"), apply_yellow(path)))
+    show_diff(path, old, new)
+    get_logger().info(f"[EDIT] {path}")
+    if mode is None:
+        mode = os.stat(path).st_mode & 0o7777 if os.path.exists(path) else 0o644
+    tmp_dir = os.path.dirname(PACMAN_WRAPPER) if sudo else os.path.dirname(path)
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=tmp_dir)
+    with os.fdopen(fd, "w") as f:
+        f.write(new)
+    os.chmod(tmp, mode)
+    if sudo:
+        run_cmd(f"sudo sh -c 'mkdir -p {os.path.dirname(path)} && install -m {mode:o} {tmp} {path}.new "
+                f"&& mv {path}.new {path}'", debug=False)
+        os.remove(tmp)
+    else:
+        os.replace(tmp, path)
+    return True
+
+
+def replace_with(content: str):
+    return lambda _: content
+
+
+def set_exports(text: str, exports: list) -> str:
+    """shell profile里的export VAR=...: 已有的同名变量就地替换, 没有的追加到末尾"""
+    lines = text.splitlines()
+    for name, value in exports:
+        line = f"export {name}={value}"
+        idx = [i for i, x in enumerate(lines) if re.match(rf"^\s*export\s+{name}=", x)]
+        if idx:
+            lines[idx[0]] = line
+        else:
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def set_pacman_option(text: str, key: str) -> str:
+    """打开[options]里被注释掉的开关, 例如Color"""
+    return re.sub(rf"^#\s*{key}\s*$", key, text, flags=re.M)
+
+
+def set_pacman_repo(text: str, name: str, servers: list, options: list = None) -> str:
+    """添加或替换一个仓库段"""
+    block = [f"[{name}]"] + (options or []) + [f"Server = {s}" for s in servers]
+    out = []
+    section = None
+    replaced = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            section = stripped[1:-1]
+            if section == name:
+                out.extend(block)
+                replaced = True
+                continue
+        if section == name:
+            if stripped == "" or stripped.startswith("#"):
+                out.append(line)  # 段之间的空行和注释保留
+            continue
+        out.append(line)
+    if not replaced:
+        if out and out[-1].strip():
+            out.append("")
+        out.extend(block)
+    return "\n".join(out) + "\n"
+
+
+def set_user_dirs(text: str, renames: dict) -> str:
+    """user-dirs.dirs里XDG_*_DIR="$HOME/旧名" -> "$HOME/新名\""""
+    def repl(m):
+        return f'{m.group(1)}"$HOME/{renames.get(m.group(2), m.group(2))}"'
+    return re.sub(r'^(XDG_\w+_DIR=)"\$HOME/([^"/]*)"', repl, text, flags=re.M)
+
+
+# =================================== AUR build farm ===================================
+
+class AurPackage:
+    def __init__(self, name: str, commit: str, version: str = None, files: list = None):
+        self.name = name
+        self.commit = commit  # AUR git仓库(PKGBUILD)的提交
+        self.version = version
+        self.files = files or []  # 仓库目录下的包文件名
+
+    def to_dict(self) -> dict:
+        return {"commit": self.commit, "version": self.version, "files": self.files}
+
+
+def aur_commit(package: str) -> str:
+    output = run_cmd(f"git ls-remote {AUR_URL}/{package}.git HEAD", debug=False, stdout=False)
+    return output.split()[0] if output else None
+
+
+def read_srcinfo_version(path: str) -> str:
+    fields = {}
+    with open(os.path.join(path, ".SRCINFO")) as f:
+        for line in f:
+            key, _, value = line.strip().partition(" = ")
+            if key in ("pkgver", "pkgrel", "epoch") and key not in fields:
+                fields[key] = value
+    version = f"{fields.get('pkgver')}-{fields.get('pkgrel')}"
+    return f"{fields['epoch']}:{version}" if "epoch" in fields else version
+
+
+class AurRepo:
+    """本地pacman仓库, 按AUR上PKGBUILD的提交缓存编译好的包; 目录可以通过http共享给其他机器,
+    其他机器用--aur-repo指定地址, 命中时直接pacman -S, 未命中的退回到yay本地编译;
+    远程仓库要求签名, 编译机用sign_key给包和数据库签名"""
+
+    def __init__(self, location: str = AUR_REPO_DIR, sign_key: str = None):
+        self.remote = location.startswith(("http://", "https://"))
+        self.sign_key = sign_key
+        self.location = location.rstrip("/") if self.remote else os.path.expanduser(location)
+        self.lock = threading.Lock()
+        self.chroot_lock = threading.Lock()
+        self.index = self.load_index()  # 包名 -> AurPackage
+        self.hits = []
+        self.built = []
+        self.fallback = []  # 远程仓库里没有, 用yay装的
+
+    @property
+    def index_path(self) -> str:
+        return f"{self.location}/{AUR_REPO_NAME}.json"
+
+    @property
+    def server(self) -> str:
+        return self.location if self.remote else f"file://{self.location}"
+
+    def load_index(self) -> dict:
+        try:
+            if self.remote:
+                with urllib.request.urlopen(self.index_path, timeout=10) as resp:
+                    data = json.loads(resp.read())
+            else:
+                with open(self.index_path) as f:
+                    data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {name: AurPackage(name, d["commit"], d.get("version"), d.get("files")) for name, d in data.items()}
+
+    def save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({name: p.to_dict() for name, p in self.index.items()}, f, indent=2)
+        os.replace(tmp, self.index_path)
+
+    def cached(self, package: str, commit: str) -> bool:
+        entry = self.index.get(package)
+        if entry is None or entry.commit != commit or not entry.files:
+            return False
+        return self.remote or all(os.path.exists(os.path.join(self.location, f)) for f in entry.files)
+
+    def ensure(self, package: str, makeflags: str):
+        """保证仓库里有和AUR上当前PKGBUILD对应的包, 没有就在干净的chroot里编译"""
+        commit = aur_commit(package)
+        if commit is not None and self.cached(package, commit):
+            print("{} {}".format(apply_cyan("[AUR HIT]"), apply_yellow(f"{package} {self.index[package].version}")))
+            self.hits.append(package)
+            return
+        if self.remote:
+            print("{} {}".format(apply_cyan("[AUR MISS]"), apply_yellow(f"{package} not in {self.location}")))
+            build_aur(package, makeflags)
+            self.fallback.append(package)
+            return
+        self.build(package, commit, makeflags)
+
+    def build_chroot(self) -> str:
+        """第一次编译时创建chroot模板, 之后每个包用它的一份拷贝(makechrootpkg -l)"""
+        with self.chroot_lock:
+            root = os.path.join(AUR_CHROOT_DIR, "root")
+            if os.path.isdir(root):
+                return AUR_CHROOT_DIR
+            os.makedirs(AUR_CHROOT_DIR, exist_ok=True)
+            os.makedirs(AUR_CCACHE_DIR, exist_ok=True)
+            makepkg_conf = os.path.join(AUR_CHROOT_DIR, "makepkg.conf")
+            with open("/etc/makepkg.conf") as f:
+                host_conf = f.read()
+            edit_file(makepkg_conf, lambda text: chroot_makepkg_conf(host_conf))
+            run_cmd(f"mkarchroot -C /etc/pacman.conf -M {makepkg_conf} {root} base-devel ccache", stdout=False)
+            return AUR_CHROOT_DIR
+
+    def build(self, package: str, commit: str, makeflags: str):
+        chroot = self.build_chroot()
+        src = os.path.join(AUR_BUILD_DIR, package)
+        if os.path.isdir(os.path.join(src, ".git")):
+            run_cmd(f"git -C {src} fetch -q --depth 1 origin && git -C {src} reset -q --hard FETCH_HEAD", stdout=False)
+        else:
+            run_cmd(f"git clone -q --depth 1 {AUR_URL}/{package}.git {src}", stdout=False)
+        for f in os.listdir(src):
+            if ".pkg.tar." in f:
+                os.remove(os.path.join(src, f))
+        # makechrootpkg不会把环境变量带进chroot: 先像-c那样从模板同步一份干净的拷贝,
+        # 再把这个编译任务分到的并行数写进拷贝里的makepkg.conf, 并行的几个编译加起来不超过CPU核数
+        copy = os.path.join(chroot, package)
+        run_cmd(f"sudo rsync -a --delete -q -W -x {chroot}/root/ {copy}/", stdout=False)
+        edit_file(os.path.join(copy, "etc/makepkg.conf"), lambda text: set_makeflags(text, makeflags), sudo=True)
+        run_cmd(f"cd {src} && makechrootpkg -r {chroot} -l {package} -d {AUR_CCACHE_DIR}:/ccache", stdout=False)
+        files = sorted(f for f in os.listdir(src) if ".pkg.tar." in f and not f.endswith(".sig"))
+        if self.sign_key:
+            for f in files:  # 与makepkg --sign相同的分离签名
+                run_cmd(f"gpg --batch --yes --detach-sign --no-armor -u {self.sign_key} {os.path.join(src, f)}",
+                        stdout=False)
+        with self.lock:
+            os.makedirs(self.location, exist_ok=True)
+            for f in files + ([f + ".sig" for f in files] if self.sign_key else []):
+                os.replace(os.path.join(src, f), os.path.join(self.location, f))
+            sign = f"-s -k {self.sign_key} " if self.sign_key else ""
+            run_cmd(f"repo-add -q -R {sign}{self.location}/{AUR_REPO_NAME}.db.tar.gz "
+                    + " ".join(os.path.join(self.location, f) for f in files), stdout=False)
+            self.index[package] = AurPackage(package, commit or "", read_srcinfo_version(src), files)
+            self.save_index()
+            self.built.append(package)
+
+    def install(self, packages: list):
+        """仓库加进pacman.conf, 命中和刚编译好的包就是普通的pacman -S;
+        只信任本机自己编译的file://仓库, 局域网上的仓库必须有编译机的签名(密钥要先用pacman-key导入并本地签名)"""
+        packages = [p for p in packages if p not in self.fallback]
+        if not packages:
+            return
+        siglevel = "SigLevel = Required" if self.remote else "SigLevel = Optional TrustAll"
+        edit_file("/etc/pacman.conf", lambda text: set_pacman_repo(text, AUR_REPO_NAME, [self.server], [siglevel]),
+                  sudo=True)
+        run_cmd("sudo pacman -Sy --needed --noconfirm " + " ".join(packages))
+
+    def print_stat(self):
+        print("{}: {}".format(apply_blue("AUR"), apply_green(
+            f"{len(self.hits)} cached, {len(self.built)} built, {len(self.fallback)} via yay")))
+
+
+def chroot_makepkg_conf(text: str) -> str:
+    """编译chroot用的makepkg.conf: 打开ccache, ccache目录绑定挂载到/ccache"""
+    text = re.sub(r"^(BUILDENV=.*)!ccache", r"\1ccache", text, flags=re.M)
+    return text + "export CCACHE_DIR=/ccache\n"
+
+
+def set_makeflags(text: str, makeflags: str) -> str:
+    """替换makepkg.conf里生效的MAKEFLAGS, 没有就追加"""
+    line = f'MAKEFLAGS="{makeflags}"'
+    text, n = re.subn(r"^MAKEFLAGS=.*$", line, text, flags=re.M)
+    return text if n else text.rstrip("\n") + "\n" + line + "\n"
+
+
+# =================================== provisioning =====================================
+
+class Task:
+    """一项配置: 需要的官方源/AUR软件包, 不依赖软件包的文件操作(files), 装好软件包后的配置(configure)"""
+
+    def __init__(self, name: str, prompt: str, packages: list = None, aur: list = None, deps: list = None,
+                 files=None, configure=None, check=None, final: bool = False):
+        self.name = name
+        self.prompt = prompt
+        self.packages = packages or []
+        self.aur = aur or []
+        self.deps = deps or []  # 依赖的其他任务, 它们全部完成后才开始
+        self.files = files
+        self.configure = configure
+        self.check = check  # 返回True表示files/configure的结果已经存在
+        self.final = final  # 所有其他任务完成之后再执行
+
+    def satisfied(self, installed: set) -> bool:
+        """软件包都已安装且配置已完成, 再次运行时直接跳过"""
+        if any(p not in installed for p in self.packages + self.aur):
+            return False
+        if self.check is not None:
+            return self.check()
+        return self.files is None and self.configure is None
+
+
+class Job:
+    def __init__(self, name: str, prompt: str, func, deps: list, pool: str = "io"):
+        self.name = name
+        self.prompt = prompt
+        self.func = func  # None表示只用来汇总依赖
+        self.deps = deps
+        self.pool = pool  # io: 文件和配置, aur: 编译
+
+
+def installed_packages(db: str = PACMAN_LOCAL_DB) -> set:
+    """直接读pacman本地数据库的目录名(名字-版本-发布号), 比pacman -Qq快"""
+    try:
+        return {d.rsplit("-", 2)[0] for d in os.listdir(db) if d.count("-") >= 2}
+    except OSError:
+        return set()
+
+
+def file_contains(path: str, text: str) -> bool:
+    try:
+        with open(os.path.expanduser(path)) as f:
+            return text in f.read()
+    except OSError:
+        return False
+
+
+def mem_available() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def aur_workers() -> int:
+    """同时编译的AUR包数量, 受CPU核数和可用内存限制"""
+    return max(1, min(os.cpu_count() or 1, mem_available() // AUR_BUILD_MEM))
+
+
+def pacman_wrapper() -> str:
+    """并发编译时yay各自调用pacman, 用flock串行化避免数据库锁冲突"""
+    os.makedirs(os.path.dirname(PACMAN_WRAPPER), exist_ok=True)
+    with open(PACMAN_WRAPPER, "w") as f:
+        f.write(f'#!/bin/sh\nexec flock {PACMAN_LOCK} pacman "$@"\n')
+    os.chmod(PACMAN_WRAPPER, 0o755)
+    return PACMAN_WRAPPER
+
+
+def build_aur(package: str, makeflags: str):
+    run_cmd(f"MAKEFLAGS={makeflags} yay -S --needed --noconfirm --answerdiff None --answerclean None "
+            f"--pacman {pacman_wrapper()} {package}", stdout=False)
+
+
+def keep_sudo(stop: threading.Event):
+    """定时刷新sudo凭证, 避免编译很久之后再次询问密码"""
+    while not stop.wait(60):
+        run_cmd("sudo -n -v", debug=False, exit_=False)
+
+
+class Provisioner:
+    """所有任务的官方源软件包合并成一次pacman事务, AUR包按核数和内存并行编译,
+    文件和配置类的操作在下载软件包的同时执行"""
+
+    def __init__(self, tasks: list, io_workers: int = IO_WORKERS, aur_repo: AurRepo = None):
+        self.tasks = {t.name: t for t in tasks}
+        self.aur_repo = aur_repo or AurRepo()
+        self.io_workers = io_workers
+        self.aur_workers = aur_workers()
+        self.jobs = self.plan()
+
+    def task_deps(self, task: Task) -> list:
+        deps = [f"{d}:done" for d in task.deps if d in self.tasks]
+        if task.final:
+            deps += [f"{t.name}:done" for t in self.tasks.values() if not t.final]
+        return deps
+
+    def plan(self) -> dict:
+        """每个任务拆成 files / configure / done 几个job, 官方源的包统一由pacman这个job安装,
+        AUR包每个一个build:<包>, 编译或命中缓存后统一由aur-install安装"""
+        jobs = {}
+        packages = []
+        pacman_deps = []
+        for t in self.tasks.values():
+            packages += [p for p in t.packages if p not in packages]
+            if t.packages:
+                pacman_deps += [d for d in self.task_deps(t) if d not in pacman_deps]
+        if packages:
+            jobs["pacman"] = Job("pacman", f"安装{len(packages)}个软件包",
+                                 functools.partial(run_cmd, f"sudo pacman -S --needed --noconfirm {' '.join(packages)}"),
+                                 pacman_deps)
+
+        makeflags = f"-j{max(1, (os.cpu_count() or 1) // self.aur_workers)}"
+        aur = []
+        for t in self.tasks.values():
+            aur += [p for p in t.aur if p not in aur]
+        aur_deps = ["pacman"] if packages else []
+        for t in self.tasks.values():
+            if t.aur:
+                aur_deps += [d for d in self.task_deps(t) if d not in aur_deps]
+        for p in aur:
+            jobs[f"build:{p}"] = Job(f"build:{p}", f"编译{p}", functools.partial(self.aur_repo.ensure, p, makeflags),
+                                     aur_deps, pool="aur")
+        if aur:
+            # 全部命中时只剩一次pacman -S
+            jobs["aur-install"] = Job("aur-install", f"安装{len(aur)}个AUR软件包",
+                                      functools.partial(self.aur_repo.install, aur), [f"build:{p}" for p in aur])
+        for t in self.tasks.values():
+            deps = self.task_deps(t)
+            needs = ["pacman"] if t.packages else []
+            if t.files is not None:
+                jobs[f"{t.name}:files"] = Job(f"{t.name}:files", f"{t.prompt}(文件)", t.files, deps)
+                needs.append(f"{t.name}:files")
+            if t.aur:
+                needs.append("aur-install")
+            if t.configure is not None:
+                jobs[f"{t.name}:configure"] = Job(f"{t.name}:configure", f"{t.prompt}(配置)", t.configure,
+                                                  deps + needs)
+                needs = [f"{t.name}:configure"]
+            jobs[f"{t.name}:done"] = Job(f"{t.name}:done", t.prompt, None, deps + needs)
+        return jobs
+
+    def run(self):
+        """按依赖启动job; 任一job失败后不再启动新的, 等已经启动的结束后抛出"""
+        done = set()
+        pending = list(self.jobs)
+        running = {}  # future -> name
+        error = None
+        with ThreadPoolExecutor(self.io_workers) as io, ThreadPoolExecutor(self.aur_workers) as aur:
+            pools = {"io": io, "aur": aur}
+            while pending or running:
+                ready = [n for n in pending if all(d in done for d in self.jobs[n].deps)]
+                for name in ready:
+                    job = self.jobs[name]
+                    if job.func is None:
+                        pending.remove(name)
+                        done.add(name)
+                    elif error is None:
+                        pending.remove(name)
+                        running[pools[job.pool].submit(timed, job.prompt, job.func)] = name
+                if any(self.jobs[n].func is None for n in ready):
+                    continue  # 汇总job完成后可能有新的job就绪
+                if not running:
+                    if pending and error is None:
+                        print("{}".format(apply_red("dependency cycle: " + ", ".join(pending))))
+                        sys.exit(1)
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    name = running.pop(f)
+                    if f.exception() is not None:
+                        error = error or f.exception()
+                        print("{}".format(apply_red(f"FAILED: {name}")))
+                    else:
+                        done.add(name)
+        if error is not None:
+            raise error
+
+
+# =================================== tasks ============================================
+
+def set_archlinuxcn():
+    edit_file("/etc/pacman.conf", lambda text: set_pacman_repo(set_pacman_option(text, "Color"), "archlinuxcn", [
+        "https://mirrors.tuna.tsinghua.edu.cn/archlinuxcn/$arch"]), sudo=True)
+    run_cmd("sudo pacman -Syu --noconfirm")
+    run_cmd("sudo pacman -S --noconfirm archlinuxcn-keyring")
+
+
+def set_aur():
+    run_cmd('yay --aururl "https://aur.tuna.tsinghua.edu.cn" --save')
+
+
+def set_fcitx_profile():
+    edit_file("~/.xprofile", lambda text: set_exports(text, [
+        ("XIM", "fcitx"), ("XIM_PROGRAM", "fcitx"), ("GTK_IM_MODULE", "fcitx"), ("QT_IM_MODULE", "fcitx"),
+        ("XMODIFIERS", '"@im=fcitx"')]))
+
+
+user_dirs = (("公共", "Public"), ("模板", "Template"), ("视频", "Video"), ("图片", "Picture"),
+             ("文档", "Documents"), ("下载", "Download"), ("音乐", "Music"), ("桌面", "Desktop"))
+
+
+def set_user_dir():
+    for zh, en in user_dirs:
+        src, dst = os.path.expanduser(f"~/{zh}"), os.path.expanduser(f"~/{en}")
+        if os.path.isdir(src) and not os.path.exists(dst):
+            os.rename(src, dst)
+    edit_file("~/.config/user-dirs.dirs", lambda text: set_user_dirs(text, dict(user_dirs)))
+
+
+def check_user_dir() -> bool:
+    return not any(os.path.exists(os.path.expanduser(f"~/{zh}")) for zh, _ in user_dirs)
+
+
+def set_golang_env():
+    for d in ("bin", "src", "pkg"):
+        os.makedirs(os.path.expanduser(f"~/.go/{d}"), exist_ok=True)
+    edit_file("~/.xprofile", lambda text: set_exports(text, [
+        ("GOROOT", "/usr/lib/go"), ("GOPATH", "~/Documents/go"), ("GOBIN", "~/Documents/go/bin"),
+        ("PATH", "$PATH:$GOROOT/bin:$GOBIN")]))
+
+
+def set_golang_proxy():
+    run_cmd('go env -w GOPROXY=https://goproxy.io,direct')
+
+
+def set_docker_daemon():
+    edit_file("/etc/docker/daemon.json", replace_with('{\n\t"registry-mirrors": ["http://hub-mirror.c.163.com"]\n}\n'),
+              sudo=True)
+
+
+def set_docker():
+    run_cmd('sudo gpasswd -a ${USER} docker')
+    run_cmd("sudo systemctl enable docker")
+
+
+def check_docker() -> bool:
+    user = os.environ.get("USER", "")
+    with open("/etc/group") as f:
+        members = [line.rstrip("\n").split(":")[-1].split(",") for line in f if line.startswith("docker:")]
+    return (os.path.exists("/etc/docker/daemon.json") and any(user in m for m in members)
+            and os.path.exists("/etc/systemd/system/multi-user.target.wants/docker.service"))
+
+
+def set_oh_my_zsh():
+    run_cmd('sh -c "$(wget https://gitee.com/shenghaiyang/ohmyzsh/raw/master/tools/install.sh -O -)"')
+    run_cmd('git clone git://github.com/zsh-users/zsh-autosuggestions.git ~/.oh-my-zsh/plugins/zsh-autosuggestions')
+    run_cmd('git clone https://github.com/zsh-users/zsh-syntax-highlighting.git ~/.oh-my-zsh/plugins/zsh-syntax-highlighting')
+    plugins = "plugins=(docker git sudo zsh-syntax-highlighting zsh-autosuggestions)"
+    edit_file("~/.zshrc", lambda text: re.sub(r"^plugins=\(.*\)$", plugins, text, flags=re.M))
+    run_cmd("zsh -c 'source ~/.zshrc'")
+
+
+tasks = [
+    # 1. 必要软件安装
+    Task("archlinuxcn", "配置archlinuxcn源", configure=set_archlinuxcn,
+         check=lambda: file_contains("/etc/pacman.conf", "[archlinuxcn]")
+         and "archlinuxcn-keyring" in installed_packages()),
+    Task("aur", "设置AUR", packages=["yay", "devtools"], deps=["archlinuxcn"], configure=set_aur,
+         check=lambda: file_contains("~/.config/yay/config.json", "aur.tuna.tsinghua.edu.cn")),
+    Task("fcitx", "安装输入法", packages=["fcitx", "fcitx-table-other", "kcm-fcitx", "fcitx-skin-material"],  # kcm 针对kde桌面
+         files=set_fcitx_profile, check=lambda: file_contains("~/.xprofile", "XIM=fcitx")),
+    Task("font", "安装nerd-font字体", packages=["nerd-fonts-complete"], deps=["archlinuxcn"]),
+    Task("user_dir", "修改中文目录为英文", files=set_user_dir, check=check_user_dir),
+    # 2. 各类开发环境
+    Task("golang", "安装golang", packages=["go", "goland-jre", "goland"], deps=["archlinuxcn"],
+         files=set_golang_env, configure=set_golang_proxy,
+         check=lambda: file_contains("~/.xprofile", "GOPATH") and file_contains("~/.config/go/env", "goproxy.io")),
+    Task("docker", "安装docker", packages=["docker"], files=set_docker_daemon, configure=set_docker,
+         check=check_docker),
+    # 3. 常用软件
+    Task("virtualbox", "安装virtualbox", packages=["virtualbox", "virtualbox-ext-oracle", "virtualbox-guest-iso",
+                                                 "net-tools"], deps=["archlinuxcn"]),
+    Task("telegram", "安装telegram", packages=["telegram-desktop"]),
+    Task("chrome", "安装google-chrome", aur=["google-chrome"], deps=["aur"]),
+    Task("typora", "安装typora", packages=["typora"], deps=["archlinuxcn"]),
+    Task("vscode", "安装vscode", aur=["visual-studio-code-bin"], deps=["aur"]),
+    Task("qqmusic", "安装qq音乐", aur=["qqmusic-bin"], deps=["aur"]),
+    # 4. 美化
+    Task("icon_theme", "安装papirus图标主题", packages=["papirus-icon-theme"]),
+    Task("layan_theme", "安装layan全局主题", aur=["layan-kde-git"], deps=["aur"]),
+    Task("grub_theme", "安装tela-2k grub主题", aur=["grub-theme-tela-color-2k-git"], deps=["aur"]),
     # 最后再来安装oh-my-zsh
-    base.set_oh_my_zsh()
+    Task("oh_my_zsh", "设置ohmyzsh", configure=set_oh_my_zsh, final=True,
+         check=lambda: os.path.isdir(os.path.expanduser("~/.oh-my-zsh/plugins/zsh-syntax-highlighting"))),
+]
+
+registry = {t.name: t for t in tasks}
+
+profiles = {
+    "minimal": ["archlinuxcn", "aur", "fcitx", "font", "user_dir", "oh_my_zsh"],
+    "dev-workstation": ["archlinuxcn", "aur", "fcitx", "font", "user_dir", "golang", "docker", "chrome", "typora",
+                        "vscode", "oh_my_zsh"],
+    "desktop": ["archlinuxcn", "aur", "fcitx", "font", "user_dir", "chrome", "telegram", "typora", "qqmusic",
+                "icon_theme", "layan_theme", "grub_theme", "oh_my_zsh"],
+    "full": [t.name for t in tasks],
+}
+
+
+def select_tasks(names: list) -> list:
+    """选中的任务加上它们依赖的任务, 按注册顺序返回"""
+    selected = set()
+
+    def add(name):
+        if name not in registry:
+            print("{}".format(apply_red(f"unknown task {name}, choose from: {', '.join(registry)}")))
+            sys.exit(1)
+        if name not in selected:
+            selected.add(name)
+            for d in registry[name].deps:
+                add(d)
+
+    for n in names:
+        add(n)
+    return [t for t in tasks if t.name in selected]
+
+
+def print_registry():
+    for t in tasks:
+        pkgs = " ".join(t.packages + [f"aur/{p}" for p in t.aur])
+        print("{} {} {}".format(apply_cyan(f"{t.name:<12}"), apply_yellow(t.prompt), pkgs))
+    for name, names in profiles.items():
+        print("{}: {}".format(apply_blue(name), apply_green(" ".join(names))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="post-install setup for archlinux + plasma")
+    parser.add_argument("--profile", choices=list(profiles), default=DEFAULT_PROFILE)
+    parser.add_argument("--with", dest="with_", action="append", default=[], metavar="TASK",
+                        help="add a task to the profile")
+    parser.add_argument("--without", action="append", default=[], metavar="TASK",
+                        help="remove a task from the profile")
+    parser.add_argument("--aur-repo", default=AUR_REPO_DIR, metavar="DIR|URL",
+                        help="local repository of prebuilt AUR packages, or the URL of one shared by a build host")
+    parser.add_argument("--aur-sign-key", metavar="KEYID",
+                        help="GPG key used to sign built AUR packages and the repository database")
+    parser.add_argument("--force", action="store_true", help="run tasks even if their result is already present")
+    parser.add_argument("--list", action="store_true", help="list tasks and profiles, then exit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.list:
+        print_registry()
+        return
+
+    names = [n for n in profiles[args.profile] + args.with_ if n not in args.without]
+    selected = select_tasks(names)
+    if not args.force:
+        installed = installed_packages()
+        for t in selected:
+            if t.satisfied(installed):
+                print("{} {}".format(apply_cyan("[SKIP]"), apply_yellow(f"{t.prompt} already done")))
+        selected = [t for t in selected if not t.satisfied(installed)]
+    if not selected:
+        print("{}".format(apply_green("nothing to do")))
+        return
+
+    run_cmd("sudo -v", debug=False)  # 先输入一次密码, 并发的任务不会各自询问
+    # 默认sudoers的凭证按终端会话记录, 所有命令都在这个会话里执行才能复用; 不能复用时(如timestamp_timeout=0)
+    # 并发的sudo会同时抢终端询问密码, 直接停下来
+    if run_stream("sudo -n true", echo=False)[0] != 0:
+        print("{}".format(apply_red("sudo credentials are not reusable in this session, "
+                                    "run with a sudoers timestamp_timeout > 0 or as root")))
+        sys.exit(1)
+    stop = threading.Event()
+    threading.Thread(target=keep_sudo, args=(stop,), daemon=True).start()
+    aur_repo = AurRepo(args.aur_repo, args.aur_sign_key)
+    try:
+        Provisioner(selected, aur_repo=aur_repo).run()
+    except KeyboardInterrupt:
+        cancel_event.set()
+        raise
+    finally:
+        stop.set()
+        print_timings()
+        aur_repo.print_stat()
 
 
 if __name__ == "__main__":
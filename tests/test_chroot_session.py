@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import install_v2 as iv  # noqa: E402
+
+
+class LocalSession(iv.ChrootSession):
+    """不进入arch-chroot, 直接用本机bash执行同一个脚本"""
+
+    def command(self) -> list:
+        return ["bash", "-s"]
+
+
+class ChrootSessionTest(unittest.TestCase):
+    def session(self):
+        return LocalSession(tempfile.gettempdir(), "test", debug=False, exit_=False)
+
+    def test_output_without_trailing_newline(self):
+        results = self.session().add("printf foo").add("echo bar").run()
+        self.assertEqual([r.code for r in results], [0, 0])
+        self.assertEqual(results[0].output, "foo\n")
+        self.assertEqual(results[1].output, "bar\n")
+
+    def test_failure_stops_the_batch(self):
+        results = self.session().add("printf foo; false").add("echo bar").run()
+        self.assertEqual(results[0].code, 1)
+        self.assertIsNone(results[1].code)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import install_v2 as iv  # noqa: E402
+
+
+class DiskLayoutValidateTest(unittest.TestCase):
+    def layout(self, boot, spec):
+        return iv.default_layout("/dev/sda", boot, 0, spec)
+
+    def test_default_layouts_are_valid(self):
+        for boot in (iv.UEFI, iv.BIOS):
+            self.assertEqual(iv.default_layout("/dev/sda", boot, 4).validate(boot), [])
+
+    def test_uefi_needs_esp(self):
+        errors = self.layout(iv.UEFI, [{"role": "root"}]).validate(iv.UEFI)
+        self.assertIn("UEFI boot needs an esp partition", errors)
+
+    def test_bios_gpt_needs_bios_boot(self):
+        layout = iv.DiskLayout("/dev/sda", "gpt", [iv.Partition(iv.BOOT, "512M"), iv.Partition(iv.ROOT)])
+        self.assertIn("BIOS boot from a GPT disk needs a bios_boot partition", layout.validate(iv.BIOS))
+
+    def test_bios_boot_partition_selects_gpt(self):
+        layout = self.layout(iv.BIOS, [{"role": "bios_boot", "size": "1M"}, {"role": "root"}])
+        self.assertEqual(layout.label, "gpt")
+        self.assertEqual(layout.validate(iv.BIOS), [])
+        self.assertIn("type=21686148-6449-6E6F-744E-656564454649", layout.script(10 * 1024 ** 3))
+
+    def test_numeric_size_is_mib(self):
+        layout = self.layout(iv.UEFI, [{"role": "esp", "size": 512}, {"role": "root"}])
+        self.assertEqual(layout.validate(iv.UEFI), [])
+        self.assertIn("size=512MiB", layout.script(10 * 1024 ** 3))
+
+    def test_tiny_and_invalid_sizes_are_rejected(self):
+        errors = self.layout(iv.UEFI, [{"role": "esp", "size": "100K"}, {"role": "swap", "size": "lots"},
+                                       {"role": "root"}]).validate(iv.UEFI)
+        self.assertIn("esp partition size 100K is smaller than 1MiB", errors)
+        self.assertIn("swap partition has invalid size lots", errors)
+
+    def test_validate_settings_uses_boot_mode(self):
+        settings = {"root_password": "x", "hostname": "h", "layout": [{"role": "root"}]}
+        self.assertIn("layout: UEFI boot needs an esp partition", iv.validate_settings(settings, iv.UEFI))
+        self.assertEqual(iv.validate_settings(settings, iv.BIOS), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import install_v2 as iv  # noqa: E402
+
+
+def gpu(vendor: int, device: int, slot: str = "0000:01:00.0") -> iv.PciDevice:
+    return iv.PciDevice(slot, 0x030000, vendor, device)
+
+
+class GpuDriverTest(unittest.TestCase):
+    def drivers(self, gpus: list) -> list:
+        matched, _ = iv.resolve_gpu_drivers(gpus)
+        return [d.name if d is not None else None for _, d in matched]
+
+    def test_nvidia_generations(self):
+        self.assertEqual(self.drivers([gpu(0x10de, 0x2520)]), ["nvidia-open"])
+        self.assertEqual(self.drivers([gpu(0x10de, 0x1380)]), ["nouveau"])
+
+    def test_intel_generations(self):
+        self.assertEqual(self.drivers([gpu(0x8086, 0x0166)]), ["i915-legacy"])
+        self.assertEqual(self.drivers([gpu(0x8086, 0x9bc4)]), ["i915"])
+
+    def test_unknown_vendor(self):
+        matched, packages = iv.resolve_gpu_drivers([gpu(0x1a03, 0x2000)])
+        self.assertIsNone(matched[0][1])
+        self.assertEqual(packages, [])
+
+    def test_dkms_for_other_kernels(self):
+        _, packages = iv.resolve_gpu_drivers([gpu(0x10de, 0x2520)], "linux")
+        self.assertIn("nvidia-open", packages)
+        _, packages = iv.resolve_gpu_drivers([gpu(0x10de, 0x2520)], "linux-lts")
+        self.assertIn("nvidia-open-dkms", packages)
+        self.assertIn("linux-lts-headers", packages)
+        self.assertNotIn("nvidia-open", packages)
+
+    def test_hybrid_graphics(self):
+        _, packages = iv.resolve_gpu_drivers([gpu(0x8086, 0x9bc4, "0000:00:02.0"), gpu(0x10de, 0x2520)])
+        self.assertEqual(packages.count("mesa"), 1)
+        self.assertIn("intel-media-driver", packages)
+        self.assertIn("nvidia-prime", packages)
+        _, packages = iv.resolve_gpu_drivers([gpu(0x8086, 0x9bc4, "0000:00:02.0"), gpu(0x1002, 0x73bf)])
+        self.assertNotIn("nvidia-prime", packages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import install_v2 as iv  # noqa: E402
+
+
+class FakeSysfs:
+    """在临时目录里搭一个最小的/sys和/proc, 只包含探测函数会读的文件"""
+
+    def __init__(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+
+    def write(self, path: str, text: str):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text + "\n")
+
+    def link(self, path: str, target: str):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.symlink(os.path.join(self.root, target), path)
+
+    def add_nvme(self, name: str = "nvme0n1"):
+        controller = "sys/devices/pci0000:00/0000:00:1d.0"
+        os.makedirs(os.path.join(self.root, "sys/module/nvme"))
+        self.link(f"{controller}/driver/module", "sys/module/nvme")
+        self.link(f"sys/block/{name}/device", f"{controller}/nvme/nvme0")
+        os.makedirs(os.path.join(self.root, controller, "nvme/nvme0"))
+
+    def cleanup(self):
+        self.tmp.cleanup()
+
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.sys = FakeSysfs()
+
+    def tearDown(self):
+        self.sys.cleanup()
+
+    def add_disk(self, name: str, sectors: int, rotational: str = "0", removable: str = "0", model: str = None,
+                 discard: str = "0"):
+        base = f"sys/block/{name}"
+        self.sys.write(f"{base}/size", str(sectors))
+        self.sys.write(f"{base}/queue/rotational", rotational)
+        self.sys.write(f"{base}/removable", removable)
+        self.sys.write(f"{base}/queue/discard_max_bytes", discard)
+        if model:
+            self.sys.write(f"{base}/device/model", model)
+
+    def add_pci(self, slot: str, cls: str, vendor: str, device: str):
+        base = f"sys/bus/pci/devices/{slot}"
+        self.sys.write(f"{base}/class", cls)
+        self.sys.write(f"{base}/vendor", vendor)
+        self.sys.write(f"{base}/device", device)
+
+    def test_probe_disks(self):
+        self.add_disk("sda", 2 * 1024 ** 3 // 512, rotational="1", model="HDD")
+        self.add_disk("nvme0n1", 1024 ** 3 // 512, discard="2199023255040")
+        self.add_disk("sdb", 8 * 1024 ** 2, removable="1")
+        self.add_disk("loop0", 1024)
+        self.add_disk("zram0", 1024)
+        self.add_disk("sr0", 0)
+        disks = {d.name: d for d in iv.probe_disks(self.sys.root)}
+        self.assertEqual(sorted(disks), ["nvme0n1", "sda", "sdb"])
+        self.assertEqual(disks["sda"].size, 2 * 1024 ** 3)
+        self.assertTrue(disks["sda"].rotational)
+        self.assertEqual(disks["sda"].model, "HDD")
+        self.assertTrue(disks["nvme0n1"].discard)
+        self.assertIsNone(disks["nvme0n1"].model)
+        self.assertTrue(disks["sdb"].removable)
+        self.assertEqual([d.name for d in iv.select_disks(list(disks.values()), "fixed,largest")], ["sda"])
+
+    def test_probe_gpus(self):
+        self.add_pci("0000:00:02.0", "0x030000", "0x8086", "0x9bc4")
+        self.add_pci("0000:01:00.0", "0x030200", "0x10de", "0x2520")
+        self.add_pci("0000:00:1f.3", "0x040300", "0x8086", "0x02c8")  # 声卡
+        gpus = iv.probe_gpus(self.sys.root)
+        self.assertEqual([(g.slot, g.vendor, g.device) for g in gpus],
+                         [("0000:00:02.0", 0x8086, 0x9bc4), ("0000:01:00.0", 0x10de, 0x2520)])
+
+    def test_probe_cpu_and_memory(self):
+        self.sys.write("proc/cpuinfo", "\n".join(
+            f"processor\t: {i}\nvendor_id\t: GenuineIntel\nmodel name\t: Test CPU\nflags\t\t: fpu sse2\n"
+            for i in range(4)))
+        self.sys.write("proc/meminfo", "MemTotal:       16318480 kB\nMemFree:         1000 kB")
+        cpu = iv.probe_cpu(self.sys.root)
+        self.assertEqual((cpu.vendor, cpu.model, cpu.threads, cpu.flags), ("GenuineIntel", "Test CPU", 4, ["fpu", "sse2"]))
+        self.assertEqual(iv.probe_memory(self.sys.root), 16318480 * 1024)
+
+    def test_missing_sysfs(self):
+        self.assertEqual(iv.probe_disks(self.sys.root), [])
+        self.assertEqual(iv.probe_gpus(self.sys.root), [])
+        self.assertEqual(iv.probe_memory(self.sys.root), 0)
+
+
+class HostonlyModulesTest(unittest.TestCase):
+    def setUp(self):
+        self.sys = FakeSysfs()
+
+    def tearDown(self):
+        self.sys.cleanup()
+
+    def test_nvme_disk(self):
+        self.sys.add_nvme()
+        self.assertEqual(iv.probe_storage_modules("nvme0n1", self.sys.root), ["nvme"])
+        self.assertEqual(iv.hostonly_modules("nvme0n1", "ext4", self.sys.root), ["nvme", "ext4"])
+
+    def test_loop_target_keeps_generic_hooks(self):
+        self.sys.write("sys/block/loop0/size", "2097152")
+        self.assertEqual(iv.hostonly_modules("loop0", "ext4", self.sys.root), [])
+        conf = "MODULES=()\nHOOKS=(base udev autodetect modconf block filesystems fsck)\n"
+        self.assertEqual(iv.tune_mkinitcpio(conf, iv.hostonly_modules("loop0", "ext4", self.sys.root)), conf)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import install_v2 as iv  # noqa: E402
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    """本地替身镜像: /fast/和/slow/下有core.db, /slow/发完响应头后再等一会, 其他路径404"""
+    body = b"x" * (64 * 1024)
+
+    def do_GET(self):
+        mirror = self.path.split("/")[1]
+        if mirror not in ("fast", "slow") or not self.path.endswith("/core/os/x86_64/" + iv.MIRROR_PROBE_DB):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        if mirror == "slow":
+            time.sleep(0.3)
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MirrorRankTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{cls.httpd.server_address[1]}"
+        cls.fast, cls.slow, cls.broken = (f"{base}/{m}/$repo/os/$arch" for m in ("fast", "slow", "broken"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_rank_by_speed_failures_last(self):
+        results = iv.rank_mirrors([self.broken, self.slow, self.fast], timeout=2, cache=None)
+        self.assertEqual([r.server for r in results], [self.fast, self.slow, self.broken])
+        self.assertTrue(results[0].ok and results[1].ok)
+        self.assertFalse(results[2].ok)
+        self.assertGreater(results[0].speed, results[1].speed)
+
+    def test_cache_reused_for_same_candidates(self):
+        cache = os.path.join(self.tmp.name, "mirrors.json")
+        first = iv.rank_mirrors([self.fast, self.broken], timeout=2, cache=cache)
+        self.assertIsNotNone(iv.load_mirror_cache([self.broken, self.fast], cache))
+        self.assertIsNone(iv.load_mirror_cache([self.fast], cache))
+        self.assertIsNone(iv.load_mirror_cache([self.fast, self.broken], cache, ttl=-1))
+        again = iv.rank_mirrors([self.fast, self.broken], timeout=2, cache=cache)
+        self.assertEqual([r.to_dict() for r in again], [r.to_dict() for r in first])
+
+    def test_write_mirrorlist(self):
+        path = os.path.join(self.tmp.name, "mirrorlist")
+        with open(path, "w") as f:
+            f.write("Server = http://old/$repo/os/$arch\n")
+        iv.write_mirrorlist(iv.rank_mirrors([self.broken, self.slow, self.fast], timeout=2, cache=None), path, top=1)
+        self.assertEqual(iv.read_mirrorlist_servers(path), [self.fast])
+        self.assertEqual(iv.read_mirrorlist_servers(path + ".bak"), ["http://old/$repo/os/$arch"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import functools
+import http.server
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import install_v2 as iv  # noqa: E402
+
+
+class QuietCacheHandler(iv.CacheRequestHandler):
+    stat = iv.CacheStat()
+
+    def log_message(self, *args):
+        pass
+
+
+class PackageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        for name, size in (("foo-1.0-1-x86_64.pkg.tar.zst", 1000), ("bar-2.0-3-any.pkg.tar.xz", 500)):
+            with open(os.path.join(self.dir, name), "wb") as f:
+                f.write(b"\0" * size)
+        with open(os.path.join(self.dir, "foo-1.0-1-x86_64.pkg.tar.zst.sig"), "wb") as f:
+            f.write(b"sig")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_local_directory(self):
+        cache = iv.PackageCache(self.dir)
+        cache.scan()
+        self.assertEqual(cache.available, {"foo-1.0-1-x86_64": 1000, "bar-2.0-3-any": 500})
+        cache.account(["foo-1.0-1-x86_64", "foo-1.0-2-x86_64", "baz-1-1-any"])
+        self.assertEqual((cache.stat.hits, cache.stat.misses, cache.stat.saved), (1, 2, 1000))
+
+    def test_lan_server(self):
+        handler = functools.partial(QuietCacheHandler, directory=self.dir)
+        httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            cache = iv.PackageCache(f"http://127.0.0.1:{httpd.server_address[1]}/")
+            cache.scan()
+            self.assertEqual(cache.available, {"foo-1.0-1-x86_64": None, "bar-2.0-3-any": None})
+            cache.account(["bar-2.0-3-any", "baz-1-1-any"])
+            self.assertEqual((cache.stat.hits, cache.stat.misses, cache.stat.saved), (1, 1, 500))
+            # pacman的下载: 一个命中, 一个404后回落到上游镜像
+            for name in ("foo-1.0-1-x86_64.pkg.tar.zst", "baz-1-1-any.pkg.tar.zst"):
+                try:
+                    urllib.request.urlopen(f"{cache.source}/{name}", timeout=10).close()
+                except urllib.error.HTTPError:
+                    pass
+        finally:
+            httpd.shutdown()
+            httpd.server_close()  # 等处理请求的线程结束, 服务端的统计才完整
+        # account()探测大小时的HEAD请求不算
+        stat = QuietCacheHandler.stat
+        self.assertEqual((stat.hits, stat.misses, stat.saved), (1, 1, 1000))
+
+    def test_templated_proxy_is_not_listed(self):
+        cache = iv.PackageCache("http://127.0.0.1:1/repo/$repo/os/$arch")
+        cache.scan()
+        self.assertTrue(cache.templated)
+        self.assertEqual(cache.available, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import signal
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import install_v2 as iv  # noqa: E402
+
+
+class SchedulerInterruptTest(unittest.TestCase):
+    def tearDown(self):
+        iv.cancel_event.clear()
+
+    def test_ctrl_c_stops_running_command(self):
+        results = []
+
+        def runner(name):
+            results.append(iv.run_stream(["sleep", "8"], echo=False))
+
+        threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT)).start()
+        start = time.monotonic()
+        with self.assertRaises(KeyboardInterrupt):
+            iv.StepScheduler([iv.Step("sleep")]).run(runner)
+        self.assertLess(time.monotonic() - start, 3)
+
+        deadline = time.monotonic() + 3
+        while not results and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(results), 1)
+        self.assertNotEqual(results[0].code, 0)
+        self.assertEqual(iv._running, set())
+
+
+if __name__ == "__main__":
+    unittest.main()